@@ -3,9 +3,11 @@
 
 from fastapi import APIRouter
 
-from .endpoints import odoo, tasks
+from .endpoints import backups, odoo, tasks, uploads
 
 
 api_router = APIRouter()
 api_router.include_router(odoo.router, prefix="/odoo", tags=["odoo"])
-api_router.include_router(tasks.router, prefix="/tasks", tags=["tasks"])
\ No newline at end of file
+api_router.include_router(tasks.router, prefix="/tasks", tags=["tasks"])
+api_router.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
+api_router.include_router(backups.router, prefix="/backups", tags=["backups"])
\ No newline at end of file
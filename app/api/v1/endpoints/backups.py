@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import os
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from typing import Optional
+
+from worker import main as wk
+
+router = APIRouter()
+
+
+def _not_found(backup_id):
+    return JSONResponse({'status': "No backup {}".format(backup_id)}, status_code=404)
+
+
+@router.get("")
+def list_backups(q: Optional[str] = None, db_name: Optional[str] = None, version: Optional[str] = None,
+                 module: Optional[str] = None, limit: int = wk.catalog.DEFAULT_LIMIT, offset: int = 0):
+    """
+    Search the catalog: q matches filenames and database names, module an
+    installed module.
+    """
+    try:
+        result = wk.catalog.search(q, db_name=db_name, version=version, module=module, limit=limit, offset=offset)
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=400)
+
+    return JSONResponse(result)
+
+
+@router.post("/sync", status_code=201)
+def sync_backups():
+    """
+    Index the backups copied in the input or output folders by hand, and
+    forget the deleted ones.
+    """
+    task = wk.sync_catalog.delay()
+
+    return JSONResponse({"task_id": task.id})
+
+
+@router.get("/precheck")
+def precheck_restore(filename: str, version: Optional[str] = None):
+    """
+    Checks run before a restore of an uploaded backup, from the catalog.
+    Backups not indexed yet are queued for indexing and answered with 409.
+    """
+    zipfile = os.path.join(wk.tools.INPUT_DIR, os.path.basename(filename))
+    result = wk.catalog.precheck(zipfile, version=version)
+    if result.get('indexed') is False:
+        task = wk.index_backup.delay(zipfile)
+        return JSONResponse(dict(result, task_id=task.id), status_code=409)
+
+    return JSONResponse(result, status_code=200 if result.get('backup') else 404)
+
+
+@router.get("/{backup_id}")
+def get_backup(backup_id: int):
+    backup = wk.catalog.get_backup_by_id(backup_id)
+    if not backup:
+        return _not_found(backup_id)
+
+    return JSONResponse(backup)
+
+
+@router.get("/{backup_id}/members")
+def list_members(backup_id: int, prefix: Optional[str] = None, limit: int = wk.catalog.DEFAULT_LIMIT,
+                 offset: int = 0):
+    """
+    Members of a backup with their offset, size, compressed size and CRC.
+    """
+    backup = wk.catalog.get_backup_by_id(backup_id)
+    if not backup:
+        return _not_found(backup_id)
+
+    members = wk.catalog.list_members(backup['id'], prefix=prefix, limit=limit, offset=offset)
+
+    return JSONResponse({'id': backup['id'], 'members': members})
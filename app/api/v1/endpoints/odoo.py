@@ -3,37 +3,104 @@
 
 
 from celery import chain, group
-from fastapi import APIRouter, Body
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi import APIRouter, Body, Request
+from fastapi.responses import JSONResponse
 import os
-from typing import Optional
 
 from worker import main as wk
+from worker.env import get_bool_env, parse_bool
 from . import utils
 
-DEFAULT_DUMP_FS = os.environ.get("DUMP_FILESTORE", False)
+
+DEFAULT_DUMP_FS = get_bool_env("DUMP_FILESTORE", True)
 DEFAULT_DUMP_FORMAT = os.environ.get("DUMP_FORMAT", "sql")
+DEFAULT_ARCHIVE_FORMAT = os.environ.get("ARCHIVE_FORMAT", wk.archive.ARCHIVE_FORMAT_ZIP)
+DEFAULT_DUMP_STREAM = get_bool_env("DUMP_STREAM", True)
+DEFAULT_DUMP_DEDUP = get_bool_env("DUMP_DEDUP", False)
+# template: CREATE DATABASE ... TEMPLATE, dump: dump and restore
+DUPLICATE_MODES = ('template', 'dump')
+DEFAULT_DUPLICATE_MODE = os.environ.get("DUPLICATE_MODE", "template")
+DEFAULT_RESTORE_JOBS = int(os.environ.get("RESTORE_JOBS", os.cpu_count() or 1))
+DEFAULT_DEFER_INDEXES = get_bool_env("RESTORE_DEFER_INDEXES", False)
+DEFAULT_RESTORE_STREAM = get_bool_env("RESTORE_STREAM", True)
+DEFAULT_RESTORE_PARALLEL = get_bool_env("RESTORE_PARALLEL", True)
 
 
 router = APIRouter()
 
 
-@router.post("/dump", status_code=201)
-def run_task_dump(payload = Body(...)):
-    data = {'db_name': payload["name"]}
+def _get_jobs(payload, default):
+    jobs = payload.get('jobs', default)
+    try:
+        # int() would truncate floats and accept booleans
+        valid = not isinstance(jobs, (bool, float)) and int(jobs) >= 1
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        raise ValueError("Invalid jobs '{}', expected a positive integer".format(jobs))
+    return int(jobs)
+
+
+def _get_bool(payload, key, default):
+    return parse_bool(payload.get(key, default))
 
-    filestore = payload.get('filestore', DEFAULT_DUMP_FS)
+
+def _get_dump_options(payload):
     dump = payload.get('dump', DEFAULT_DUMP_FORMAT)
+    if dump not in wk.tools.DUMP_FORMATS:
+        raise ValueError("Unknown dump format '{}'".format(dump))
 
-    tasks = chain(
-        wk.create_env.s(data),
-        wk.create_odoo_manifest.s(),
-        wk.dump_db.s(),
-        wk.add_to_zip.s(),
-        # wk.add_filestore.s(data).set(link_error=wk.error_handler.s()),
-        wk.add_filestore.s(),
-        wk.clean_workdir.s(),
-    ).on_error(wk.error_handler.s()).apply_async()
+    archive_format = payload.get('archive', DEFAULT_ARCHIVE_FORMAT)
+    if archive_format not in wk.archive.ARCHIVE_FORMATS:
+        raise ValueError("Unknown archive format '{}'".format(archive_format))
+
+    options = {
+        'dump_format': dump,
+        'archive_format': archive_format,
+        'jobs': _get_jobs(payload, wk.tools.DEFAULT_DUMP_JOBS),
+        'with_filestore': _get_bool(payload, 'filestore', DEFAULT_DUMP_FS),
+        'dedup': _get_bool(payload, 'dedup', DEFAULT_DUMP_DEDUP),
+        # Previous backup (task id or filename) for an incremental filestore
+        'since': payload.get('since', False),
+    }
+    if not options['with_filestore'] and (options['dedup'] or options['since']):
+        raise ValueError("Deduplicated and incremental backups require the filestore")
+    return options
+
+
+@router.post("/dump", status_code=201)
+async def run_task_dump(payload = Body(...)):
+    try:
+        data = dict(_get_dump_options(payload), db_name=payload["name"])
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=400)
+    dump, archive_format = data['dump_format'], data['archive_format']
+
+    # Directory format dumps are written to the workdir before being zipped
+    stream = _get_bool(payload, 'stream', DEFAULT_DUMP_STREAM) and dump != wk.tools.DUMP_FORMAT_DIRECTORY
+
+    # Other archive formats are only written by the single pass backup
+    if archive_format != wk.archive.ARCHIVE_FORMAT_ZIP and not stream:
+        return JSONResponse({'status': "Archive format '{}' requires a streamed sql or custom dump".format(archive_format)}, status_code=400)
+
+    if stream:
+        steps = [
+            wk.create_env.s(data),
+            wk.backup.s(),
+        ]
+    else:
+        steps = [
+            wk.create_env.s(data),
+            wk.create_odoo_manifest.s(),
+            wk.dump_db.s(),
+            wk.add_to_zip.s(),
+            # wk.add_filestore.s(data).set(link_error=wk.error_handler.s()),
+        ]
+        if data['with_filestore']:
+            steps.append(wk.add_filestore.s())
+        steps.append(wk.clean_workdir.s())
+
+    tasks = await utils.run_sync(utils.submit_chain, steps, on_error=wk.error_handler.s())
 
     result = {
         "task_id": tasks.id,
@@ -43,69 +110,242 @@ def run_task_dump(payload = Body(...)):
     return JSONResponse(result)
 
 
+@router.post("/dump/bulk", status_code=201)
+async def run_task_bulk_dump(payload = Body(...)):
+    """
+    Back up a list of databases, or all of the cluster with "all": true.
+    """
+    names = payload.get('names') or []
+    if not names and not _get_bool(payload, 'all', False):
+        return JSONResponse({'status': "No database to dump, give 'names' or 'all'"}, status_code=400)
 
-@router.get("/download/{task_id}")
-async def fast_download(task_id: str, method: Optional[str] = None):
+    try:
+        options = _get_dump_options(payload)
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=400)
+
+    # Bulk dumps are always single pass backups
+    if options['dump_format'] == wk.tools.DUMP_FORMAT_DIRECTORY:
+        return JSONResponse({'status': "Bulk dumps require a sql or custom dump"}, status_code=400)
+    if options['since']:
+        return JSONResponse({'status': "Bulk dumps can't be incremental"}, status_code=400)
 
+    task = await utils.run_sync(wk.bulk_dump.delay, names, options)
+
+    return JSONResponse({"task_id": task.id})
+
+
+@router.get("/dump/bulk/{task_id}")
+async def get_bulk_dump_status(task_id: str):
     try:
-        filepath = utils._get_file_from_task(task_id)
+        result = await utils.run_sync(utils.get_bulk_status, task_id)
     except ValueError as error:
-        return JSONResponse({'status': error})
+        return JSONResponse({'status': str(error)}, status_code=404)
 
-    if method == "stream":
-        return StreamingResponse(utils.iterfile(filepath), media_type="application/octet-stream")
+    return JSONResponse(result)
 
-    return FileResponse(filepath)
+
+@router.get("/download/{task_id}")
+async def fast_download(task_id: str, request: Request):
+
+    try:
+        filepath = await utils._get_file_from_task(task_id)
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=404)
+
+    return utils.get_file_response(request, filepath)
 
 
 @router.post("/restore", status_code=201)
-def restore_backup(payload = Body(...)):
+async def restore_backup(payload = Body(...)):
+    try:
+        jobs = _get_jobs(payload, DEFAULT_RESTORE_JOBS)
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=400)
+
     data = {
         'db_name': payload["name"],
-        'filename': payload["filename"]
+        'filename': payload["filename"],
+        'jobs': jobs,
+        'defer_indexes': _get_bool(payload, 'defer_indexes', DEFAULT_DEFER_INDEXES),
+        'stream': _get_bool(payload, 'stream', DEFAULT_RESTORE_STREAM),
+        # Odoo version the backup must come from
+        'version': payload.get('version'),
     }
 
-    tasks = chain(
-        wk.init_restore.s(data),
-        wk.unzip_dump.s(),
-        wk.create_database.s(),
-        wk.restore_dump.s(),
-        wk.unzip_filestore.s()
-    ).apply_async()
+    # The filestore disk is checked again by init_restore on the worker,
+    # backups missing from the catalog are indexed by check_restore
+    zipfile = os.path.join(wk.tools.INPUT_DIR, os.path.basename(data['filename']))
+    check = await utils.run_sync(wk.catalog.precheck, zipfile, version=data['version'])
+    if check['errors'] and check.get('indexed', True):
+        status_code = 400 if check.get('backup') else 404
+        return JSONResponse({'status': ", ".join(check['errors']), 'errors': check['errors']}, status_code=status_code)
+
+    if _get_bool(payload, 'parallel', DEFAULT_RESTORE_PARALLEL):
+        # Database and filestore restored at the same time
+        steps = [
+            wk.init_restore.s(data),
+            wk.check_restore.s(),
+            wk.restore.s(),
+        ]
+    elif data['stream']:
+        # Dump fed from the archive to postgres, see restore_stream for
+        # the cases where it is still extracted first
+        steps = [
+            wk.init_restore.s(data),
+            wk.check_restore.s(),
+            wk.create_database.s(),
+            wk.restore_stream.s(),
+            wk.unzip_filestore.s(),
+        ]
+    else:
+        steps = [
+            wk.init_restore.s(data),
+            wk.check_restore.s(),
+            wk.unzip_dump.s(),
+            wk.create_database.s(),
+            wk.restore_dump.s(),
+            wk.unzip_filestore.s(),
+        ]
+
+    tasks = await utils.run_sync(utils.submit_chain, steps)
 
     result = {
         "task_id": tasks.id,
         "parent_id": [t.id for t in list(utils.unpack_parents(tasks))][-1],
         # "names": [item.name for item in list(map(lambda x: x.name, tasks))],
-        "names": [t.name for t in list(utils.unpack_parents(tasks))],
+        "names": [step.task for step in steps],
         # "all": store(tasks)
     }
     # print([item.name for item in list(map(lambda x: x.name, tasks))])
     return JSONResponse(result)
 
 
+@router.post("/attachments/restore", status_code=201)
+async def restore_attachments(payload = Body(...)):
+    """
+    Put back some files of a live filestore from a backup (filename or
+    dump task id): "paths" in the filestore, "sha1s" of their content or
+    "ids" of their ir_attachment records.
+    """
+    paths = [path[len(wk.tools.FILESTORE_PREFIX):] if path.startswith(wk.tools.FILESTORE_PREFIX) else path
+             for path in payload.get('paths') or []]
+    sha1s = [checksum.lower() for checksum in payload.get('sha1s') or []]
+    ids = payload.get('ids') or []
+
+    if not (paths or sha1s or ids):
+        return JSONResponse({'status': "No attachment to restore, give 'paths', 'sha1s' or 'ids'"}, status_code=400)
+    invalid = [checksum for checksum in sha1s if not wk.tools.SHA1_RE.match(checksum)]
+    if invalid:
+        return JSONResponse({'status': "Invalid sha1 '{}'".format(invalid[0])}, status_code=400)
+    if not all(isinstance(value, int) for value in ids):
+        return JSONResponse({'status': "Attachment ids must be integers"}, status_code=400)
+
+    data = {
+        'db_name': payload["name"],
+        'backup': payload["backup"],
+        'paths': paths,
+        'sha1s': sha1s,
+        'ids': ids,
+        'overwrite': _get_bool(payload, 'overwrite', False),
+    }
+    task = await utils.run_sync(wk.restore_attachments.delay, data)
+
+    return JSONResponse({"task_id": task.id})
+
+
 @router.post("/duplicate", status_code=201)
-def run_task_duplicate(payload = Body(...)):
+async def run_task_duplicate(payload = Body(...)):
     data = {
         'db_name': payload["name"],
-        'new_db': payload["new"]
+        'new_db': payload["new"],
+        'terminate': _get_bool(payload, 'terminate', False),
+        'filestore_mode': payload.get('filestore_mode', wk.tools.DEFAULT_FILESTORE_COPY_MODE),
     }
 
     # filestore = payload.get('filestore', DEFAULT_DUMP_FS)
     # dump = payload.get('dump', DEFAULT_DUMP_FORMAT)
+    mode = payload.get('mode', DEFAULT_DUPLICATE_MODE)
+
+    if mode not in DUPLICATE_MODES:
+        return JSONResponse({'status': "Unknown duplicate mode '{}'".format(mode)}, status_code=400)
+    if data['filestore_mode'] not in wk.tools.FILESTORE_COPY_MODES:
+        return JSONResponse({'status': "Unknown filestore mode '{}'".format(data['filestore_mode'])}, status_code=400)
+
+    if mode == "template":
+        # Falls back to dump/restore by itself when the clone is impossible
+        steps = [
+            wk.create_env.s(data),
+            wk.clone_database.s(),
+        ]
+    else:
+        steps = [
+            wk.create_env.s(data),
+            wk.dump_db.s(),
+            wk.create_database.s(data['new_db']),
+            wk.restore_dump.s(data['new_db']),
+        ]
 
-    tasks = chain(
-        wk.create_env.s(data),
-        wk.dump_db.s(),
-        wk.create_database.s(data['new_db']),
-        wk.restore_dump.s(data['new_db']),
+    steps += [
         wk.copy_filestore.s(),
         wk.clean_workdir.s(),
-    ).on_error(wk.error_handler.s()).apply_async()
+    ]
+
+    tasks = await utils.run_sync(utils.submit_chain, steps, on_error=wk.error_handler.s())
 
     result = {
         "task_id": tasks.id,
         "parent_id": [t.id for t in list(utils.unpack_parents(tasks))][-1],
         # "all": store(tasks)
     }
-    return JSONResponse(result)
\ No newline at end of file
+    return JSONResponse(result)
+
+
+@router.post("/blobstore/gc", status_code=201)
+async def run_task_gc_blobstore(payload = Body({})):
+    task = await utils.run_sync(wk.gc_blobstore.delay, _get_bool(payload, 'prune', False))
+
+    return JSONResponse({"task_id": task.id})
+
+
+@router.post("/claim", status_code=201)
+async def claim_database(payload = Body(...)):
+    """
+    Create a tenant from a database restored ahead of time from a template
+    backup, 409 when none is ready: fall back to /restore.
+    """
+    template = payload.get('template', wk.warm.DEFAULT_TEMPLATE)
+    if template not in wk.warm.WARM_TEMPLATES:
+        return JSONResponse({'status': "Unknown template '{}'".format(template)}, status_code=404)
+    # Checked before taking a database, which would otherwise be lost
+    try:
+        wk.warm.check_db_name(payload.get('name'))
+    except ValueError as error:
+        return JSONResponse({'status': str(error)}, status_code=400)
+
+    db_name = await utils.run_sync(wk.warm.pop_ready, template)
+    if not db_name:
+        return JSONResponse({'status': "No database ready for template '{}'".format(template)}, status_code=409)
+
+    data = {'db_name': db_name, 'new_db': payload["name"], 'template': template}
+    try:
+        task = await utils.run_sync(wk.claim_database.delay, data)
+    except Exception:
+        await utils.run_sync(wk.warm.push_back, template, db_name)
+        raise
+
+    return JSONResponse({"task_id": task.id, "name": payload["name"]})
+
+
+@router.get("/warm")
+async def get_warm_pool():
+    result = await utils.run_sync(wk.warm.get_status)
+
+    return JSONResponse(result)
+
+
+@router.post("/warm/refill", status_code=201)
+async def refill_warm_pool():
+    task = await utils.run_sync(wk.refill_warm_pool.delay)
+
+    return JSONResponse({"task_id": task.id})
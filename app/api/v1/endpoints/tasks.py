@@ -4,7 +4,7 @@
 
 from celery.result import AsyncResult
 from fastapi import APIRouter, Body
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional
 
 from worker import main as wk
@@ -14,15 +14,31 @@ router = APIRouter()
 
 
 @router.get("/{task_id}")
-def get_status(task_id):
+async def get_status(task_id):
+    # Chains submitted by the odoo endpoints are read in one round trip
+    result = await utils.get_chain_status(task_id)
+    if result is None:
+        result = await utils.run_sync(_get_status, task_id)
+
+    return JSONResponse(result)
+
+
+def _get_status(task_id):
     task_result = AsyncResult(task_id)
 
-    result = {
+    return {
         "id": task_id,
         "result": str(task_result.result) if bool(task_result.traceback) else task_result.result,
         "traceback": str(task_result.traceback) if task_result.traceback else "",
         "status": task_result.status,
         "tasks": [(t.name, t.state) for t in utils.iter_children(task_result)],
     }
-    # task_result.forget()
-    return JSONResponse(result)
\ No newline at end of file
+
+
+@router.get("/{task_id}/events")
+async def stream_events(task_id):
+    """
+    Push state and progress of a task (and its chain) as Server-Sent Events.
+    """
+    headers = {'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"}
+    return StreamingResponse(utils.iter_events(task_id), media_type="text/event-stream", headers=headers)
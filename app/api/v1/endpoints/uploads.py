@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+import aiofiles
+from fastapi import APIRouter, Body, Request
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from worker import main as wk
+
+# Uploads are written next to the backups so they are moved in place by a
+# link once complete
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(wk.tools.INPUT_DIR, '.uploads'))
+UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 0))
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+ARCHIVE_MAGICS = [b'PK\x03\x04', wk.archive.ZSTD_MAGIC]
+
+router = APIRouter()
+
+
+def _get_paths(upload_id):
+    if not UPLOAD_ID_RE.match(upload_id):
+        raise KeyError(upload_id)
+    base = os.path.join(UPLOAD_DIR, upload_id)
+    return base + '.part', base + '.json'
+
+
+def _read_session(upload_id):
+    """
+    Session of an upload, its offset is the end of the last chunk recorded
+    with its sha256: a chunk interrupted while written is sent again.
+    """
+    part, meta = _get_paths(upload_id)
+    if not os.path.isfile(meta):
+        raise KeyError(upload_id)
+    with open(meta) as fh:
+        session = json.load(fh)
+    session['offset'] = sum(size for size, digest in session['chunks'])
+    return session
+
+
+def _write_session(upload_id, session):
+    part, meta = _get_paths(upload_id)
+    tmp = "{}.{}.tmp".format(meta, uuid.uuid4().hex)
+    with open(tmp, 'w') as fh:
+        json.dump({key: value for key, value in session.items() if key != 'offset'}, fh)
+    os.replace(tmp, meta)
+
+
+def _remove_session(upload_id):
+    for path in _get_paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _lock(part):
+    """
+    Take the lock of an upload, seen by every API process and released if
+    the one holding it dies. None if it is already taken.
+    """
+    fd = os.open(part, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _get_hash(chunks):
+    """
+    Checksum of an upload: sha256 of the binary sha256 of its chunks, in
+    order. Computed from the digests of the chunks, the upload is not read.
+    """
+    sha256 = hashlib.sha256()
+    for size, digest in chunks:
+        sha256.update(bytes.fromhex(digest))
+    return sha256.hexdigest()
+
+
+def _link(part, target):
+    """
+    Put a complete upload in place, never replacing an existing backup.
+    """
+    try:
+        os.link(part, target)
+        return
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    # Upload folder on another filesystem: copied next to the target first
+    tmp = os.path.join(os.path.dirname(target), ".{}.{}.tmp".format(os.path.basename(target), uuid.uuid4().hex))
+    try:
+        shutil.copyfile(part, tmp)
+        os.link(tmp, target)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+
+def _not_found(upload_id):
+    return JSONResponse({'status': "No upload {}".format(upload_id)}, status_code=404)
+
+
+@router.post("", status_code=201)
+def create_upload(payload = Body(...)):
+    """
+    Start an upload of a backup, chunks are then sent with PUT at the
+    current offset.
+    """
+    filename = os.path.basename(payload.get('filename') or '')
+    extensions = tuple(wk.archive.ARCHIVE_FORMATS.values())
+    if not filename or filename.startswith('.') or not filename.endswith(extensions):
+        return JSONResponse({'status': "Invalid backup filename '{}'".format(filename)}, status_code=400)
+    if os.path.exists(os.path.join(wk.tools.INPUT_DIR, filename)):
+        return JSONResponse({'status': "Backup '{}' already exists".format(filename)}, status_code=409)
+
+    size = payload.get('size')
+    if size is not None and UPLOAD_MAX_SIZE and int(size) > UPLOAD_MAX_SIZE:
+        return JSONResponse({'status': "Backup too large"}, status_code=413)
+
+    upload_id = uuid.uuid4().hex
+    part, meta = _get_paths(upload_id)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    open(part, 'wb').close()
+    _write_session(upload_id, {'filename': filename, 'size': size and int(size), 'chunks': []})
+
+    return JSONResponse({'upload_id': upload_id, 'offset': 0}, status_code=201)
+
+
+@router.get("/{upload_id}")
+def get_upload(upload_id: str):
+    """
+    Offset to resume an interrupted upload from.
+    """
+    try:
+        session = _read_session(upload_id)
+    except KeyError:
+        return _not_found(upload_id)
+
+    return JSONResponse(dict(session, upload_id=upload_id))
+
+
+@router.put("/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = 0, sha256: str = None):
+    """
+    Append the request body at offset, which must be the current size of
+    the upload. The body is streamed to disk, never held in memory, and
+    hashed on the way: its sha256 is checked if given.
+    """
+    try:
+        part, meta = _get_paths(upload_id)
+        fd = _lock(part)
+    except (KeyError, FileNotFoundError):
+        return _not_found(upload_id)
+    if fd is None:
+        return JSONResponse({'status': "Upload {} is already being written".format(upload_id)}, status_code=409)
+
+    try:
+        return await _write_chunk(upload_id, request, offset, sha256)
+    finally:
+        os.close(fd)
+
+
+async def _write_chunk(upload_id, request, offset, expected=None):
+    # Read once locked, the offset can't change anymore
+    try:
+        session = _read_session(upload_id)
+    except KeyError:
+        return _not_found(upload_id)
+
+    if offset != session['offset']:
+        return JSONResponse({'status': "Expected offset {}".format(session['offset']), 'offset': session['offset']},
+                            status_code=409)
+
+    part, meta = _get_paths(upload_id)
+    # Drop what an interrupted request wrote without recording it
+    os.truncate(part, offset)
+    sha256 = hashlib.sha256()
+    async with aiofiles.open(part, mode='ab') as fh:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if UPLOAD_MAX_SIZE and offset + len(chunk) > UPLOAD_MAX_SIZE:
+                _remove_session(upload_id)
+                return JSONResponse({'status': "Backup too large"}, status_code=413)
+            await fh.write(chunk)
+            sha256.update(chunk)
+            offset += len(chunk)
+
+    digest = sha256.hexdigest()
+    if expected and expected.lower() != digest:
+        os.truncate(part, session['offset'])
+        return JSONResponse({'status': "Checksum mismatch", 'sha256': digest, 'offset': session['offset']},
+                            status_code=400)
+    if offset > session['offset']:
+        session['chunks'].append([offset - session['offset'], digest])
+        _write_session(upload_id, session)
+
+    # Reject anything that is not an archive as soon as its header is known
+    if session['offset'] < len(ARCHIVE_MAGICS[0]) <= offset:
+        async with aiofiles.open(part, mode='rb') as fh:
+            magic = await fh.read(len(ARCHIVE_MAGICS[0]))
+        if magic not in ARCHIVE_MAGICS:
+            _remove_session(upload_id)
+            return JSONResponse({'status': "Not a zip or tar.zst backup"}, status_code=400)
+
+    return JSONResponse({'upload_id': upload_id, 'offset': offset, 'sha256': digest})
+
+
+@router.post("/{upload_id}/complete")
+async def complete_upload(upload_id: str, payload = Body({})):
+    """
+    Check and move the upload to the input folder, the filename returned is
+    the one to give to /odoo/restore. The sha256 given is checked against
+    the checksum of the chunks, see _get_hash.
+    """
+    try:
+        part, meta = _get_paths(upload_id)
+        # Chunks sent while the upload is checked and moved are refused
+        fd = _lock(part)
+    except (KeyError, FileNotFoundError):
+        return _not_found(upload_id)
+    if fd is None:
+        return JSONResponse({'status': "Upload {} is being written".format(upload_id)}, status_code=409)
+
+    try:
+        return await _complete(upload_id, payload)
+    finally:
+        os.close(fd)
+
+
+async def _complete(upload_id, payload):
+    try:
+        session = _read_session(upload_id)
+    except KeyError:
+        return _not_found(upload_id)
+
+    if session['size'] is not None and session['offset'] != session['size']:
+        return JSONResponse({'status': "Upload incomplete", 'offset': session['offset']}, status_code=409)
+
+    sha256 = _get_hash(session['chunks'])
+    if payload.get('sha256') and payload['sha256'].lower() != sha256:
+        return JSONResponse({'status': "Checksum mismatch", 'sha256': sha256}, status_code=400)
+
+    part, meta = _get_paths(upload_id)
+    try:
+        manifest = await run_in_threadpool(wk.tools.read_manifest, part)
+    except Exception as error:
+        return JSONResponse({'status': "Invalid backup: {}".format(error)}, status_code=400)
+    if not manifest:
+        return JSONResponse({'status': "Invalid backup: no manifest"}, status_code=400)
+
+    target = os.path.join(wk.tools.INPUT_DIR, session['filename'])
+    try:
+        # Unlike rename, never replaces an existing backup
+        await run_in_threadpool(_link, part, target)
+    except FileExistsError:
+        return JSONResponse({'status': "Backup '{}' already exists".format(session['filename'])}, status_code=409)
+    _remove_session(upload_id)
+    # Indexing reads the whole archive, done by a worker
+    await run_in_threadpool(wk.index_backup.delay, target)
+
+    return JSONResponse({
+        'filename': session['filename'],
+        'size': session['offset'],
+        'sha256': sha256,
+        'manifest': manifest,
+    })
+
+
+@router.delete("/{upload_id}")
+def abort_upload(upload_id: str):
+    try:
+        part, meta = _get_paths(upload_id)
+        # Not while a chunk is written or the upload moved in place
+        fd = _lock(part)
+    except (KeyError, FileNotFoundError):
+        return _not_found(upload_id)
+    if fd is None:
+        return JSONResponse({'status': "Upload {} is being written".format(upload_id)}, status_code=409)
+
+    try:
+        _read_session(upload_id)
+        _remove_session(upload_id)
+    except KeyError:
+        return _not_found(upload_id)
+    finally:
+        os.close(fd)
+
+    return JSONResponse({'upload_id': upload_id, 'status': "aborted"})
@@ -1,9 +1,60 @@
 # -*- coding: utf-8 -*-
 # Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
 
+import json
 import os
+import re
+import time
+import aiofiles
+from celery import chain
 from celery.result import AsyncResult
+import redis.asyncio as aioredis
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
 
+from worker import main as wk
+
+CHAIN_KEY = 'saas:chain:{}'
+# Status responses are cached for that long, clients poll every few seconds
+STATUS_CACHE_TTL = float(os.environ.get("STATUS_CACHE_TTL", 1))
+STATUS_CACHE_SIZE = int(os.environ.get("STATUS_CACHE_SIZE", 4096))
+
+# A comment line is sent when no event came for that long, it keeps
+# proxies from closing the stream
+EVENTS_KEEPALIVE = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+READY_STATES = ['SUCCESS', 'FAILURE', 'REVOKED']
+
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+# Task results never change, their file is kept for that long
+DOWNLOAD_CACHE_TTL = float(os.environ.get("DOWNLOAD_CACHE_TTL", 300))
+# Location of OUTPUT_DIR for an nginx internal redirect, nginx then serves
+# the file itself with sendfile and ranges
+DOWNLOAD_ACCEL_REDIRECT = os.environ.get("DOWNLOAD_ACCEL_REDIRECT")
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_chains = {}
+_status_cache = {}
+_files = {}
+_client = None
+
+
+def get_client():
+    """
+    Asyncio client of the result backend, shared by the requests of the
+    process.
+    """
+    global _client
+    if _client is None:
+        _client = aioredis.from_url(wk.celery.conf.result_backend)
+    return _client
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking call (Celery submission, result backend) off the event
+    loop.
+    """
+    return await run_in_threadpool(func, *args, **kwargs)
 
 
 def unpack_chain(nodes):
@@ -41,20 +92,292 @@ def store(node):
     return id_chain
 
 
-def _get_file_from_task(task_id, key='download'):
-    task_result = AsyncResult(task_id)
-    if not task_result.result:
+def iter_parents(node):
+    while node:
+        yield node
+        node = node.parent
+
+
+def save_chain(result, signatures):
+    """
+    Record the tasks of a submitted chain under each of their ids, its
+    status can then be read in one round trip from any of them.
+    """
+    ids = [node.id for node in iter_parents(result)][::-1]
+    graph = json.dumps([[task_id, sig.task] for task_id, sig in zip(ids, signatures)])
+
+    backend = wk.celery.backend
+    pipe = backend.client.pipeline()
+    for task_id in ids:
+        pipe.set(CHAIN_KEY.format(task_id), graph, ex=backend.expires)
+    pipe.execute()
+
+
+def submit_chain(steps, on_error=None):
+    """
+    Submit a chain of signatures and record it, returns its last result.
+    """
+    tasks = chain(*steps)
+    if on_error is not None:
+        tasks = tasks.on_error(on_error)
+    result = tasks.apply_async()
+    save_chain(result, steps)
+
+    return result
+
+
+async def _get_chain(task_id):
+    # Chains never change once submitted
+    if task_id not in _chains:
+        graph = await get_client().get(CHAIN_KEY.format(task_id))
+        if graph is None:
+            return None
+        if len(_chains) >= STATUS_CACHE_SIZE:
+            _chains.clear()
+        _chains[task_id] = json.loads(graph)
+    return _chains[task_id]
+
+
+async def get_chain_status(task_id, cache=True):
+    """
+    Status of a task and of the chain it belongs to, None if the chain was
+    not recorded by save_chain.
+    """
+    now = time.monotonic()
+    cached = _status_cache.get(task_id)
+    if cache and cached and cached[0] > now:
+        return cached[1]
+
+    tasks = await _get_chain(task_id)
+    if tasks is None:
+        return None
+
+    backend = wk.celery.backend
+    values = await get_client().mget([backend.get_key_for_task(child_id) for child_id, name in tasks])
+    metas = {
+        child_id: backend.decode_result(value) if value else {'status': 'PENDING', 'result': None}
+        for (child_id, name), value in zip(tasks, values)
+    }
+
+    meta = metas[task_id]
+    result = meta.get('result')
+    status = {
+        "id": task_id,
+        "result": str(result) if meta.get('traceback') or isinstance(result, Exception) else result,
+        "traceback": str(meta['traceback']) if meta.get('traceback') else "",
+        "status": meta['status'],
+        "tasks": [(name, metas[child_id]['status']) for child_id, name in tasks],
+    }
+
+    if len(_status_cache) >= STATUS_CACHE_SIZE:
+        _status_cache.clear()
+    _status_cache[task_id] = (now + STATUS_CACHE_TTL, status)
+
+    return status
+
+
+def _format_event(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+def _is_finished(status):
+    states = [state for name, state in status.get('tasks') or []]
+    return status['status'] in READY_STATES or 'FAILURE' in states
+
+
+async def iter_events(task_id):
+    """
+    Server-Sent Events of a task and of the chain it belongs to: the current
+    status first, then state and progress events published by the workers
+    until the chain is done.
+    """
+    tasks = await _get_chain(task_id) or [[task_id, None]]
+    last_id = tasks[-1][0]
+
+    client = aioredis.from_url(wk.broker.REDIS_URL)
+    pubsub = client.pubsub()
+    # Subscribed before reading the status so no event is missed in between
+    await pubsub.subscribe(*[wk.broker.EVENTS_CHANNEL.format(child_id) for child_id, name in tasks])
+
+    try:
+        status = await get_chain_status(last_id, cache=False)
+        if status is None:
+            status = {"id": task_id, "status": (await _get_task_meta(task_id))['status']}
+        yield _format_event('status', status)
+        if _is_finished(status):
+            return
+
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=EVENTS_KEEPALIVE)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            event = json.loads(message['data'])
+            yield _format_event(event['event'], event)
+            if event['event'] == 'state' and (
+                    event['state'] == 'FAILURE' or (event['task_id'] == last_id and event['state'] in READY_STATES)):
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.close()
+        await client.close()
+
+
+async def _get_task_meta(task_id):
+    backend = wk.celery.backend
+    value = await get_client().get(backend.get_key_for_task(task_id))
+    return backend.decode_result(value) if value else {'status': 'PENDING', 'result': None}
+
+
+async def _get_file_from_task(task_id, key='download'):
+    cached = _files.get((task_id, key))
+    if cached and cached[0] > time.monotonic() and os.path.isfile(cached[1]):
+        return cached[1]
+
+    result = (await _get_task_meta(task_id))['result']
+    if not isinstance(result, dict):
         raise ValueError('No task found motherf****r !')
 
-    filepath = task_result.result.get(key, False)
+    filepath = result.get(key, False)
 
-    if not os.path.isfile(filepath):
+    if not filepath or not os.path.isfile(filepath):
         raise ValueError('No file found at {}'.format(filepath))
 
+    if len(_files) >= STATUS_CACHE_SIZE:
+        _files.clear()
+    _files[(task_id, key)] = (time.monotonic() + DOWNLOAD_CACHE_TTL, filepath)
+
     return filepath
 
 
-def iterfile(path):
-    with open(path, mode="rb") as file_like:
-        yield from file_like
+def _parse_range(header, size):
+    """
+    First and last byte of a single bytes range, None to send the whole
+    file (no or multiple ranges). Raises ValueError if not satisfiable.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+        if not int(last):
+            raise ValueError(header)
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        raise ValueError(header)
+    return (start, end)
+
+
+class RangeFileResponse(FileResponse):
+    """
+    FileResponse read by fixed size chunks, restricted to a byte range with
+    set_range.
+    """
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headers['accept-ranges'] = 'bytes'
+        self.range = None
+
+    def set_range(self, start, end):
+        self.range = (start, end)
+        self.status_code = 206
+        self.headers['content-length'] = str(end - start + 1)
+        self.headers['content-range'] = 'bytes {}-{}/{}'.format(start, end, self.stat_result.st_size)
+
+    async def __call__(self, scope, receive, send):
+        if self.range is None:
+            return await super().__call__(scope, receive, send)
+
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+        start, end = self.range
+        remaining = end - start + 1
+        async with aiofiles.open(self.path, mode='rb') as fh:
+            await fh.seek(start)
+            while remaining:
+                chunk = await fh.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': bool(remaining)})
+        if remaining:
+            # File truncated meanwhile
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+        if self.background is not None:
+            await self.background()
+
+
+def get_file_response(request, filepath):
+    """
+    Download of a file supporting single range and If-Range requests, so
+    interrupted downloads can be resumed.
+    """
+    stat_result = os.stat(filepath)
+    filename = os.path.basename(filepath)
+
+    if DOWNLOAD_ACCEL_REDIRECT:
+        location = os.path.join(DOWNLOAD_ACCEL_REDIRECT, os.path.relpath(filepath, wk.tools.OUTPUT_DIR))
+        return Response(headers={
+            'x-accel-redirect': location,
+            'content-disposition': 'attachment; filename="{}"'.format(filename),
+        })
+
+    response = RangeFileResponse(
+        filepath, stat_result=stat_result, filename=filename, media_type="application/octet-stream")
+
+    header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    # A resumed download of a file changed since is sent whole
+    if header and (not if_range or if_range.strip('"') == response.headers['etag']):
+        try:
+            byte_range = _parse_range(header, stat_result.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={'content-range': 'bytes */{}'.format(stat_result.st_size)})
+        if byte_range:
+            response.set_range(*byte_range)
+
+    return response
+
+
+def get_bulk_status(task_id):
+    """
+    Aggregated status of a bulk dump and the status of each database.
+    """
+    task_result = AsyncResult(task_id)
+    if not task_result.ready():
+        return {"id": task_id, "status": task_result.status, "databases": {}}
+    if task_result.failed():
+        return {"id": task_id, "status": task_result.status, "error": str(task_result.result), "databases": {}}
+    if not isinstance(task_result.result, dict) or 'tasks' not in task_result.result:
+        raise ValueError('No bulk dump found for task {}'.format(task_id))
+
+    databases, counts = {}, {}
+    for name, child_id in task_result.result['tasks'].items():
+        child = AsyncResult(child_id)
+        status = {"task_id": child_id, "status": child.status}
+        if child.successful():
+            status["download"] = child.result.get('download')
+        elif child.failed():
+            status["error"] = str(child.result)
+        databases[name] = status
+        counts[child.status] = counts.get(child.status, 0) + 1
 
+    done = sum(counts.get(state, 0) for state in ('SUCCESS', 'FAILURE', 'REVOKED'))
+    return {
+        "id": task_id,
+        "group_id": task_result.result['group_id'],
+        "status": 'SUCCESS' if done == len(databases) else 'PROGRESS',
+        "total": len(databases),
+        "counts": counts,
+        "databases": databases,
+    }
@@ -4,16 +4,21 @@
 from celery.result import AsyncResult
 from celery import chain, group
 from fastapi import Body, FastAPI, Request, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
 import os
 
 from api.v1.api import api_router
 from core.config import settings
 from api.v1.endpoints import utils
+from worker import metrics as wk_metrics
 
 DEFAULT_DUMP_FS = os.environ.get("DUMP_FILESTORE", False)
 DEFAULT_DUMP_FORMAT = os.environ.get("DUMP_FORMAT", "sql")
 
+# Worker metrics are read from Redis on each scrape
+registry = CollectorRegistry()
+registry.register(wk_metrics.RedisCollector())
 
 root_router = APIRouter()
 app = FastAPI(title="SaaS Backend")
@@ -27,5 +32,11 @@ def root(request: Request):
     return JSONResponse(vals)
 
 
+@root_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    content = await utils.run_sync(generate_latest, registry)
+    return Response(content, headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
 app.include_router(root_router)
\ No newline at end of file
@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+"""
+Benchmark of dump, restore and duplicate on a synthetic Odoo tenant.
+
+Creates a database (ir_module_module, ir_attachment and bulk tables) and a
+filestore of sha1 named blobs, then times the worker.tools functions and
+the full task chains run eagerly. Runs where the workers run, with their
+Postgres and Redis:
+
+    docker-compose run --rm worker-db python -m tests.benchmark --rows 200000 --files 20000 -o bench.json
+
+Each step reports its duration, throughput (MB/s, files/s), peak RSS of the
+process and its children (pg_dump, psql...) and peak scratch disk use (growth
+of the used space of the filesystems the steps write to: output, input,
+filestore, blobstore and temporary folders, each counted once). The Postgres
+data directory is on another host and not included.
+"""
+
+import argparse
+from datetime import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from celery import chain
+
+from worker import main as wk
+from worker import blobstore, db, tools
+
+MODULES = [('base', '14.0.1.3'), ('web', '14.0.1.0'), ('mail', '14.0.1.2'), ('sale', '14.0.1.1')]
+SQL_CREATE_MODULES = """
+CREATE TABLE ir_module_module (id serial PRIMARY KEY, name varchar NOT NULL, latest_version varchar, state varchar);
+"""
+SQL_CREATE_ATTACHMENTS = """
+CREATE TABLE ir_attachment (
+    id serial PRIMARY KEY, name varchar, store_fname varchar, checksum varchar(40), file_size integer,
+    mimetype varchar, res_model varchar, res_id integer
+);
+"""
+SQL_CREATE_TABLE = """
+CREATE TABLE bench_data_{0} (
+    id serial PRIMARY KEY, name varchar NOT NULL, ref varchar, amount numeric, active boolean,
+    create_date timestamp, payload text
+);
+INSERT INTO bench_data_{0} (name, ref, amount, active, create_date, payload)
+SELECT 'record ' || i, md5(i::text), random() * 1000, i % 3 > 0, now() - i * interval '1 minute',
+       repeat(md5(random()::text), {1})
+FROM generate_series(1, {2}) AS i;
+CREATE INDEX bench_data_{0}_ref_idx ON bench_data_{0} (ref);
+CREATE INDEX bench_data_{0}_date_idx ON bench_data_{0} (create_date);
+"""
+SAMPLE_INTERVAL = 0.1
+
+
+def _read_rss(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _iter_children(pid):
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as fh:
+            children = [int(child) for child in fh.read().split()]
+    except OSError:
+        return
+    for child in children:
+        yield child
+        yield from _iter_children(child)
+
+
+def _get_disk_used(path):
+    stats = os.statvfs(path)
+    return (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+
+
+def get_volumes(paths):
+    """
+    One existing folder per filesystem among paths, folders not created
+    yet are looked up through their parents.
+    """
+    volumes = {}
+    for path in paths:
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        volumes.setdefault(os.stat(path).st_dev, path)
+    return list(volumes.values())
+
+
+def get_scratch_paths():
+    return [
+        tools.OUTPUT_DIR, tools.INPUT_DIR, wk.FILESTORE_PATH, blobstore.BLOBSTORE_PATH, tempfile.gettempdir(),
+    ]
+
+
+class Sampler(threading.Thread):
+    """
+    Peak RSS of this process and its children and peak disk use of
+    filesystems (the sum of their growth) while a step runs.
+    """
+
+    def __init__(self, paths, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.volumes = get_volumes(paths)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.disk_base = self._get_disk_used()
+        self.peak_rss = 0
+        self.peak_disk = 0
+
+    def _get_disk_used(self):
+        return sum(_get_disk_used(path) for path in self.volumes)
+
+    def sample(self):
+        pid = os.getpid()
+        rss = _read_rss(pid) + sum(_read_rss(child) for child in _iter_children(pid))
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_disk = max(self.peak_disk, self._get_disk_used() - self.disk_base)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def measure(results, name, func, size=0, files=0, required=False):
+    """
+    Run a step and record its metrics, size in bytes and files processed.
+    Failed steps are reported and skipped unless required.
+    """
+    print("{}...".format(name), file=sys.stderr)
+    sampler = Sampler(get_scratch_paths())
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        value = func()
+        error = None
+    except Exception as exc:
+        value, error = None, "{}: {}".format(type(exc).__name__, exc)
+    seconds = time.perf_counter() - start
+    sampler.stop()
+
+    results.append({
+        'step': name,
+        'seconds': round(seconds, 3),
+        'bytes': size,
+        'files': files,
+        'mb_s': round(size / seconds / 1024 / 1024, 2) if size else None,
+        'files_s': round(files / seconds, 1) if files else None,
+        'peak_rss': sampler.peak_rss,
+        'peak_disk': max(sampler.peak_disk, 0),
+        'error': error,
+    })
+    print("{} done in {:.1f}s{}".format(name, seconds, " ({})".format(error) if error else ""), file=sys.stderr)
+    if error and required:
+        raise RuntimeError("Step {} failed: {}".format(name, error))
+    return value
+
+
+def create_database(db_name, tables, rows, row_size):
+    tools.create_database(db_name)
+    with db.connection(db_name) as conn:
+        cr = conn.cursor()
+        cr.execute(SQL_CREATE_MODULES)
+        cr.executemany(
+            "INSERT INTO ir_module_module (name, latest_version, state) VALUES (%s, %s, 'installed')", MODULES)
+        cr.execute(SQL_CREATE_ATTACHMENTS)
+        for index in range(tables):
+            # md5 is 32 characters
+            cr.execute(SQL_CREATE_TABLE.format(index, max(row_size // 32, 1), rows))
+        conn.commit()
+        cr.execute("SELECT pg_database_size(%s)", (db_name,))
+        return cr.fetchone()[0]
+
+
+def _random_size(median, sigma):
+    return max(int(random.lognormvariate(0, sigma) * median), 1)
+
+
+def create_filestore(db_name, files, median_size, sigma, compressible):
+    """
+    Odoo like filestore: blobs named after their sha1 in 256 folders, a
+    share of them compressible (text) and the rest random (images, pdf).
+    """
+    path = os.path.join(wk.FILESTORE_PATH, db_name)
+    total = 0
+    attachments = []
+
+    for index in range(files):
+        size = _random_size(median_size, sigma)
+        if random.random() < compressible:
+            content = (b"Lorem ipsum dolor sit amet %d " % index) * (size // 30 + 1)
+            content = content[:size]
+        else:
+            content = os.urandom(size)
+        checksum = hashlib.sha1(content).hexdigest()
+        filepath = os.path.join(path, checksum[:2], checksum)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as fh:
+            fh.write(content)
+        total += size
+        attachments.append(('file{}'.format(index), '{}/{}'.format(checksum[:2], checksum), checksum, size))
+
+    with db.connection(db_name) as conn:
+        conn.cursor().executemany(
+            "INSERT INTO ir_attachment (name, store_fname, checksum, file_size, mimetype, res_model, res_id) "
+            "VALUES (%s, %s, %s, %s, 'application/octet-stream', 'res.partner', 1)", attachments)
+        conn.commit()
+
+    return (path, total, files)
+
+
+def drop_tenant(db_name):
+    tools.drop_database(db_name)
+    path = os.path.join(wk.FILESTORE_PATH, db_name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def run(args):
+    random.seed(args.seed)
+    wk.celery.conf.task_always_eager = True
+    wk.celery.conf.task_eager_propagates = True
+
+    name = args.db_name
+    results = []
+    created = []
+    workdir = os.path.join(tools.OUTPUT_DIR, "benchmark-{}".format(name))
+    os.makedirs(workdir, exist_ok=True)
+
+    try:
+        created.append(name)
+        db_size = measure(results, 'generate_database', lambda: create_database(
+            name, args.tables, args.rows, args.row_size), required=True)
+        filestore, fs_size, fs_files = measure(results, 'generate_filestore', lambda: create_filestore(
+            name, args.files, args.file_size, args.file_sigma, args.compressible), required=True)
+        total = db_size + fs_size
+
+        # worker.tools steps
+        for format in tools.DUMP_FORMATS:
+            measure(results, 'dump_{}'.format(format), lambda: tools.create_db_dump(
+                name, workdir, format=format, jobs=args.jobs), size=db_size)
+
+        backups = {}
+        for archive_format in args.archive_formats:
+            zipfile = os.path.join(workdir, "{}.backup".format(name))
+            value = measure(results, 'backup_{}'.format(archive_format), lambda: tools.create_backup(
+                name, zipfile, tools.get_odoo_manifest(name, dump_format=args.dump_format), filestore=filestore,
+                format=args.dump_format, archive_format=archive_format), size=total, files=fs_files)
+            if value:
+                backups[archive_format] = value[1]['path']
+
+        for archive_format, path in backups.items():
+            target = "{}_restore_{}".format(name, archive_format.replace('.', '_'))
+            created.append(target)
+            tools.create_database(target)
+            measure(results, 'restore_stream_{}'.format(archive_format), lambda: tools.restore_db_stream(
+                target, path), size=db_size)
+            measure(results, 'unzip_filestore_{}'.format(archive_format), lambda: tools.unzip_filestore(
+                path, target, wk.FILESTORE_PATH), size=fs_size, files=fs_files)
+
+        for mode in tools.FILESTORE_COPY_MODES:
+            dest = os.path.join(wk.FILESTORE_PATH, "{}_copy_{}".format(name, mode))
+            measure(results, 'copy_filestore_{}'.format(mode), lambda: tools.copy_filestore(
+                filestore, dest, mode=mode), size=fs_size, files=fs_files)
+            shutil.rmtree(dest, ignore_errors=True)
+
+        # Full chains, run eagerly in this process
+        options = {'dump_format': args.dump_format, 'archive_format': wk.archive.ARCHIVE_FORMAT_ZIP, 'jobs': args.jobs}
+        data = measure(results, 'chain_dump', lambda: chain(
+            wk.create_env.s(dict(options, db_name=name)), wk.backup.s()).apply().get(), size=total, files=fs_files)
+
+        if data:
+            filename = os.path.basename(data['download'])
+            os.makedirs(tools.INPUT_DIR, exist_ok=True)
+            shutil.copy(data['download'], os.path.join(tools.INPUT_DIR, filename))
+            target = "{}_chain_restore".format(name)
+            created.append(target)
+            measure(results, 'chain_restore', lambda: chain(
+                wk.init_restore.s({'db_name': target, 'filename': filename, 'stream': True, 'jobs': args.jobs}),
+                wk.check_restore.s(), wk.restore.s()).apply().get(), size=total, files=fs_files)
+            os.remove(os.path.join(tools.INPUT_DIR, filename))
+            shutil.rmtree(data['workdir'], ignore_errors=True)
+
+        target = "{}_chain_duplicate".format(name)
+        created.append(target)
+        data = measure(results, 'chain_duplicate', lambda: chain(
+            wk.create_env.s({'db_name': name, 'new_db': target}),
+            wk.clone_database.s(),
+            wk.copy_filestore.s(),
+            wk.clean_workdir.s(),
+        ).apply().get(), size=total, files=fs_files)
+        if data:
+            shutil.rmtree(data['workdir'], ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if not args.keep:
+            for db_name in reversed(created):
+                drop_tenant(db_name)
+        db.close_pools()
+
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'host': socket.gethostname(),
+        'cpus': os.cpu_count(),
+        'revision': _get_revision(),
+        'params': vars(args),
+        'database_size': db_size,
+        'filestore_size': fs_size,
+        'steps': results,
+    }
+
+
+def _get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db-name', default="bench_{}".format(int(time.time())))
+    parser.add_argument('--tables', type=int, default=4, help="bulk tables")
+    parser.add_argument('--rows', type=int, default=100000, help="rows per bulk table")
+    parser.add_argument('--row-size', type=int, default=256, help="payload bytes per row")
+    parser.add_argument('--files', type=int, default=10000, help="filestore blobs")
+    parser.add_argument('--file-size', type=int, default=32 * 1024, help="median blob size")
+    parser.add_argument('--file-sigma', type=float, default=1.0, help="log-normal spread of blob sizes")
+    parser.add_argument('--compressible', type=float, default=0.3, help="share of compressible blobs")
+    parser.add_argument('--dump-format', default=tools.DUMP_FORMAT_CUSTOM, choices=list(tools.DUMP_FORMATS))
+    parser.add_argument('--archive-formats', nargs='+', default=list(wk.archive.ARCHIVE_FORMATS),
+                        choices=list(wk.archive.ARCHIVE_FORMATS))
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="keep the generated databases and filestores")
+    parser.add_argument('-o', '--output', help="JSON report path, stdout by default")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    report = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
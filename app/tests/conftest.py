@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import sys
+import types
+from unittest import mock
+
+import fakeredis
+import pytest
+
+# The worker tools import pg_dump, pg_restore and psql from sh, which fails
+# where the PostgreSQL client is not installed. Tests never run them: they
+# are mocks, patched by the tests checking their calls.
+_sh = types.ModuleType('sh')
+for _command in ('pg_dump', 'pg_restore', 'psql'):
+    setattr(_sh, _command, mock.MagicMock(name=_command))
+sys.modules['sh'] = _sh
+
+from worker import broker, db  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    """
+    Redis of the broker module, in memory.
+    """
+    client = fakeredis.FakeRedis()
+    with mock.patch.object(broker, '_client', client):
+        yield client
+
+
+@pytest.fixture
+def cursor():
+    """
+    Cursor of every pooled connection, queries are recorded.
+    """
+    conn = mock.MagicMock()
+    conn.__enter__.return_value = conn
+    with mock.patch.object(db, 'connection', return_value=conn), mock.patch.object(db, 'release'):
+        yield conn.cursor.return_value
+
+
+@pytest.fixture
+def executed(cursor):
+    """
+    Queries run on the cursor so far.
+    """
+    return lambda: [call[0][0] for call in cursor.execute.call_args_list]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import os
+import threading
+from unittest import mock
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+import pytest
+
+from worker import archive
+
+
+def _make_files(folder):
+    files = {
+        'text.txt': b'odoo ' * 20000,
+        'empty.txt': b'',
+        'image.png': b'\x89PNG' + os.urandom(4096),
+        'ab/0123456789abcdef': os.urandom(1024),
+        'large.sql': b'COPY ir_attachment;\n' * 10000,
+    }
+    for name, content in files.items():
+        filepath = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(content)
+    return files
+
+
+def _items(folder, files, prefix=''):
+    return [(os.path.join(folder, name), prefix + name) for name in sorted(files)]
+
+
+def _check_zip(path, files, prefix=''):
+    with ZipFile(path, 'r') as myzip:
+        assert myzip.testzip() is None
+        for name, content in files.items():
+            assert myzip.read(prefix + name) == content
+
+
+@pytest.fixture(params=[True, False], ids=['internals', 'public'])
+def internals(request):
+    with mock.patch.object(archive, 'ZIP_INTERNALS', request.param and archive.ZIP_INTERNALS):
+        yield request.param
+
+
+def test_write_files_round_trip(tmp_path, internals):
+    files = _make_files(str(tmp_path / 'src'))
+    path = str(tmp_path / 'backup.zip')
+
+    # large.sql is written serially, the others compressed by the workers
+    with mock.patch.object(archive, 'ZIP_PARALLEL_MAX_SIZE', 100000):
+        with ZipFile(path, 'w', compression=ZIP_DEFLATED, allowZip64=True) as myzip:
+            myzip.writestr('manifest.json', '{}')
+            count = archive.write_files(myzip, _items(str(tmp_path / 'src'), files), workers=2)
+
+    assert count == len(files)
+    _check_zip(path, dict(files, **{'manifest.json': b'{}'}))
+    with ZipFile(path, 'r') as myzip:
+        assert myzip.namelist()[0] == 'manifest.json'
+        assert myzip.getinfo('image.png').compress_type == ZIP_STORED
+        assert myzip.getinfo('text.txt').compress_type == ZIP_DEFLATED
+
+
+def test_write_files_window(tmp_path):
+    files = {'{:02d}.txt'.format(i): b'odoo ' * 2000 for i in range(12)}
+    folder = tmp_path / 'src'
+    folder.mkdir()
+    for name, content in files.items():
+        (folder / name).write_bytes(content)
+
+    held, peak = [0], [0]
+    compress, write_compressed = archive._compress, archive._write_compressed
+
+    lock = threading.Lock()
+
+    def compress_held(filepath, arcname, level):
+        with lock:
+            held[0] += os.path.getsize(filepath)
+            peak[0] = max(peak[0], held[0])
+        return compress(filepath, arcname, level)
+
+    def write_held(myzip, zinfo, data):
+        with lock:
+            held[0] -= zinfo.file_size
+        write_compressed(myzip, zinfo, data)
+
+    path = str(tmp_path / 'backup.zip')
+    # Room for 3 members while 8 workers could take 16
+    with mock.patch.object(archive, 'ZIP_PARALLEL_WINDOW', 30000), \
+            mock.patch.object(archive, '_compress', compress_held), \
+            mock.patch.object(archive, '_write_compressed', write_held), \
+            ZipFile(path, 'w', compression=ZIP_DEFLATED) as myzip:
+        archive.write_files(myzip, _items(str(folder), files), workers=8)
+
+    _check_zip(path, files)
+    assert 0 < peak[0] <= 30000
+
+
+def test_parse_rules_invalid():
+    rules = archive._parse_rules(".log:store, .pdf, .txt:gzip,.xml:deflate")
+
+    assert rules == {'.log': ZIP_STORED, '.xml': ZIP_DEFLATED}
+
+
+def test_write_files_append(tmp_path, internals):
+    files = _make_files(str(tmp_path / 'src'))
+    path = str(tmp_path / 'backup.zip')
+
+    with ZipFile(path, 'w', compression=ZIP_DEFLATED) as myzip:
+        archive.write_files(myzip, _items(str(tmp_path / 'src'), files, 'first/'))
+    with ZipFile(path, 'a', compression=ZIP_DEFLATED) as myzip:
+        archive.write_files(myzip, _items(str(tmp_path / 'src'), files, 'second/'))
+
+    _check_zip(path, files, 'first/')
+    _check_zip(path, files, 'second/')
+
+
+def test_extract_parallel_round_trip(tmp_path, internals):
+    files = _make_files(str(tmp_path / 'src'))
+    path = str(tmp_path / 'backup.zip')
+    with ZipFile(path, 'w', compression=ZIP_DEFLATED) as myzip:
+        archive.write_files(myzip, _items(str(tmp_path / 'src'), files, 'filestore/'))
+
+    target = str(tmp_path / 'target')
+    found = archive.extract_parallel(path, {'filestore/': target}, workers=3, batch_size=2)
+
+    assert found == set('filestore/' + name for name in files)
+    for name, content in files.items():
+        with open(os.path.join(target, name), 'rb') as f:
+            assert f.read() == content
+
+
+def test_tar_zst_round_trip(tmp_path):
+    files = _make_files(str(tmp_path / 'src'))
+    path = str(tmp_path / 'backup.tar.zst')
+    with archive.TarZstWriter(path) as tar:
+        tar.writestr('manifest.json', '{}')
+        archive.write_files(tar, _items(str(tmp_path / 'src'), files, 'filestore/'))
+
+    assert archive.guess_format(path) == archive.ARCHIVE_FORMAT_TAR_ZST
+    assert archive.read_member(path, 'manifest.json') == b'{}'
+    for name, content in files.items():
+        assert b''.join(archive.iter_member(path, 'filestore/' + name)) == content
+
+
+def test_infolist(tmp_path):
+    files = _make_files(str(tmp_path / 'src'))
+    for path in (str(tmp_path / 'backup.zip'), str(tmp_path / 'backup.tar.zst')):
+        writer = archive.TarZstWriter(path) if path.endswith('.tar.zst') else ZipFile(path, 'w', compression=ZIP_DEFLATED)
+        with writer as myzip:
+            archive.write_files(myzip, _items(str(tmp_path / 'src'), files))
+
+        members = {member['name']: member for member in archive.infolist(path)}
+        assert {name: member['size'] for name, member in members.items()} == {
+            name: len(content) for name, content in files.items()}
+        # Tar has no checksums, they are not computed when indexing
+        assert (members['text.txt']['crc'] is None) == path.endswith('.tar.zst')
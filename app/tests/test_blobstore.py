@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import hashlib
+import os
+
+import pytest
+
+from worker import blobstore
+
+LOGO = b'logo'
+LOGO_KEY = hashlib.sha1(LOGO).hexdigest()
+
+
+@pytest.fixture
+def filestore(tmp_path):
+    path = tmp_path / 'filestore'
+    for relpath, content in ((LOGO_KEY[:2] + '/' + LOGO_KEY, LOGO), ('checklist/data', b'x'), ('copy/logo', LOGO)):
+        (path / os.path.dirname(relpath)).mkdir(parents=True, exist_ok=True)
+        (path / relpath).write_bytes(content)
+    return str(path)
+
+
+def test_store_folder(tmp_path, filestore):
+    store = str(tmp_path / 'store')
+
+    # One worker: files with the same content may otherwise both be stored
+    success, results = blobstore.store_folder(filestore, store=store, mode='copy', workers=1)
+
+    assert results['index']['copy/logo'] == LOGO_KEY
+    assert results['index']['checklist/data'] == hashlib.sha1(b'x').hexdigest()
+    assert (results['files'], results['new']) == (3, 2)
+    # Stored again, no blob is added
+    success, results = blobstore.store_folder(filestore, store=store, mode='copy')
+    assert results['new'] == 0
+
+
+def test_restore_folder(tmp_path, filestore):
+    store = str(tmp_path / 'store')
+    success, results = blobstore.store_folder(filestore, store=store, mode='copy')
+    target = str(tmp_path / 'restored')
+
+    success, restored = blobstore.restore_folder(results['index'], target, store=store, mode='hardlink')
+
+    assert restored['files'] == 3
+    for relpath in results['index']:
+        with open(os.path.join(filestore, relpath), 'rb') as a, open(os.path.join(target, relpath), 'rb') as b:
+            assert a.read() == b.read()
+    with pytest.raises(FileExistsError):
+        blobstore.restore_folder(results['index'], target, store=store)
+
+
+def test_restore_folder_missing_blob(tmp_path):
+    target = str(tmp_path / 'restored')
+
+    with pytest.raises(FileNotFoundError):
+        blobstore.restore_folder({'ab/ab12': 'ab' * 20}, target, store=str(tmp_path / 'store'))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_gc(tmp_path, filestore):
+    store = str(tmp_path / 'store')
+    backup = tmp_path / 'backup.zip'
+    backup.write_bytes(b'')
+    blobstore.backup_folder(filestore, str(backup), store=store, mode='copy')
+
+    success, results = blobstore.gc(store=store, grace=0)
+    assert (results['referenced'], results['removed']) == (2, 0)
+
+    # The archive is gone, its refs are pruned and its blobs collected
+    backup.unlink()
+    success, results = blobstore.gc(store=store, grace=0, prune=True)
+    assert (results['pruned'], results['removed']) == (1, 2)
+    assert not os.path.exists(blobstore._get_object_path(LOGO_KEY, store))
+
+
+@pytest.mark.parametrize('index', [
+    {'../../escaped.txt': LOGO_KEY},
+    {'/etc/escaped.txt': LOGO_KEY},
+    {'ab/ab12': '../../../etc/passwd'},
+    {'ab/ab12': '/etc/passwd'},
+    {'ab/ab12': 42},
+])
+def test_restore_malicious_index(tmp_path, filestore, index):
+    store = str(tmp_path / 'store')
+    blobstore.store_folder(filestore, store=store, mode='copy')
+    target = tmp_path / 'restore' / 'filestore'
+    target.parent.mkdir()
+
+    with pytest.raises(ValueError):
+        blobstore.restore_folder(index, str(target), store=store)
+    with pytest.raises(ValueError):
+        blobstore.restore_files(index, str(target), store=store)
+
+    assert list(target.parent.iterdir()) == []
+    assert not os.path.exists(str(tmp_path / 'escaped.txt'))
+
+
+def test_restore_files_checked_first(tmp_path, filestore):
+    store = str(tmp_path / 'store')
+    blobstore.store_folder(filestore, store=store, mode='copy')
+    target = tmp_path / 'filestore2'
+
+    # Sorted before the escaping path, still not restored
+    with pytest.raises(ValueError):
+        blobstore.restore_files({'a/logo': LOGO_KEY, 'b/../../escaped.txt': LOGO_KEY}, str(target), store=store)
+    assert not target.exists()
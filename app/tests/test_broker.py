@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from worker import broker
+
+
+def test_acquire_up_to_limit(client):
+    first = broker.acquire_slots([('postgres:db', 2)])
+    second = broker.acquire_slots([('postgres:db', 2)])
+
+    assert first and second and first[0] != second[0]
+    assert broker.acquire_slots([('postgres:db', 2)]) is None
+
+    broker.release_slots(first)
+    assert broker.acquire_slots([('postgres:db', 2)])
+
+
+def test_acquire_all_or_nothing(client):
+    assert broker.acquire_slots([('disk:1', 1)])
+
+    # The postgres slot is not taken when the disk is full
+    assert broker.acquire_slots([('postgres:db', 1), ('disk:1', 1)]) is None
+    assert client.zcard(broker.SLOTS_PREFIX + 'postgres:db') == 0
+    assert broker.acquire_slots([('postgres:db', 1)])
+
+
+def test_expired_slots_are_freed(client):
+    assert broker.acquire_slots([('postgres:db', 1)], ttl=-1)
+    # Slots of crashed workers are taken back once expired
+    assert broker.acquire_slots([('postgres:db', 1)])
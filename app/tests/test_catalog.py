@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import json
+import os
+from unittest import mock
+from zipfile import ZipFile
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from api.v1.endpoints import backups
+from worker import catalog
+
+
+def _write_backup(path, db_name='tenant', version='15.0', modules=('base', 'sale')):
+    manifest = {'db_name': db_name, 'version': version, 'modules': {name: version for name in modules}}
+    with ZipFile(str(path), 'w') as zf:
+        zf.writestr('manifest.json', json.dumps(manifest))
+        zf.writestr('dump.sql', 'SELECT 1;')
+        zf.writestr('filestore/ab/ab12', b'logo' * 100)
+        zf.writestr('filestore/cd/cd34', b'report')
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def catalog_path(tmp_path):
+    with mock.patch.object(catalog, 'CATALOG_PATH', str(tmp_path / 'catalog' / 'catalog.sqlite')):
+        yield
+
+
+def test_index_backup(tmp_path):
+    path = _write_backup(tmp_path / 'tenant.zip')
+
+    backup = catalog.index_backup(path)
+
+    assert backup['db_name'] == 'tenant' and backup['members'] == 4
+    assert (backup['filestore_files'], backup['filestore_size']) == (2, 406)
+    assert backup['dump_size'] == len('SELECT 1;')
+    assert catalog.get_backup(path)['id'] == backup['id']
+    members = catalog.list_members(backup['id'], prefix='filestore/')
+    assert [member['name'] for member in members] == ['filestore/ab/ab12', 'filestore/cd/cd34']
+
+
+def test_get_backup_outdated(tmp_path):
+    path = _write_backup(tmp_path / 'tenant.zip')
+    catalog.index_backup(path)
+
+    # Replaced by another backup of the same name
+    _write_backup(tmp_path / 'tenant.zip', db_name='other')
+    os.utime(path, (1, 1))
+    assert catalog.get_backup(path)['db_name'] == 'other'
+
+    os.remove(path)
+    assert catalog.get_backup(path) is None
+    assert catalog.search()['count'] == 0
+
+
+def test_search(tmp_path):
+    catalog.index_backup(_write_backup(tmp_path / 'a.zip', db_name='alpha', version='14.0'))
+    catalog.index_backup(_write_backup(tmp_path / 'b.zip', db_name='beta', modules=('base', 'stock')))
+
+    def names(**kwargs):
+        return sorted(backup['db_name'] for backup in catalog.search(**kwargs)['backups'])
+
+    assert names() == ['alpha', 'beta']
+    assert names(query='alp') == ['alpha']
+    assert names(version='15.0') == ['beta']
+    assert names(module='stock') == ['beta']
+    assert names(module='sale', db_name='beta') == []
+
+
+@pytest.mark.parametrize('module', ['sale"', 'sale]', "sale'", 'sale.x', 'sale" OR 1'])
+def test_search_invalid_module(module):
+    with pytest.raises(ValueError):
+        catalog.search(module=module)
+
+
+def test_sync(tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    path = _write_backup(inputs / 'a.zip')
+
+    success, results = catalog.sync([str(inputs)])
+    assert results == {'indexed': 1, 'removed': 0, 'backups': 1}
+
+    os.remove(path)
+    success, results = catalog.sync([str(inputs)])
+    assert results == {'indexed': 0, 'removed': 1, 'backups': 0}
+
+
+def test_precheck(tmp_path):
+    path = _write_backup(tmp_path / 'tenant.zip')
+
+    result = catalog.precheck(path)
+    assert result == {'errors': ["Backup 'tenant.zip' not indexed yet"], 'indexed': False}
+
+    result = catalog.precheck(path, filestore=str(tmp_path / 'filestore' / 'tenant'), version='15.0', index=True)
+    assert result['errors'] == [] and result['required']['filestore'] == 406
+
+    result = catalog.precheck(path, filestore=str(tmp_path), version='16.0')
+    assert result['errors'] == [
+        "Backup of Odoo 15.0 can't be restored on Odoo 16.0",
+        "Filestore '{}' already exists".format(tmp_path),
+    ]
+
+    result = catalog.precheck(str(tmp_path / 'missing.zip'))
+    assert result['errors'] == ["Backup 'missing.zip' not found"]
+
+
+def test_search_endpoint_invalid_module():
+    app = FastAPI()
+    app.include_router(backups.router, prefix='/backups')
+
+    response = TestClient(app).get('/backups', params={'module': 'sale"]'})
+
+    assert response.status_code == 400
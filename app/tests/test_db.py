@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from unittest import mock
+
+import pytest
+
+from worker import db
+
+
+@pytest.fixture
+def pools():
+    with mock.patch.object(db, 'ConnectionPool', side_effect=lambda **kw: mock.MagicMock(name=kw['name'])) as pool_class:
+        db.close_pools()
+        yield pool_class
+        db.close_pools()
+
+
+def test_get_pool(pools):
+    maintenance = db.get_pool()
+    tenant = db.get_pool('tenant')
+
+    assert db.get_pool('tenant') is tenant and db.get_pool() is maintenance
+    assert pools.call_count == 2
+    assert pools.call_args_list[0][1]['kwargs']['autocommit'] is True
+    assert 'autocommit' not in pools.call_args_list[1][1]['kwargs']
+    assert pools.call_args_list[1][1]['min_size'] == 0
+    tenant.open.assert_called_once_with()
+
+
+def test_get_pool_eviction(pools):
+    maintenance = db.get_pool()
+    tenants = [db.get_pool('tenant{}'.format(i)) for i in range(db.POOL_MAX_TENANTS)]
+    # tenant0 is used again, tenant1 is now the least recently used
+    db.get_pool('tenant0')
+
+    db.get_pool('new')
+
+    tenants[1].close.assert_called_once_with()
+    assert not tenants[0].close.called and not maintenance.close.called
+    assert db.get_pool('tenant1') is not tenants[1]
+
+
+def test_close_pool(pools):
+    tenant = db.get_pool('tenant')
+
+    assert db.close_pool('tenant') is True
+    tenant.close.assert_called_once_with()
+    assert db.close_pool('tenant') is False
+
+
+def test_reset_after_fork(pools):
+    tenant = db.get_pool('tenant')
+
+    with mock.patch.object(db.os, 'getpid', return_value=-1):
+        # The parent connections are left alone
+        assert db.get_pool('tenant') is not tenant
+    assert not tenant.close.called
+
+
+def test_release(pools):
+    tenant = db.get_pool('tenant')
+    maintenance = db.get_pool()
+    cursor = maintenance.connection.return_value.__enter__.return_value.cursor.return_value
+
+    db.release('tenant')
+
+    tenant.close.assert_called_once_with()
+    cursor.execute.assert_called_once_with(db.SQL_TERMINATE_IDLE, ('tenant', db.POOL_APPLICATION_NAME))
+
+
+def test_maintenance_pool_not_on_template(pools):
+    db.init_pools()
+
+    # Pooled connections to template1 make every CREATE DATABASE fail
+    assert pools.call_args[1]['kwargs']['dbname'] != 'template1'
+    assert pools.call_args[1]['kwargs']['dbname'] == 'postgres'
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import pytest
+
+from worker import env
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1', True),
+    ('true', True),
+    ('yes', True),
+    ('0', False),
+    ('FALSE', False),
+    ('no', False),
+    (' off ', False),
+    ('', False),
+])
+def test_get_bool_env(monkeypatch, value, expected):
+    monkeypatch.setenv('SAAS_TEST_FLAG', value)
+
+    assert env.get_bool_env('SAAS_TEST_FLAG', not expected) is expected
+
+
+def test_get_bool_env_default(monkeypatch):
+    monkeypatch.delenv('SAAS_TEST_FLAG', raising=False)
+
+    assert env.get_bool_env('SAAS_TEST_FLAG', True) is True
+
+
+@pytest.mark.parametrize('value, expected', [(True, True), (False, False), (0, False), (1, True), ('false', False), ('on', True)])
+def test_parse_bool(value, expected):
+    # Payload values, from JSON
+    assert env.parse_bool(value) is expected
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import json
+import os
+from unittest import mock
+from zipfile import ZipFile
+
+import psycopg
+import pytest
+
+from worker import main
+
+DATA = {'db_name': 'tenant', 'filestore': '/filestore/tenant', 'zipfile': '/inputs/backup.zip'}
+
+
+@pytest.fixture
+def steps():
+    with mock.patch.multiple(
+        main,
+        create_database=mock.DEFAULT,
+        unzip_dump=mock.DEFAULT,
+        restore_dump=mock.DEFAULT,
+        unzip_filestore=mock.DEFAULT,
+    ) as steps, mock.patch.multiple(main.tools, drop_database=mock.DEFAULT, clean_workdir=mock.DEFAULT) as cleanup:
+        steps['restore_dump'].return_value = {'dump': {'path': 'dump.sql'}}
+        steps['unzip_filestore'].return_value = {'zip': {'filestore': 'ok'}}
+        steps.update(cleanup)
+        yield steps
+
+
+def test_restore(steps):
+    data = main.restore(dict(DATA))
+
+    assert data['dump'] == {'path': 'dump.sql'} and data['zip'] == {'filestore': 'ok'}
+    assert not steps['drop_database'].called and not steps['clean_workdir'].called
+
+
+def test_restore_filestore_fails(steps):
+    steps['unzip_filestore'].side_effect = OSError("No space left on device")
+
+    with pytest.raises(OSError):
+        main.restore(dict(DATA))
+
+    # The database branch completed, it is dropped; the filestore was never created
+    steps['drop_database'].assert_called_once_with('tenant')
+    assert not steps['clean_workdir'].called
+
+
+def test_restore_database_fails(steps):
+    steps['create_database'].side_effect = RuntimeError("database exists")
+
+    with pytest.raises(RuntimeError):
+        main.restore(dict(DATA))
+
+    assert not steps['drop_database'].called
+    steps['clean_workdir'].assert_called_once_with('/filestore/tenant')
+
+
+@pytest.fixture
+def backup(tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    with ZipFile(str(inputs / 'backup.zip'), 'w') as zf:
+        zf.writestr('manifest.json', json.dumps({'db_name': 'tenant', 'version': '15.0'}))
+        zf.writestr('dump.sql', 'SELECT 1;')
+    with mock.patch.object(main.tools, 'INPUT_DIR', str(inputs)), \
+            mock.patch.object(main, 'FILESTORE_PATH', str(tmp_path / 'filestore')), \
+            mock.patch.object(main.catalog, 'CATALOG_PATH', str(tmp_path / 'catalog.sqlite')):
+        yield str(inputs / 'backup.zip')
+
+
+def test_init_restore_reads_catalog_only(backup):
+    with mock.patch.object(main.catalog, 'index_backup', wraps=main.catalog.index_backup) as index_backup:
+        data = main.init_restore({'db_name': 'tenant', 'filename': 'backup.zip', 'version': '15.0'})
+        assert not index_backup.called and data['checked'] is False
+
+        # Indexed by the disk worker
+        data = main.check_restore(data)
+        index_backup.assert_called_once_with(backup)
+        assert data['checked'] is True
+
+        data = main.init_restore({'db_name': 'tenant', 'filename': 'backup.zip'})
+        assert data['checked'] is True and main.check_restore(data) is data
+        assert index_backup.call_count == 1
+
+
+def test_init_restore_input_folder(backup, tmp_path):
+    with open(str(tmp_path / 'outside.zip'), 'wb') as f, open(backup, 'rb') as src:
+        f.write(src.read())
+
+    with pytest.raises(FileNotFoundError):
+        main.init_restore({'db_name': 'tenant', 'filename': '../outside.zip'})
+    data = main.init_restore({'db_name': 'tenant', 'filename': '../inputs/backup.zip'})
+    assert data['zipfile'] == backup
+
+
+def test_check_restore_fails(backup):
+    data = main.init_restore({'db_name': 'tenant', 'filename': 'backup.zip', 'version': '16.0'})
+
+    with pytest.raises(ValueError):
+        main.check_restore(data)
+    # Known to the catalog now, rejected without reading the archive
+    with pytest.raises(ValueError):
+        main.init_restore({'db_name': 'tenant', 'filename': 'backup.zip', 'version': '16.0'})
+
+
+def test_backup_without_filestore(tmp_path):
+    data = {'db_name': 'tenant', 'zipfile': str(tmp_path / 'backup'), 'with_filestore': False, 'dedup': True}
+
+    # The tenant has no filestore folder
+    with mock.patch.object(main, 'FILESTORE_PATH', str(tmp_path / 'filestore')), \
+            mock.patch.object(main.tools, 'get_odoo_manifest', return_value={}), \
+            mock.patch.object(main.tools, 'create_backup', return_value=(True, {'path': 'backup.zip'})) as create_backup, \
+            mock.patch.object(main.catalog, 'add_backup'):
+        main._backup(None, data)
+
+    assert create_backup.call_args[1]['filestore'] is None and create_backup.call_args[1]['members'] == {}
+
+
+def test_unzip_dump_shared_volume(backup, tmp_path):
+    output = tmp_path / 'output'
+    output.mkdir()
+
+    with mock.patch.object(main.tools, 'OUTPUT_DIR', str(output)):
+        data = main.unzip_dump({'db_name': 'tenant', 'zipfile': backup})
+
+    # Read by restore_dump on a db worker, which only shares the volumes
+    tmp_dir = data['dump']['tmp_dir']
+    assert os.path.dirname(tmp_dir) == str(output)
+    assert data['dump']['path'] == os.path.join(tmp_dir, 'dump.sql')
+    assert open(data['dump']['path']).read() == 'SELECT 1;'
+
+    with mock.patch.object(main.tools, 'restore_db_dump', return_value=(True, {'deferred': None})):
+        main.restore_dump(data)
+    assert not os.path.exists(tmp_dir)
+
+
+@pytest.mark.parametrize('error', [
+    ValueError("Invalid database name"),
+    FileExistsError("/filestore/tenant"),
+    PermissionError("/filestore/warm_default_1"),
+    psycopg.errors.ObjectInUse(),
+])
+def test_claim_database_push_back(error):
+    data = {'db_name': 'warm_default_1', 'new_db': 'tenant', 'template': 'default'}
+
+    with mock.patch.object(main.warm, 'claim_database', side_effect=error), \
+            mock.patch.object(main.warm, 'push_back') as push_back, \
+            mock.patch.object(main, 'refill_warm_pool') as refill, \
+            pytest.raises(type(error)):
+        main.claim_database(dict(data))
+
+    # Still in Postgres under its name, back in the ready list
+    push_back.assert_called_once_with('default', 'warm_default_1')
+    refill.delay.assert_called_once_with(['default'])
+
+
+def test_claim_database_lost():
+    data = {'db_name': 'warm_default_1', 'new_db': 'tenant', 'template': 'default'}
+
+    # The rename back failed, the database is not given again
+    with mock.patch.object(main.warm, 'claim_database', side_effect=RuntimeError()), \
+            mock.patch.object(main.warm, 'push_back') as push_back, \
+            mock.patch.object(main, 'refill_warm_pool'), \
+            pytest.raises(RuntimeError):
+        main.claim_database(dict(data))
+
+    assert not push_back.called
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import errno
+import gzip
+import json
+import os
+from unittest import mock
+from zipfile import ZipFile
+
+import psycopg
+import pytest
+
+from worker import tools
+
+TOC = """;
+; Archive created at 2022-05-02 10:00:00 UTC
+;
+215; 1259 16385 TABLE public res_partner odoo
+3456; 0 16385 TABLE DATA public res_partner odoo
+3501; 2606 16800 CONSTRAINT public res_partner res_partner_pkey odoo
+3502; 1259 16801 INDEX public res_partner_name_idx odoo
+3503; 0 0 INDEX ATTACH public measurement_y2022_idx odoo
+3504; 2606 16802 FK CONSTRAINT public res_partner res_partner_company_id_fkey odoo
+"""
+
+
+def _read_ids(path):
+    with open(path) as f:
+        return [line.split(';')[0] for line in f.read().splitlines()]
+
+
+def test_split_toc(tmp_path):
+    dump = str(tmp_path / 'dump.dump')
+    with mock.patch.object(tools, 'pg_restore', return_value=TOC) as pg_restore:
+        immediate, deferred = tools._split_toc(dump)
+
+    assert pg_restore.call_args[0] == ('--list', dump)
+    assert _read_ids(immediate) == ['', '', '', '215', '3456', '3501']
+    assert _read_ids(deferred) == ['3502', '3503', '3504']
+
+
+def test_restore_dump_deferred(tmp_path):
+    dump = tmp_path / 'dump.dump'
+    dump.write_bytes(b'PGDMP' + b'\0' * 64)
+
+    with mock.patch.object(tools, 'pg_restore', return_value=TOC) as pg_restore:
+        success, results = tools.restore_db_dump('tenant', str(dump), jobs=4, defer_post_data=True)
+
+    args = pg_restore.call_args[0]
+    assert args[-1] == str(dump)
+    assert '--jobs=4' in args and '--dbname=tenant' in args
+    assert '--use-list={}.toc'.format(dump) in args
+    assert results['jobs'] == 4 and results['deferred'] == '{}.deferred.toc'.format(dump)
+    assert _read_ids(results['deferred']) == ['3502', '3503', '3504']
+
+
+def test_create_dump_gzip(tmp_path):
+    def dump(*args, _out, **kwargs):
+        for _ in range(1000):
+            _out.write(b'SELECT 1;\n')
+
+    with mock.patch.object(tools, 'pg_dump', side_effect=dump):
+        success, results = tools.create_db_dump('tenant', str(tmp_path))
+
+    with open(results['path'], 'rb') as f:
+        content = f.read()
+    assert content[:2] == b'\x1f\x8b'
+    assert gzip.decompress(content) == b'SELECT 1;\n' * 1000
+
+
+def test_restore_dump_gzip(tmp_path):
+    dump = tmp_path / 'dump.sql'
+    dump.write_bytes(gzip.compress(b'SELECT 1;\n' * 1000))
+
+    # Read by sh while the command runs
+    stdin = []
+    with mock.patch.object(tools, 'psql', side_effect=lambda *args, _in, **kwargs: stdin.extend(_in)):
+        tools.restore_db_dump('tenant', str(dump))
+
+    assert b''.join(stdin) == b'SELECT 1;\n' * 1000
+
+
+def test_clone_database_waits_for_template(cursor, executed):
+    busy = psycopg.errors.ObjectInUse()
+    cursor.execute.side_effect = [busy, busy, None]
+
+    with mock.patch.object(tools.time, 'sleep'):
+        success, results = tools.clone_database('template', 'tenant')
+
+    assert results == {'db_name': 'tenant', 'template': 'template', 'attempts': 3}
+    assert executed() == ['CREATE DATABASE "tenant" TEMPLATE "template";'] * 3
+
+
+def test_clone_database_timeout(cursor):
+    cursor.execute.side_effect = psycopg.errors.ObjectInUse()
+
+    with pytest.raises(psycopg.errors.ObjectInUse):
+        tools.clone_database('template', 'tenant', timeout=0)
+
+
+def test_clone_database_terminate(cursor, executed):
+    tools.clone_database('template', 'tenant', terminate=True)
+
+    assert executed() == [tools.SQL_TERMINATE_BACKENDS, 'CREATE DATABASE "tenant" TEMPLATE "template";']
+    assert cursor.execute.call_args_list[0][0][1] == ('template',)
+
+
+def _make_filestore(path):
+    files = {'ab/ab12': b'logo', 'cd/cd34': b'report' * 1000, 'checklist/data': b'x'}
+    for relpath, content in files.items():
+        os.makedirs(os.path.join(path, os.path.dirname(relpath)), exist_ok=True)
+        with open(os.path.join(path, relpath), 'wb') as f:
+            f.write(content)
+    return files
+
+
+def _read_tree(path):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            with open(os.path.join(dirpath, fname), 'rb') as f:
+                tree[os.path.relpath(os.path.join(dirpath, fname), path)] = f.read()
+    return tree
+
+
+@pytest.mark.parametrize('mode', tools.FILESTORE_COPY_MODES)
+def test_copy_filestore(tmp_path, mode):
+    src, dest = str(tmp_path / 'src'), str(tmp_path / 'dest')
+    files = _make_filestore(src)
+
+    success, results = tools.copy_filestore(src, dest, mode=mode, workers=2)
+
+    assert results['mode'] == mode
+    assert _read_tree(dest) == files
+    shared = os.stat(os.path.join(dest, 'ab/ab12')).st_ino == os.stat(os.path.join(src, 'ab/ab12')).st_ino
+    assert shared == (mode == 'hardlink')
+
+
+def test_copy_filestore_errors(tmp_path):
+    src = str(tmp_path / 'src')
+    _make_filestore(src)
+
+    with pytest.raises(ValueError):
+        tools.copy_filestore(src, str(tmp_path / 'dest'), mode='symlink')
+    # Never merged into an existing filestore
+    with pytest.raises(FileExistsError):
+        tools.copy_filestore(src, src)
+
+
+def test_hardlink_across_devices(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.write_bytes(b'blob')
+
+    with mock.patch.object(tools.os, 'link', side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+        tools._hardlink_file(str(src), str(dst))
+
+    assert dst.read_bytes() == b'blob'
+    assert os.stat(str(dst)).st_ino != os.stat(str(src)).st_ino
+
+
+DUMP = b"""--
+-- PostgreSQL database dump
+--
+
+COPY public.res_partner (id, name) FROM stdin;
+1\tstore_fname
+\\.
+
+COPY public.ir_attachment (id, name, "store_fname", checksum) FROM stdin;
+1\tlogo.png\tab/ab12\tab12
+2\tinline.txt\t\\N\t\\N
+3\treport.pdf\tcd/cd34\tcd34
+\\.
+
+COPY public.res_users (id, login) FROM stdin;
+3\tadmin
+\\.
+"""
+
+
+@pytest.mark.parametrize('compress', [False, True], ids=['plain', 'gzip'])
+def test_find_attachments(tmp_path, compress):
+    path = str(tmp_path / 'backup.zip')
+    with ZipFile(path, 'w') as myzip:
+        myzip.writestr(tools.DEFAULT_MANIFEST_FILENAME, json.dumps({'dump_format': tools.DUMP_FORMAT_SQL}))
+        myzip.writestr(tools.get_dump_filename({}), gzip.compress(DUMP) if compress else DUMP)
+
+    # Small chunks to split lines between them
+    iter_member = tools.archive.iter_member
+    with mock.patch.object(tools.archive, 'iter_member', lambda path, name: iter_member(path, name, chunk_size=16)):
+        assert tools.find_attachments(path, [3, 2, 42]) == {2: None, 3: 'cd/cd34'}
+        assert tools.find_attachments(path, ['1']) == {1: 'ab/ab12'}
+
+
+def test_restore_filestore_files(tmp_path):
+    path = str(tmp_path / 'backup.zip')
+    with ZipFile(path, 'w') as myzip:
+        myzip.writestr(tools.FILESTORE_PREFIX + tools.get_attachment_path('ab12'), b'logo')
+        myzip.writestr(tools.FILESTORE_PREFIX + tools.get_attachment_path('cd34'), b'report')
+    target = tmp_path / 'filestore'
+    (target / 'cd').mkdir(parents=True)
+    (target / 'cd' / 'cd34').write_bytes(b'current')
+
+    success, results = tools.restore_filestore_files([path], ['ab/ab12', 'cd/cd34', 'ef/ef56'], str(target))
+
+    assert (results['restored'], results['skipped'], results['missing']) == (['ab/ab12'], ['cd/cd34'], ['ef/ef56'])
+    assert (target / 'ab' / 'ab12').read_bytes() == b'logo' and (target / 'cd' / 'cd34').read_bytes() == b'current'
+    assert sorted(os.listdir(str(tmp_path))) == ['backup.zip', 'filestore']
+
+
+def _write_backup(path, index):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with ZipFile(path, 'w') as myzip:
+        myzip.writestr(tools.DEFAULT_FILESTORE_INDEX, json.dumps(index))
+    return path
+
+
+def test_backup_chain_uses_base_path(tmp_path):
+    base = _write_backup(str(tmp_path / 'output' / 'b' / 'backup.zip'), {'files': {}})
+    # Same filename in a workdir sorted first
+    _write_backup(str(tmp_path / 'output' / 'a' / 'backup.zip'), {'files': {}})
+
+    filestore = tmp_path / 'filestore'
+    filestore.mkdir()
+    with mock.patch.object(tools, 'get_filestore_index', return_value={}):
+        index = tools.diff_filestore(str(filestore), base)
+    latest = _write_backup(str(tmp_path / 'output' / 'c' / 'latest.zip'), index)
+
+    with mock.patch.object(tools, 'OUTPUT_DIR', str(tmp_path / 'output')):
+        assert tools.get_backup_chain(latest) == [base, latest]
+
+
+def test_backup_chain_without_base_path(tmp_path):
+    base = _write_backup(str(tmp_path / 'backup.zip'), {'files': {}})
+    latest = _write_backup(str(tmp_path / 'latest.zip'), {'mode': 'incremental', 'base': 'backup.zip', 'files': {}})
+
+    assert tools.get_backup_chain(latest) == [base, latest]
+
+
+@pytest.mark.parametrize('ids, alive', [([3], True), ([42], False)], ids=['found', 'not-found'])
+def test_find_attachments_custom(tmp_path, ids, alive):
+    path = str(tmp_path / 'backup.zip')
+    manifest = {'dump_format': tools.DUMP_FORMAT_CUSTOM}
+    with ZipFile(path, 'w') as myzip:
+        myzip.writestr(tools.DEFAULT_MANIFEST_FILENAME, json.dumps(manifest))
+        myzip.writestr(tools.get_dump_filename(manifest), b'PGDMP')
+
+    proc = mock.MagicMock()
+    proc.__iter__.return_value = iter(line + '\n' for line in DUMP.decode().splitlines())
+    proc.process.is_alive.return_value = (alive, None if alive else 0)
+    with mock.patch.object(tools, 'pg_restore', return_value=proc):
+        assert tools.find_attachments(path, ids) == ({3: 'cd/cd34'} if alive else {})
+
+    # Stopped once the record is found, left alone once done
+    assert proc.process.terminate.called == alive
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import errno
+import hashlib
+import io
+import json
+import os
+from unittest import mock
+from zipfile import ZipFile
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from api.v1.endpoints import uploads
+
+MANIFEST = {'db_name': 'tenant', 'version': '15.0'}
+
+
+def _backup():
+    buffer = io.BytesIO()
+    with ZipFile(buffer, 'w') as zf:
+        zf.writestr('manifest.json', json.dumps(MANIFEST))
+        zf.writestr('dump.sql', 'SELECT 1;')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    app = FastAPI()
+    app.include_router(uploads.router, prefix='/uploads')
+    with mock.patch.object(uploads.wk.tools, 'INPUT_DIR', str(inputs)), \
+            mock.patch.object(uploads, 'UPLOAD_DIR', str(inputs / '.uploads')), \
+            mock.patch.object(uploads.wk, 'index_backup'):
+        yield TestClient(app)
+
+
+def _checksum(*chunks):
+    return hashlib.sha256(b''.join(hashlib.sha256(chunk).digest() for chunk in chunks)).hexdigest()
+
+
+def _create(client, filename='backup.zip', size=None):
+    response = client.post('/uploads', json={'filename': filename, 'size': size})
+    assert response.status_code == 201
+    return response.json()['upload_id']
+
+
+def test_upload(client):
+    backup = _backup()
+    upload_id = _create(client, size=len(backup))
+
+    response = client.put('/uploads/{}?offset=0'.format(upload_id), data=backup[:100])
+    assert response.json() == {'upload_id': upload_id, 'offset': 100, 'sha256': hashlib.sha256(backup[:100]).hexdigest()}
+    # Resumed from the offset the server has
+    assert client.get('/uploads/{}'.format(upload_id)).json()['offset'] == 100
+    response = client.put('/uploads/{}?offset=100'.format(upload_id), data=backup[100:])
+    assert response.json()['offset'] == len(backup)
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={'sha256': _checksum(backup[:100], backup[100:])})
+
+    assert response.status_code == 200
+    assert response.json()['manifest'] == MANIFEST
+    uploads.wk.index_backup.delay.assert_called_once_with(os.path.join(uploads.wk.tools.INPUT_DIR, 'backup.zip'))
+    with open(os.path.join(uploads.wk.tools.INPUT_DIR, 'backup.zip'), 'rb') as f:
+        assert f.read() == backup
+    assert os.listdir(uploads.UPLOAD_DIR) == []
+
+
+def test_upload_offset_mismatch(client):
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+
+    response = client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+
+    assert response.status_code == 409 and response.json()['offset'] == 4
+
+
+def test_upload_incomplete(client):
+    upload_id = _create(client, size=1000)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={})
+
+    assert response.status_code == 409
+
+
+def test_upload_not_an_archive(client):
+    upload_id = _create(client)
+
+    response = client.put('/uploads/{}?offset=0'.format(upload_id), data=b'<html>')
+
+    assert response.status_code == 400
+    assert client.get('/uploads/{}'.format(upload_id)).status_code == 404
+
+
+def test_upload_existing_backup(client):
+    backup = _backup()
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=backup)
+    with open(os.path.join(uploads.wk.tools.INPUT_DIR, 'backup.zip'), 'wb') as f:
+        f.write(b'previous')
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={})
+
+    assert response.status_code == 409
+    with open(os.path.join(uploads.wk.tools.INPUT_DIR, 'backup.zip'), 'rb') as f:
+        assert f.read() == b'previous'
+    assert client.post('/uploads', json={'filename': 'backup.zip'}).status_code == 409
+
+
+@pytest.mark.parametrize('filename', ['', '.hidden.zip', 'backup.sql'])
+def test_upload_invalid_filename(client, filename):
+    assert client.post('/uploads', json={'filename': filename}).status_code == 400
+
+
+def test_complete_while_writing(client):
+    backup = _backup()
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=backup)
+
+    # A chunk is still being streamed, by another API process
+    fd = uploads._lock(uploads._get_paths(upload_id)[0])
+    try:
+        response = client.post('/uploads/{}/complete'.format(upload_id), json={})
+        assert client.put('/uploads/{}?offset={}'.format(upload_id, len(backup)), data=b'more').status_code == 409
+    finally:
+        os.close(fd)
+
+    assert response.status_code == 409
+    assert not os.path.exists(os.path.join(uploads.wk.tools.INPUT_DIR, 'backup.zip'))
+    assert client.post('/uploads/{}/complete'.format(upload_id), json={}).status_code == 200
+
+
+def test_complete_checksum_mismatch(client):
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={'sha256': '0' * 64})
+
+    assert response.status_code == 400 and response.json()['sha256'] == _checksum(b'PK\x03\x04')
+    # Chunks are accepted again once the completion is over
+    assert client.put('/uploads/{}?offset=4'.format(upload_id), data=b'more').status_code == 200
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={'sha256': '0' * 64})
+    assert response.json()['sha256'] == _checksum(b'PK\x03\x04', b'more')
+
+
+def test_complete_without_reading(client):
+    backup = _backup()
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=backup)
+
+    # Checked from the digests recorded with the chunks, never read again
+    meta = uploads._get_paths(upload_id)[1]
+    with open(meta) as f:
+        session = json.load(f)
+    session['chunks'] = [[len(backup), '0' * 64]]
+    with open(meta, 'w') as f:
+        json.dump(session, f)
+
+    response = client.post('/uploads/{}/complete'.format(upload_id), json={})
+    assert response.status_code == 200
+    assert response.json()['sha256'] == hashlib.sha256(bytes(32)).hexdigest()
+
+
+def test_upload_chunk_checksum(client):
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+
+    response = client.put('/uploads/{}?offset=4&sha256={}'.format(upload_id, '0' * 64), data=b'more')
+
+    # The chunk is dropped, to be sent again
+    assert response.status_code == 400 and response.json()['offset'] == 4
+    assert os.path.getsize(uploads._get_paths(upload_id)[0]) == 4
+    digest = hashlib.sha256(b'more').hexdigest()
+    response = client.put('/uploads/{}?offset=4&sha256={}'.format(upload_id, digest), data=b'more')
+    assert response.json()['offset'] == 8
+
+
+def test_upload_interrupted_chunk(client):
+    upload_id = _create(client)
+    client.put('/uploads/{}?offset=0'.format(upload_id), data=b'PK\x03\x04')
+    # Written by a request that died before recording it
+    with open(uploads._get_paths(upload_id)[0], 'ab') as f:
+        f.write(b'partial')
+
+    assert client.get('/uploads/{}'.format(upload_id)).json()['offset'] == 4
+    client.put('/uploads/{}?offset=4'.format(upload_id), data=b'more')
+    with open(uploads._get_paths(upload_id)[0], 'rb') as f:
+        assert f.read() == b'PK\x03\x04more'
+
+
+def test_abort_while_writing(client):
+    upload_id = _create(client)
+    fd = uploads._lock(uploads._get_paths(upload_id)[0])
+    try:
+        assert client.delete('/uploads/{}'.format(upload_id)).status_code == 409
+    finally:
+        os.close(fd)
+
+    assert client.delete('/uploads/{}'.format(upload_id)).status_code == 200
+    assert client.get('/uploads/{}'.format(upload_id)).status_code == 404
+
+
+def test_link_across_filesystems(tmp_path):
+    part, target = tmp_path / 'upload.part', tmp_path / 'inputs' / 'backup.zip'
+    part.write_bytes(b'backup')
+    target.parent.mkdir()
+    cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+
+    link = os.link
+
+    def link_across(src, dst):
+        # Only the upload folder is on another filesystem
+        if src == str(part):
+            raise cross_device
+        link(src, dst)
+
+    with mock.patch.object(uploads.os, 'link', side_effect=link_across):
+        uploads._link(str(part), str(target))
+    assert target.read_bytes() == b'backup'
+    assert os.listdir(str(target.parent)) == ['backup.zip']
+
+    # The copy error is raised, not the cleanup one
+    target.unlink()
+    with mock.patch.object(uploads.os, 'link', side_effect=cross_device), \
+            mock.patch.object(uploads.shutil, 'copyfile', side_effect=OSError(errno.ENOSPC, "No space left")), \
+            pytest.raises(OSError) as error:
+        uploads._link(str(part), str(target))
+    assert error.value.errno == errno.ENOSPC
+    assert os.listdir(str(target.parent)) == []
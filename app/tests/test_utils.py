@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import pytest
+
+from api.v1.endpoints import utils
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=900-5000', (900, 999)),
+    (' bytes=0-0 ', (0, 0)),
+    # Whole file
+    ('', None),
+    ('bytes=-', None),
+    ('items=0-10', None),
+    ('bytes=0-10,20-30', None),
+])
+def test_parse_range(header, expected):
+    assert utils._parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=1000-2000', 'bytes=50-10', 'bytes=-0'])
+def test_parse_range_not_satisfiable(header):
+    with pytest.raises(ValueError):
+        utils._parse_range(header, 1000)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from unittest import mock
+
+import psycopg
+import pytest
+
+from worker import warm
+
+
+def test_parse_templates_invalid():
+    templates = warm._parse_templates("default:template_15.zip, shop, a:b:c,:x.zip,shop:shop_15.zip")
+
+    assert templates == {'default': 'template_15.zip', 'shop': 'shop_15.zip'}
+
+
+def test_plan_refill(client):
+    names = warm.plan_refill('default', size=2)
+
+    assert len(names) == 2 and all(name.startswith('warm_default_') for name in names)
+    # Already being restored
+    assert warm.plan_refill('default', size=2) == []
+
+    warm.set_ready('default', names[0])
+    assert warm.plan_refill('default', size=3) != []
+    assert warm.pop_ready('default') == names[0]
+    assert warm.pop_ready('default') is None
+
+
+def test_plan_refill_expired(client):
+    with mock.patch.object(warm, 'WARM_PENDING_TTL', -1):
+        names = warm.plan_refill('default', size=1)
+
+    # The lost restore is planned again under a new name
+    assert warm.plan_refill('default', size=1) not in ([], names)
+
+
+def test_push_back(client):
+    warm.set_ready('default', 'warm_default_1')
+    warm.set_ready('default', 'warm_default_2')
+
+    name = warm.pop_ready('default')
+    warm.push_back('default', name)
+
+    assert warm.pop_ready('default') == 'warm_default_1'
+
+
+def test_claim_database(tmp_path, executed):
+    (tmp_path / 'warm_default_1').mkdir()
+
+    success, results = warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+
+    assert results['filestore'] == str(tmp_path / 'tenant')
+    assert (tmp_path / 'tenant').is_dir() and not (tmp_path / 'warm_default_1').exists()
+    assert warm.SQL_RENAME_DATABASE.format('warm_default_1', 'tenant') in executed()
+
+
+def test_claim_database_new_identity(tmp_path, cursor):
+    conn = warm.db.connection.return_value
+
+    warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+    warm.claim_database('warm_default_2', 'other', str(tmp_path))
+
+    calls = [call[0] for call in conn.execute.call_args_list if call[0][0] == warm.SQL_RESET_PARAMETER]
+    first, second = ({key: value for sql, (value, key) in calls[i:i + 3]} for i in (0, 3))
+    assert sorted(first) == ['database.create_date', 'database.secret', 'database.uuid']
+    # Tenants of a template never share the secret their tokens are signed with
+    assert first['database.secret'] != second['database.secret']
+    assert first['database.uuid'] != second['database.uuid']
+
+
+def test_claim_database_existing_filestore(tmp_path, cursor):
+    (tmp_path / 'tenant').mkdir()
+
+    with pytest.raises(FileExistsError):
+        warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+    assert not cursor.execute.called
+
+
+def test_claim_database_rename_fails(tmp_path, executed):
+    (tmp_path / 'warm_default_1').mkdir()
+
+    with mock.patch.object(warm.os, 'rename', side_effect=PermissionError()), pytest.raises(OSError):
+        warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+
+    # The database is given its name back
+    assert executed()[-2:] == [
+        warm.SQL_RENAME_DATABASE.format('warm_default_1', 'tenant'),
+        warm.SQL_RENAME_DATABASE.format('tenant', 'warm_default_1'),
+    ]
+
+
+def test_claim_database_busy(tmp_path, cursor):
+    (tmp_path / 'warm_default_1').mkdir()
+    # A backend connected again before the rename
+    cursor.execute.side_effect = [None, psycopg.errors.ObjectInUse()]
+
+    with pytest.raises(warm.CLAIM_ERRORS):
+        warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+    assert (tmp_path / 'warm_default_1').is_dir() and not (tmp_path / 'tenant').exists()
+
+
+def test_claim_database_lost(tmp_path, cursor):
+    (tmp_path / 'warm_default_1').mkdir()
+    cursor.execute.side_effect = [None, None, psycopg.errors.AdminShutdown()]
+
+    with mock.patch.object(warm.os, 'rename', side_effect=PermissionError()), pytest.raises(RuntimeError) as error:
+        warm.claim_database('warm_default_1', 'tenant', str(tmp_path))
+    assert not isinstance(error.value, warm.CLAIM_ERRORS)
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import io
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT, is_zipfile
+from celery.utils.log import get_task_logger
+import zstandard
+
+_logger = get_task_logger(__name__)
+
+# Backup archive formats, zip is the one Odoo restores
+ARCHIVE_FORMAT_ZIP = 'zip'
+ARCHIVE_FORMAT_TAR_ZST = 'tar.zst'
+ARCHIVE_FORMATS = {
+    ARCHIVE_FORMAT_ZIP: '.zip',
+    ARCHIVE_FORMAT_TAR_ZST: '.tar.zst',
+}
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+# -1 for one compression thread per core
+ZSTD_THREADS = int(os.environ.get("ZSTD_THREADS", -1))
+# Tar members must know their size upfront, streamed members (pg_dump
+# output) are split in parts of that size named <name>.000000, <name>.000001...
+TAR_PART_SIZE = int(os.environ.get("TAR_PART_SIZE", 64 * 1024 * 1024))
+TAR_PART_RE = re.compile(r'^([^/]+)\.(\d{6})$')
+CHUNK_SIZE = 1024 * 1024
+
+ZIP_COMPRESSION_LEVEL = int(os.environ.get("ZIP_COMPRESSION_LEVEL", 6))
+ZIP_WORKERS = int(os.environ.get("ZIP_WORKERS", os.cpu_count() or 1))
+# Members bigger than that are compressed while being written, one at a
+# time, instead of being held in memory by a worker
+ZIP_PARALLEL_MAX_SIZE = int(os.environ.get("ZIP_PARALLEL_MAX_SIZE", 64 * 1024 * 1024))
+# Total size of the members read by the workers and not written yet
+ZIP_PARALLEL_WINDOW = int(os.environ.get("ZIP_PARALLEL_WINDOW", 256 * 1024 * 1024))
+# ZipFile has no public API to append members compressed elsewhere or to
+# share its index between handles: the private attributes below are only
+# used if present, archives are written and read serially otherwise.
+ZIP_PRIVATE_ATTRS = (
+    '_lock', '_writing', '_seekable', '_allowZip64', '_didModify', '_writecheck', 'start_dir',
+    '_filePassed', '_fileRefCnt',
+)
+
+# Already compressed content is stored as is in archives, Odoo filestore
+# blobs have no extension so they are recognized by their signature.
+# Rules can be overridden with ZIP_COMPRESSION_RULES=".pdf:deflate,.log:store"
+STORED_EXTENSIONS = ['.gz', '.zip', '.zst', '.dump', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf']
+COMPRESSED_SIGNATURES = [
+    b'\x1f\x8b',          # gzip
+    b'PK\x03\x04',        # zip, docx, xlsx, odt...
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b'PGDMP',             # pg_dump custom format
+    b'%PDF',
+    b'\xff\xd8\xff',      # jpeg
+    b'\x89PNG',
+    b'GIF8',
+    b'RIFF',              # webp
+]
+COMPRESS_TYPES = {'store': ZIP_STORED, 'deflate': ZIP_DEFLATED}
+
+UNZIP_WORKERS = int(os.environ.get("UNZIP_WORKERS", os.cpu_count() or 1))
+# Members are handed to the extraction workers by batches of that size
+UNZIP_BATCH_SIZE = int(os.environ.get("UNZIP_BATCH_SIZE", 256))
+
+
+def _parse_rules(value):
+    rules = {}
+    for rule in filter(None, (rule.strip() for rule in value.split(','))):
+        try:
+            ext, compress = rule.split(':')
+            rules[ext.lower()] = COMPRESS_TYPES[compress]
+        except (ValueError, KeyError):
+            # Not worth failing every worker and the API on import
+            _logger.warning("Ignored compression rule '{}', expected .ext:store or .ext:deflate".format(rule))
+    return rules
+
+
+COMPRESSION_RULES = dict.fromkeys(STORED_EXTENSIONS, ZIP_STORED)
+COMPRESSION_RULES.update(_parse_rules(os.environ.get("ZIP_COMPRESSION_RULES", "")))
+
+
+def _has_zip_internals():
+    with ZipFile(io.BytesIO(), 'w') as myzip:
+        return all(hasattr(myzip, attr) for attr in ZIP_PRIVATE_ATTRS)
+
+
+ZIP_INTERNALS = _has_zip_internals()
+
+
+def set_compress_level(zinfo, level):
+    """
+    Compression level of a member written through ZipFile.open, public
+    since Python 3.13.
+    """
+    if hasattr(zinfo, 'compress_level'):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+
+def get_compress_type(filepath, header=None):
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext in COMPRESSION_RULES:
+        return COMPRESSION_RULES[ext]
+
+    if header is None:
+        with open(filepath, 'rb') as f:
+            header = f.read(8)
+    if any(header.startswith(signature) for signature in COMPRESSED_SIGNATURES):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def _compress(filepath, arcname, level):
+    """
+    Read and compress a member in a worker thread, zlib releases the GIL.
+    """
+    zinfo = ZipInfo.from_file(filepath, arcname)
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.compress_type = get_compress_type(filepath, data[:8])
+
+    if zinfo.compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # Unknown compressed formats
+        if len(compressed) < len(data):
+            data = compressed
+        else:
+            zinfo.compress_type = ZIP_STORED
+
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def _write_compressed(myzip, zinfo, data):
+    """
+    Append an already compressed member, ZipFile has no public API for it:
+    this follows ZipFile.open(mode='w') with sizes known upfront. Only
+    called with ZIP_INTERNALS.
+    """
+    with myzip._lock:
+        if myzip._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+
+        zinfo.flag_bits = 0x00
+        if not zinfo.external_attr:
+            zinfo.external_attr = 0o600 << 16
+        zip64 = myzip._allowZip64 and (zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT)
+
+        if myzip._seekable:
+            myzip.fp.seek(myzip.start_dir)
+        zinfo.header_offset = myzip.fp.tell()
+        myzip._writecheck(zinfo)
+        myzip._didModify = True
+
+        myzip.fp.write(zinfo.FileHeader(zip64))
+        myzip.fp.write(data)
+
+        myzip.filelist.append(zinfo)
+        myzip.NameToInfo[zinfo.filename] = zinfo
+        myzip.start_dir = myzip.fp.tell()
+
+
+def write_files(myzip, items, level=ZIP_COMPRESSION_LEVEL, workers=ZIP_WORKERS, callback=None):
+    """
+    Compress (filepath, arcname) items concurrently and write them in the
+    archive in the given order. At most 2 * workers members, and
+    ZIP_PARALLEL_WINDOW bytes of them, are held in memory at once.
+    """
+    count = 0
+    if isinstance(myzip, TarZstWriter):
+        # zstd compresses with its own threads
+        for filepath, arcname in items:
+            myzip.write(filepath, arcname)
+            count += 1
+            if callback:
+                callback(filepath, arcname)
+        return count
+
+    window = max(workers, 1) * 2
+    pending = deque()
+    held = 0
+
+    def flush(filepath, arcname, future, size):
+        if future is None:
+            myzip.write(filepath, arcname, compress_type=get_compress_type(filepath), compresslevel=level)
+        else:
+            _write_compressed(myzip, *future.result())
+        if callback:
+            callback(filepath, arcname)
+        return size
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for filepath, arcname in items:
+            size = os.path.getsize(filepath)
+            parallel = ZIP_INTERNALS and size <= ZIP_PARALLEL_MAX_SIZE
+
+            # Serial members are written once the pending ones are
+            while pending and (not parallel or len(pending) >= window or held + size > ZIP_PARALLEL_WINDOW):
+                held -= flush(*pending.popleft())
+
+            if parallel:
+                pending.append((filepath, arcname, executor.submit(_compress, filepath, arcname, level), size))
+                held += size
+            else:
+                flush(filepath, arcname, None, size)
+            count += 1
+
+        while pending:
+            flush(*pending.popleft())
+
+    return count
+
+
+def get_archive_path(path, format=ARCHIVE_FORMAT_ZIP):
+    extension = ARCHIVE_FORMATS[format]
+    if not path.endswith(extension):
+        path += extension
+    return path
+
+
+def guess_format(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == ZSTD_MAGIC:
+        return ARCHIVE_FORMAT_TAR_ZST
+    if is_zipfile(path):
+        return ARCHIVE_FORMAT_ZIP
+    raise ValueError("Unknown archive format: {}".format(path))
+
+
+class _TarPartWriter:
+    """
+    File-like object writing what it receives as tar members of at most
+    TAR_PART_SIZE, a single member keeps the plain name.
+    """
+
+    def __init__(self, writer, name, part_size=TAR_PART_SIZE):
+        self.writer = writer
+        self.name = name
+        self.part_size = part_size
+        self.parts = 0
+        self.size = 0
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.size += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._write_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _write_part(self):
+        name = "{}.{:06d}".format(self.name, self.parts)
+        self.writer.addfile(name, self.buffer)
+        self.parts += 1
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        if self.parts:
+            self._write_part()
+        else:
+            self.writer.addfile(self.name, self.buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TarZstWriter:
+    """
+    Streamed tar archive compressed with multithreaded zstd.
+    """
+
+    def __init__(self, path, level=ZSTD_LEVEL, threads=ZSTD_THREADS):
+        self.fh = open(path, 'wb')
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.stream = compressor.stream_writer(self.fh)
+        self.tar = tarfile.open(fileobj=self.stream, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def addfile(self, name, fileobj):
+        info = tarfile.TarInfo(name)
+        info.size = fileobj.tell()
+        info.mtime = time.time()
+        info.mode = 0o644
+        fileobj.seek(0)
+        self.tar.addfile(info, fileobj)
+        return info
+
+    def writestr(self, name, data):
+        if isinstance(data, str):
+            data = data.encode()
+        fileobj = io.BytesIO(data)
+        fileobj.seek(0, io.SEEK_END)
+        return self.addfile(name, fileobj)
+
+    def write(self, filepath, arcname):
+        self.tar.add(filepath, arcname, recursive=False)
+
+    def open(self, name, part_size=TAR_PART_SIZE):
+        return _TarPartWriter(self, name, part_size)
+
+    def close(self):
+        self.tar.close()
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _iter_tar(path):
+    with open(path, 'rb') as fh:
+        reader = zstandard.ZstdDecompressor().stream_reader(fh)
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for info in tar:
+                if info.isfile():
+                    yield tar, info
+
+
+def _split_part(name):
+    """
+    Logical member name and part number of a tar member.
+    """
+    match = TAR_PART_RE.match(name)
+    if match:
+        return match.group(1), int(match.group(2))
+    return name, 0
+
+
+def namelist(path):
+    if guess_format(path) == ARCHIVE_FORMAT_ZIP:
+        with ZipFile(path, 'r') as myzip:
+            return myzip.namelist()
+
+    names = []
+    for tar, info in _iter_tar(path):
+        name, part = _split_part(info.name)
+        if not part:
+            names.append(name)
+    return names
+
+
+def infolist(path):
+    """
+    Members of an archive as dicts of name, offset, size, compress_size and
+    crc. Zip offsets are those of the local headers, tar offsets are in the
+    decompressed stream and tar parts are merged in their member. Tar has
+    no checksums, their crc is None.
+    """
+    if guess_format(path) == ARCHIVE_FORMAT_ZIP:
+        with ZipFile(path, 'r') as myzip:
+            return [{
+                'name': info.filename,
+                'offset': info.header_offset,
+                'size': info.file_size,
+                'compress_size': info.compress_size,
+                'crc': info.CRC,
+            } for info in myzip.infolist() if not info.is_dir()]
+
+    members = {}
+    for tar, info in _iter_tar(path):
+        name, part = _split_part(info.name)
+        member = members.get(name)
+        if member is None:
+            member = members[name] = {
+                'name': name, 'offset': info.offset_data, 'size': 0, 'compress_size': None, 'crc': None,
+            }
+        member['size'] += info.size
+    return list(members.values())
+
+
+def read_member(path, name):
+    """
+    Content of a small member or None. Metadata members (json) are written
+    first in tar archives, the scan stops at the first other member.
+    """
+    if guess_format(path) == ARCHIVE_FORMAT_ZIP:
+        with ZipFile(path, 'r') as myzip:
+            try:
+                return myzip.read(name)
+            except KeyError:
+                return None
+
+    for tar, info in _iter_tar(path):
+        if info.name == name:
+            return tar.extractfile(info).read()
+        if not info.name.endswith('.json'):
+            break
+    return None
+
+
+def iter_member(path, name, chunk_size=CHUNK_SIZE):
+    """
+    Decompressed content of a member, chunk by chunk, without extracting it.
+    """
+    if guess_format(path) == ARCHIVE_FORMAT_ZIP:
+        with ZipFile(path, 'r') as myzip:
+            with myzip.open(name) as src:
+                yield from iter(lambda: src.read(chunk_size), b'')
+        return
+
+    found = False
+    for tar, info in _iter_tar(path):
+        if _split_part(info.name)[0] != name:
+            if found:
+                return
+            continue
+        found = True
+        src = tar.extractfile(info)
+        yield from iter(lambda: src.read(chunk_size), b'')
+
+    if not found:
+        raise KeyError("There is no item named '{}' in the archive".format(name))
+
+
+def _get_target(members, folders, name):
+    """
+    Target path of a member, members ending with a slash are folders.
+    """
+    if name in members:
+        return members[name]
+
+    for prefix, target in folders:
+        if name.startswith(prefix):
+            filepath = os.path.normpath(os.path.join(target, name[len(prefix):]))
+            if not filepath.startswith(os.path.normpath(target) + os.sep):
+                raise ValueError("Illegal member path {}".format(name))
+            return filepath
+    return None
+
+
+def _copy_member(src, filepath, mode='wb'):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, mode) as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+
+def extract(path, members, callback=None):
+    """
+    Extract members, a dict of member name (or folder ending with a slash)
+    to target path, in one pass whatever the format. Returns the names of
+    the members found.
+    """
+    found = set()
+    folders = [(name, target) for name, target in members.items() if not name or name.endswith('/')]
+
+    if guess_format(path) == ARCHIVE_FORMAT_ZIP:
+        with ZipFile(path, 'r') as myzip:
+            for info in myzip.infolist():
+                filepath = None if info.is_dir() else _get_target(members, folders, info.filename)
+                if filepath:
+                    with myzip.open(info) as src:
+                        _copy_member(src, filepath)
+                    found.add(info.filename)
+                    if callback:
+                        callback(info.filename, info.file_size)
+        return found
+
+    for tar, info in _iter_tar(path):
+        name, part = _split_part(info.name)
+        filepath = _get_target(members, folders, name)
+        if filepath:
+            _copy_member(tar.extractfile(info), filepath, 'ab' if part else 'wb')
+            found.add(name)
+            if callback:
+                callback(name, info.size)
+    return found
+
+
+def _open_shared(myzip, path):
+    """
+    New handle on an opened zip file sharing its member index, the central
+    directory is only read once whatever the number of workers.
+    """
+    if not ZIP_INTERNALS:
+        return ZipFile(path, 'r')
+
+    clone = copy.copy(myzip)
+    clone.fp = open(path, 'rb')
+    clone._filePassed = 0
+    clone._fileRefCnt = 1
+    clone._lock = threading.RLock()
+    return clone
+
+
+def extract_parallel(path, members, workers=UNZIP_WORKERS, batch_size=UNZIP_BATCH_SIZE, callback=None):
+    """
+    Same as extract, zip members are inflated and written by a pool of
+    workers each reading the archive through its own handle. Tar archives
+    are a single stream and are extracted sequentially. The callback gets
+    the count of members extracted and their total (None for tar).
+    """
+    count = 0
+
+    def progress(name, size, total=None):
+        nonlocal count
+        count += 1
+        if callback:
+            callback(count, total)
+
+    if guess_format(path) != ARCHIVE_FORMAT_ZIP:
+        return extract(path, members, callback=progress)
+
+    found = set()
+    folders = [(name, target) for name, target in members.items() if not name or name.endswith('/')]
+    local = threading.local()
+    handles = []
+
+    with ZipFile(path, 'r') as myzip:
+        items = []
+        for info in myzip.infolist():
+            filepath = None if info.is_dir() else _get_target(members, folders, info.filename)
+            if filepath:
+                items.append((info, filepath))
+
+        def work(batch):
+            handle = getattr(local, 'handle', None)
+            if handle is None:
+                handle = local.handle = _open_shared(myzip, path)
+                handles.append(handle)
+            for info, filepath in batch:
+                with handle.open(info) as src:
+                    _copy_member(src, filepath)
+            return batch
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                futures = [executor.submit(work, items[i:i + batch_size]) for i in range(0, len(items), batch_size)]
+                for future in as_completed(futures):
+                    for info, filepath in future.result():
+                        found.add(info.filename)
+                        progress(info.filename, info.file_size, len(items))
+        finally:
+            for handle in handles:
+                handle.close()
+
+    return found
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from celery.utils.log import get_task_logger
+
+from . import metrics, tools
+
+_logger = get_task_logger(__name__)
+
+# Content addressed store shared by all backups:
+#   <store>/objects/<sha1[:2]>/<sha1>   one blob per distinct file
+#   <store>/refs/<backup>-<hash>.json   blobs referenced by a backup, the
+#                                       hash of its path tells apart
+#                                       backups with the same filename
+BLOBSTORE_PATH = os.environ.get("BLOBSTORE_PATH", os.path.join(tools.OUTPUT_DIR, "blobs"))
+DEFAULT_BLOBSTORE_COPY_MODE = os.environ.get("BLOBSTORE_COPY_MODE", "reflink")
+# Blobs written less than that ago are never collected, their backup may
+# still be running and its refs not written yet
+DEFAULT_GC_GRACE = int(os.environ.get("BLOBSTORE_GC_GRACE", 3600))
+
+INDEX_MODE = 'blobstore'
+
+
+def _get_object_path(key, store=BLOBSTORE_PATH):
+    # Keys of restores come from the index of an archive
+    if not isinstance(key, str) or not tools.SHA1_RE.match(key):
+        raise ValueError("Illegal blob key {}".format(key))
+    return os.path.join(store, 'objects', key[:2], key)
+
+
+def _get_refs_path(name, store=BLOBSTORE_PATH):
+    return os.path.join(store, 'refs', "{}.json".format(name))
+
+
+def get_refs_name(backup):
+    path = os.path.abspath(backup)
+    return "{}-{}".format(os.path.basename(path), hashlib.sha1(path.encode()).hexdigest()[:12])
+
+
+def _store_blob(filepath, key, store, copy_function):
+    target = _get_object_path(key, store)
+    try:
+        # Reused blobs are touched so that a concurrent GC keeps them
+        # until the refs of this backup are written
+        os.utime(target)
+        return 0
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+    try:
+        copy_function(filepath, tmp)
+        os.replace(tmp, target)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    return os.path.getsize(target)
+
+
+def store_folder(path, store=BLOBSTORE_PATH, mode=DEFAULT_BLOBSTORE_COPY_MODE, workers=tools.DEFAULT_COPY_WORKERS):
+    """
+    Add the missing blobs of a filestore to the store, returns its index.
+    """
+    tools._check_path(path)
+
+    index = tools.index_folder(path)
+    copy_function = tools.COPY_FUNCTIONS[mode]
+
+    with metrics.Step('blobstore_store') as step, ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(
+            lambda item: _store_blob(os.path.join(path, item[0]), item[1], store, copy_function),
+            index.items(),
+        ))
+        added = [size for size in sizes if size]
+        step.add(bytes_out=sum(added), files=len(index))
+
+    _logger.info("Blobstore: {} files, {} new blobs ({} bytes)".format(len(index), len(added), sum(added)))
+
+    return (True, {'files': len(index), 'new': len(added), 'new_size': sum(added), 'index': index})
+
+
+def write_refs(name, index, backup=None, store=BLOBSTORE_PATH):
+    filepath = _get_refs_path(name, store)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    with open(filepath, 'w') as fh:
+        json.dump({'backup': backup, 'files': index}, fh)
+
+    return filepath
+
+
+def remove_refs(name, store=BLOBSTORE_PATH):
+    filepath = _get_refs_path(name, store)
+    if os.path.isfile(filepath):
+        os.remove(filepath)
+        return True
+    return False
+
+
+def backup_folder(path, backup, store=BLOBSTORE_PATH, mode=DEFAULT_BLOBSTORE_COPY_MODE):
+    """
+    Store a filestore for a backup archive, returns the filestore index to
+    put in the archive instead of the files.
+    """
+    success, results = store_folder(path, store=store, mode=mode)
+    index = results.pop('index')
+    write_refs(get_refs_name(backup), index, backup=backup, store=store)
+    results['index'] = {'mode': INDEX_MODE, 'files': index}
+
+    return (True, results)
+
+
+def restore_folder(index, path, store=BLOBSTORE_PATH, mode=DEFAULT_BLOBSTORE_COPY_MODE, workers=tools.DEFAULT_COPY_WORKERS):
+    """
+    Rebuild a filestore from its index, the folder only appears once
+    complete.
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    copy_function = tools.COPY_FUNCTIONS[mode]
+    staging = "{}.{}.tmp".format(os.path.normpath(path), uuid.uuid4().hex)
+
+    # Paths and keys are checked before anything is written
+    targets = {relpath: tools._get_safe_path(staging, relpath) for relpath in index}
+    blobs = {key: _get_object_path(key, store) for key in set(index.values())}
+
+    def restore(item):
+        relpath, key = item
+        target = targets[relpath]
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy_function(blobs[key], target)
+
+    try:
+        missing = [key for key, blob in blobs.items() if not os.path.isfile(blob)]
+        if missing:
+            raise FileNotFoundError("{} blobs missing from {}, e.g. {}".format(len(missing), store, missing[0]))
+
+        os.makedirs(staging)
+        with metrics.Step('blobstore_restore') as step, ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(restore, index.items()))
+            step.add(files=len(index))
+        os.rename(staging, path)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+    return (True, {'path': path, 'files': len(index)})
+
+
+def restore_files(index, path, store=BLOBSTORE_PATH, mode=DEFAULT_BLOBSTORE_COPY_MODE, overwrite=False):
+    """
+    Restore some files of a filestore from their blobs, index maps their
+    path to their key. Each file is written next to its target and renamed.
+    """
+    copy_function = tools.COPY_FUNCTIONS[mode]
+    restored, skipped, missing = [], [], []
+    files = {relpath: (tools._get_safe_path(path, relpath), _get_object_path(key, store)) for relpath, key in index.items()}
+
+    for relpath, (target, blob) in sorted(files.items()):
+        if os.path.exists(target) and not overwrite:
+            skipped.append(relpath)
+            continue
+        if not os.path.isfile(blob):
+            missing.append(relpath)
+            continue
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+        try:
+            copy_function(blob, tmp)
+            os.replace(tmp, target)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        restored.append(relpath)
+
+    return (True, {'path': path, 'restored': restored, 'skipped': skipped, 'missing': missing})
+
+
+def gc(store=BLOBSTORE_PATH, grace=DEFAULT_GC_GRACE, prune=False):
+    """
+    Remove blobs no backup refers to. With prune, refs of backups whose
+    archive is gone are dropped first.
+    """
+    referenced = set()
+    pruned = 0
+
+    refs_dir = os.path.join(store, 'refs')
+    for fname in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+        filepath = os.path.join(refs_dir, fname)
+        with open(filepath) as fh:
+            refs = json.load(fh)
+        if prune and refs.get('backup') and not os.path.exists(refs['backup']):
+            os.remove(filepath)
+            pruned += 1
+            continue
+        referenced.update(refs['files'].values())
+
+    removed, freed = 0, 0
+    limit = time.time() - grace
+    for dirpath, dirnames, filenames in os.walk(os.path.join(store, 'objects')):
+        for fname in filenames:
+            if fname in referenced:
+                continue
+            filepath = os.path.join(dirpath, fname)
+            stats = os.stat(filepath)
+            # ctime is updated when the blob is linked in the store or
+            # reused by a backup
+            if stats.st_ctime > limit:
+                continue
+            os.remove(filepath)
+            removed += 1
+            freed += stats.st_size
+
+    _logger.info("Blobstore GC: {} blobs removed, {} bytes freed".format(removed, freed))
+
+    return (True, {'referenced': len(referenced), 'removed': removed, 'freed': freed, 'pruned': pruned})
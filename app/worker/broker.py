@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import json
+import os
+import time
+import uuid
+from celery.utils.log import get_task_logger
+import redis
+
+from . import db
+
+_logger = get_task_logger(__name__)
+
+REDIS_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
+
+# Concurrency limits shared by all workers: each resource is a sorted set
+# of slot holders scored by their expiry, so the slots of a killed worker
+# are freed after SLOT_TTL.
+SLOTS_PREFIX = 'saas:slots:'
+POSTGRES_HOST_SLOTS = int(os.environ.get("POSTGRES_HOST_SLOTS", 2))
+DISK_SLOTS = int(os.environ.get("DISK_SLOTS", 2))
+# Workers writing to the same disk from different hosts must share an id
+DISK_ID = os.environ.get("DISK_ID")
+SLOT_TTL = int(os.environ.get("SLOT_TTL", 6 * 3600))
+SLOT_RETRY_DELAY = int(os.environ.get("SLOT_RETRY_DELAY", 30))
+
+# Task state and progress events are published on a channel per task id
+EVENTS_CHANNEL = 'saas:events:{}'
+
+# Slots are taken on every resource or none
+SCRIPT_ACQUIRE = """
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    if redis.call('ZCARD', key) >= tonumber(ARGV[3 + i]) then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, ARGV[2], ARGV[3])
+end
+return 1
+"""
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+
+def postgres_slot(host=db.POSTGRES_HOST, limit=POSTGRES_HOST_SLOTS):
+    return ('postgres:{}'.format(host), limit)
+
+
+def disk_slot(path, limit=DISK_SLOTS):
+    disk = DISK_ID or os.stat(path).st_dev
+    return ('disk:{}'.format(disk), limit)
+
+
+def acquire_slots(slots, ttl=SLOT_TTL):
+    """
+    Take a slot on each (resource, limit), returns a token to release them
+    or None if one of the resources is full.
+    """
+    token = uuid.uuid4().hex
+    keys = [SLOTS_PREFIX + name for name, limit in slots]
+    now = time.time()
+    args = [now, now + ttl, token] + [limit for name, limit in slots]
+
+    if not get_client().eval(SCRIPT_ACQUIRE, len(keys), *keys, *args):
+        return None
+    return (token, keys)
+
+
+def release_slots(slots):
+    token, keys = slots
+    pipe = get_client().pipeline()
+    for key in keys:
+        pipe.zrem(key, token)
+    pipe.execute()
+
+
+
+def publish(task_id, event):
+    """
+    Publish an event of a task, lost events are only logged: progress must
+    never fail a task.
+    """
+    try:
+        get_client().publish(EVENTS_CHANNEL.format(task_id), json.dumps(event))
+    except redis.RedisError as error:
+        _logger.warning("Can't publish event of task {}: {}".format(task_id, error))
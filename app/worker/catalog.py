@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from contextlib import closing
+import json
+import os
+import re
+import sqlite3
+import time
+from celery.utils.log import get_task_logger
+
+from . import archive, tools
+
+_logger = get_task_logger(__name__)
+
+# Index of the backups and of their members, shared by the API and the
+# workers through the output volume. Entries are refreshed when the size or
+# mtime of their archive changed.
+CATALOG_PATH = os.environ.get("CATALOG_PATH", os.path.join(tools.OUTPUT_DIR, 'catalog.sqlite'))
+CATALOG_TIMEOUT = float(os.environ.get("CATALOG_TIMEOUT", 30))
+DEFAULT_LIMIT = 100
+# Module names end up in a JSON path, same rule as Odoo
+MODULE_RE = re.compile(r'^[a-zA-Z0-9_]+$')
+
+SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    format TEXT NOT NULL,
+    db_name TEXT,
+    version TEXT,
+    dump_format TEXT,
+    dump_size INTEGER NOT NULL,
+    filestore_files INTEGER NOT NULL,
+    filestore_size INTEGER NOT NULL,
+    filestore_index INTEGER NOT NULL,
+    members INTEGER NOT NULL,
+    manifest TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_filename ON backups (filename);
+CREATE INDEX IF NOT EXISTS backups_db_name ON backups (db_name);
+CREATE TABLE IF NOT EXISTS members (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    compress_size INTEGER,
+    crc INTEGER,
+    PRIMARY KEY (backup_id, name)
+) WITHOUT ROWID;
+"""
+SQL_SELECT_BACKUP = "SELECT * FROM backups WHERE path = ?"
+SQL_DELETE_BACKUP = "DELETE FROM backups WHERE path = ?"
+SQL_INSERT_BACKUP = """
+INSERT INTO backups (path, filename, size, mtime, format, db_name, version, dump_format, dump_size,
+                     filestore_files, filestore_size, filestore_index, members, manifest, indexed_at)
+VALUES (:path, :filename, :size, :mtime, :format, :db_name, :version, :dump_format, :dump_size,
+        :filestore_files, :filestore_size, :filestore_index, :members, :manifest, :indexed_at)
+"""
+SQL_INSERT_MEMBER = """
+INSERT INTO members (backup_id, name, offset, size, compress_size, crc)
+VALUES (:backup_id, :name, :offset, :size, :compress_size, :crc)
+"""
+
+
+def connect(path=None):
+    path = path or CATALOG_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=CATALOG_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    # Readers never wait for the workers indexing a backup
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SQL_SCHEMA)
+    return conn
+
+
+def _to_dict(row):
+    backup = dict(row)
+    backup['manifest'] = json.loads(backup['manifest']) if backup['manifest'] else {}
+    backup['filestore_index'] = bool(backup['filestore_index'])
+    return backup
+
+
+def _summarize(path, members, manifest):
+    stats = os.stat(path)
+    dump = tools.get_dump_filename(manifest) if manifest else None
+    filestore = [m for m in members if m['name'].startswith(tools.FILESTORE_PREFIX)]
+
+    return {
+        'path': path,
+        'filename': os.path.basename(path),
+        'size': stats.st_size,
+        'mtime': stats.st_mtime,
+        'format': archive.guess_format(path),
+        'db_name': manifest.get('db_name'),
+        'version': manifest.get('version'),
+        'dump_format': manifest.get('dump_format', tools.DUMP_FORMAT_SQL) if manifest else None,
+        'dump_size': sum(m['size'] for m in members if dump and (m['name'] == dump or m['name'].startswith(dump))),
+        'filestore_files': len(filestore),
+        'filestore_size': sum(m['size'] for m in filestore),
+        'filestore_index': any(m['name'] == tools.DEFAULT_FILESTORE_INDEX for m in members),
+        'members': len(members),
+        'manifest': json.dumps(manifest) if manifest else None,
+        'indexed_at': time.time(),
+    }
+
+
+def index_backup(path):
+    """
+    Read the manifest and member list of a backup into the catalog,
+    replacing its previous entry.
+    """
+    path = os.path.abspath(path)
+    tools._check_path(path)
+
+    members = archive.infolist(path)
+    manifest = tools.read_manifest(path)
+    backup = _summarize(path, members, manifest)
+
+    with closing(connect()) as conn, conn:
+        conn.execute(SQL_DELETE_BACKUP, (path,))
+        backup_id = conn.execute(SQL_INSERT_BACKUP, backup).lastrowid
+        conn.executemany(SQL_INSERT_MEMBER, [dict(member, backup_id=backup_id) for member in members])
+
+    return dict(backup, id=backup_id, manifest=manifest)
+
+
+def add_backup(path):
+    """
+    Index a backup just written or uploaded, failures are only logged:
+    the entry is built again on its first lookup.
+    """
+    try:
+        return index_backup(path)
+    except (OSError, ValueError, sqlite3.Error) as error:
+        _logger.warning("Can't index backup '{}': {}".format(path, error))
+        return False
+
+
+def remove_backup(path):
+    with closing(connect()) as conn, conn:
+        return bool(conn.execute(SQL_DELETE_BACKUP, (os.path.abspath(path),)).rowcount)
+
+
+def get_backup(path, index=True):
+    """
+    Catalog entry of a backup, None once the archive is gone. Missing or
+    outdated entries are indexed first, or None without index: indexing
+    reads the archive, a whole tar.zst one.
+    """
+    path = os.path.abspath(path)
+
+    with closing(connect()) as conn:
+        row = conn.execute(SQL_SELECT_BACKUP, (path,)).fetchone()
+
+    if not os.path.isfile(path):
+        if row:
+            remove_backup(path)
+        return None
+
+    stats = os.stat(path)
+    if row and row['size'] == stats.st_size and row['mtime'] == stats.st_mtime:
+        return _to_dict(row)
+
+    return index_backup(path) if index else None
+
+
+def search(query=None, db_name=None, version=None, module=None, limit=DEFAULT_LIMIT, offset=0):
+    """
+    Backups matching all the given criteria, newest first: query is a
+    substring of the filename or database name, module an installed module.
+    Raise a ValueError for an invalid module name.
+    """
+    where, params = [], []
+    if query:
+        where.append("(filename LIKE ? OR db_name LIKE ?)")
+        params += ["%{}%".format(query)] * 2
+    if db_name:
+        where.append("db_name = ?")
+        params.append(db_name)
+    if version:
+        where.append("version = ?")
+        params.append(version)
+    if module:
+        if not MODULE_RE.match(module):
+            raise ValueError("Invalid module name '{}'".format(module))
+        where.append("json_type(manifest, '$.modules.\"' || ? || '\"') IS NOT NULL")
+        params.append(module)
+
+    where = " WHERE " + " AND ".join(where) if where else ""
+
+    with closing(connect()) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM backups" + where, params).fetchone()[0]
+        rows = conn.execute(
+            "SELECT * FROM backups" + where + " ORDER BY mtime DESC LIMIT ? OFFSET ?", params + [limit, offset],
+        ).fetchall()
+
+    return {'count': total, 'backups': [_to_dict(row) for row in rows]}
+
+
+def list_members(backup_id, prefix=None, limit=DEFAULT_LIMIT, offset=0):
+    sql, params = "SELECT name, offset, size, compress_size, crc FROM members WHERE backup_id = ?", [backup_id]
+    if prefix:
+        # Range scan on the primary key instead of LIKE
+        sql += " AND name >= ? AND name < ?"
+        params += [prefix, prefix + '\uffff']
+    sql += " ORDER BY name LIMIT ? OFFSET ?"
+
+    with closing(connect()) as conn:
+        rows = conn.execute(sql, params + [limit, offset]).fetchall()
+
+    return [dict(row) for row in rows]
+
+
+def find_members(path, names):
+    """
+    Those of names that are members of a backup, without opening it once
+    indexed.
+    """
+    backup = get_backup(path)
+    if backup is None:
+        return set()
+
+    names, found = list(names), set()
+    with closing(connect()) as conn:
+        # Within the bound parameters limit of older SQLite builds
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            rows = conn.execute("SELECT name FROM members WHERE backup_id = ? AND name IN ({})".format(
+                ", ".join("?" * len(batch))), [backup['id']] + batch)
+            found.update(row['name'] for row in rows)
+
+    return found
+
+
+def get_backup_by_id(backup_id):
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT path FROM backups WHERE id = ?", (backup_id,)).fetchone()
+    return row and get_backup(row['path'])
+
+
+def _iter_backups(folders):
+    extensions = tuple(archive.ARCHIVE_FORMATS.values())
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        # Backups are uploaded in the input folder, written in a workdir of
+        # the output folder
+        for entry in os.scandir(folder):
+            if entry.is_file() and entry.name.endswith(extensions):
+                yield entry.path
+            elif entry.is_dir() and not entry.name.startswith('.'):
+                for sub in os.scandir(entry.path):
+                    if sub.is_file() and sub.name.endswith(extensions):
+                        yield sub.path
+
+
+def sync(folders=None):
+    """
+    Index the backups added or modified in folders outside of the API and
+    workers, and forget those removed.
+    """
+    folders = folders or [tools.INPUT_DIR, tools.OUTPUT_DIR]
+    indexed = removed = 0
+
+    with closing(connect()) as conn:
+        known = {row['path']: (row['size'], row['mtime']) for row in conn.execute("SELECT path, size, mtime FROM backups")}
+
+    found = set()
+    for path in _iter_backups(folders):
+        path = os.path.abspath(path)
+        found.add(path)
+        stats = os.stat(path)
+        if known.get(path) == (stats.st_size, stats.st_mtime):
+            continue
+        if add_backup(path):
+            indexed += 1
+
+    roots = tuple(os.path.abspath(folder) + os.sep for folder in folders)
+    for path in set(known) - found:
+        if path.startswith(roots) and not os.path.isfile(path):
+            remove_backup(path)
+            removed += 1
+
+    return (True, {'indexed': indexed, 'removed': removed, 'backups': len(found)})
+
+
+def _get_free_space(path):
+    # The target itself is created by the restore
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def _get_major(version):
+    return str(version).split('.')[0]
+
+
+def precheck(path, filestore=None, version=None, index=False):
+    """
+    Check a restore against the catalog, without reading the archive: a
+    manifest and dump are present, the Odoo version matches and the
+    filestore fits on its disk. Returns the errors found and the figures,
+    indexed is False if the backup must be indexed first.
+    """
+    backup = get_backup(path, index=index)
+    if backup is None:
+        if os.path.isfile(path):
+            return {'errors': ["Backup '{}' not indexed yet".format(os.path.basename(path))], 'indexed': False}
+        return {'errors': ["Backup '{}' not found".format(os.path.basename(path))]}
+
+    errors = []
+    manifest = backup['manifest']
+    if not manifest:
+        errors.append("No manifest in backup")
+    elif not backup['dump_size']:
+        errors.append("No dump in backup")
+    if version and backup['version'] and _get_major(version) != _get_major(backup['version']):
+        errors.append("Backup of Odoo {} can't be restored on Odoo {}".format(backup['version'], version))
+
+    required = {'filestore': backup['filestore_size'], 'dump': backup['dump_size']}
+    available = {}
+    if filestore:
+        if os.path.exists(filestore):
+            errors.append("Filestore '{}' already exists".format(filestore))
+        available['filestore'] = _get_free_space(filestore)
+        if required['filestore'] > available['filestore']:
+            errors.append("Filestore needs {} bytes, {} available".format(required['filestore'], available['filestore']))
+
+    return {
+        'errors': errors,
+        'backup': {key: backup[key] for key in ('id', 'filename', 'size', 'db_name', 'version', 'dump_format')},
+        'required': required,
+        'available': available,
+    }
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from collections import OrderedDict
+import os
+import threading
+import time
+from celery.utils.log import get_task_logger
+from psycopg_pool import ConnectionPool
+
+_logger = get_task_logger(__name__)
+
+POSTGRES_USER = os.environ.get("POSTGRES_USER")
+POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
+POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "db")
+POSTGRES_PORT = str(os.environ.get("POSTGRES_PORT", 5432))
+# Maintenance database, never template1: CREATE DATABASE copies it and
+# fails while anything else is connected to it
+POSTGRES_DEFAULT_DATABASE = os.environ.get("POSTGRES_MAINTENANCE_DB", 'postgres')
+# Set on the pooled connections of the API and workers, so that their idle
+# ones in other processes can be told apart from those of Odoo
+POOL_APPLICATION_NAME = os.environ.get("POOL_APPLICATION_NAME", "saas_backend")
+
+# The maintenance database runs CREATE/DROP DATABASE, its connections are
+# kept open. Tenant pools only keep connections while they are used and
+# the least recently used pools are closed past POOL_MAX_TENANTS.
+POOL_MAINTENANCE_MIN_SIZE = int(os.environ.get("POOL_MAINTENANCE_MIN_SIZE", 1))
+POOL_MAINTENANCE_MAX_SIZE = int(os.environ.get("POOL_MAINTENANCE_MAX_SIZE", 4))
+POOL_TENANT_MAX_SIZE = int(os.environ.get("POOL_TENANT_MAX_SIZE", 2))
+POOL_MAX_TENANTS = int(os.environ.get("POOL_MAX_TENANTS", 8))
+POOL_MAX_IDLE = float(os.environ.get("POOL_MAX_IDLE", 300))
+POOL_TIMEOUT = float(os.environ.get("POOL_TIMEOUT", 30))
+# Idle connections of a pool are checked before use if it has not been
+# used for that long
+POOL_CHECK_INTERVAL = float(os.environ.get("POOL_CHECK_INTERVAL", 60))
+
+SQL_TERMINATE_IDLE = """
+SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+WHERE datname = %s AND application_name = %s AND state = 'idle' AND pid <> pg_backend_pid()
+"""
+
+_pools = OrderedDict()
+_last_used = {}
+_lock = threading.Lock()
+_pid = None
+
+
+def _get_params(dbname):
+    return {
+        'host': POSTGRES_HOST,
+        'port': POSTGRES_PORT,
+        'user': POSTGRES_USER,
+        'password': POSTGRES_PASSWORD,
+        'dbname': dbname,
+        'application_name': POOL_APPLICATION_NAME,
+    }
+
+
+def _create_pool(dbname):
+    params = _get_params(dbname)
+    options = {'kwargs': params, 'max_idle': POOL_MAX_IDLE, 'timeout': POOL_TIMEOUT, 'name': dbname}
+
+    if dbname == POSTGRES_DEFAULT_DATABASE:
+        params['autocommit'] = True
+        options.update(min_size=POOL_MAINTENANCE_MIN_SIZE, max_size=POOL_MAINTENANCE_MAX_SIZE)
+    else:
+        options.update(min_size=0, max_size=POOL_TENANT_MAX_SIZE, num_workers=1)
+
+    pool = ConnectionPool(open=False, **options)
+    pool.open()
+    return pool
+
+
+def _reset_after_fork():
+    """
+    Pools are per process: connections inherited from a parent are dropped
+    without being closed, they belong to it.
+    """
+    global _pid
+    if _pid != os.getpid():
+        _pools.clear()
+        _last_used.clear()
+        _pid = os.getpid()
+
+
+def get_pool(dbname=POSTGRES_DEFAULT_DATABASE):
+    evicted = []
+
+    with _lock:
+        _reset_after_fork()
+        pool = _pools.get(dbname)
+        if pool is None:
+            pool = _pools[dbname] = _create_pool(dbname)
+            _last_used[dbname] = time.monotonic()
+        _pools.move_to_end(dbname)
+
+        tenants = [name for name in _pools if name != POSTGRES_DEFAULT_DATABASE]
+        while len(tenants) > POOL_MAX_TENANTS:
+            name = tenants.pop(0)
+            evicted.append(_pools.pop(name))
+            _last_used.pop(name, None)
+
+        check = time.monotonic() - _last_used.get(dbname, 0) > POOL_CHECK_INTERVAL
+        _last_used[dbname] = time.monotonic()
+
+    for old in evicted:
+        _logger.info("Close connection pool '{}'".format(old.name))
+        old.close()
+    if check:
+        pool.check()
+
+    return pool
+
+
+def connection(dbname=POSTGRES_DEFAULT_DATABASE):
+    """
+    Context manager borrowing a connection from the pool of a database,
+    connections to the maintenance database are in autocommit.
+    """
+    return get_pool(dbname).connection()
+
+
+def close_pool(dbname):
+    """
+    Close the pool of a database, needed before it is dropped or used as a
+    template.
+    """
+    with _lock:
+        _reset_after_fork()
+        pool = _pools.pop(dbname, None)
+        _last_used.pop(dbname, None)
+
+    if pool is None:
+        return False
+    pool.close()
+    return True
+
+
+def release(dbname):
+    """
+    Close the pool of a database and terminate the idle connections other
+    processes keep to it, which would make it busy when dropped, renamed
+    or used as a template. Connections in use are left alone.
+    """
+    close_pool(dbname)
+
+    with connection() as conn:
+        cr = conn.cursor()
+        cr.execute(SQL_TERMINATE_IDLE, (dbname, POOL_APPLICATION_NAME))
+        return cr.rowcount
+
+
+def init_pools():
+    with _lock:
+        _reset_after_fork()
+    get_pool(POSTGRES_DEFAULT_DATABASE)
+
+
+def close_pools():
+    with _lock:
+        _reset_after_fork()
+        pools = list(_pools.values())
+        _pools.clear()
+        _last_used.clear()
+
+    for pool in pools:
+        pool.close()
+
+    return len(pools)
+
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+import os
+
+
+def parse_bool(value):
+    # Strings from the environment or a payload, any of them is truthy
+    if isinstance(value, str):
+        return value.strip().lower() not in ("", "0", "false", "no", "off")
+    return bool(value)
+
+
+def get_bool_env(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return parse_bool(value)
@@ -2,13 +2,20 @@
 # Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
 
 from genericpath import isdir
+from concurrent.futures import ThreadPoolExecutor
 import os
+import random
 import time
-from celery import Celery, chain
+from celery import Celery, chain, group
+from celery.signals import (
+    before_task_publish, task_postrun, task_prerun, worker_process_init, worker_process_shutdown,
+)
 from celery.utils.log import get_task_logger
+import json
+import shutil
 import uuid
 
-from . import tools
+from . import archive, blobstore, broker, catalog, db, metrics, tools, warm
 
 celery = Celery("saas")
 celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
@@ -16,14 +23,109 @@ celery.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://lo
 celery.conf.result_extended = True
 celery.conf.timezone = 'Europe/Paris'
 celery.conf.enable_utc = True
-celery.conf.task_annotations = {
-    'create_env': {'rate_limit': '4/m'}
+
+# Tasks are routed by the resource they wait on, each queue has its own
+# workers (see docker-compose.yml) so that quick control steps never wait
+# behind a long dump or zip.
+QUEUE_CONTROL = 'control'
+QUEUE_DB = 'db'
+QUEUE_CPU = 'cpu'
+QUEUE_DISK = 'disk'
+TASK_QUEUES = {
+    QUEUE_CONTROL: [
+        'error_handler', 'create_task', 'create_env', 'create_odoo_manifest', 'clean_workdir', 'bulk_dump',
+        'init_restore', 'create_database', 'refill_warm_pool', 'warm_ready', 'claim_database',
+    ],
+    QUEUE_DB: ['dump_db', 'backup', 'restore_dump', 'restore_post_data', 'restore_stream', 'restore', 'clone_database'],
+    QUEUE_CPU: ['add_to_zip', 'add_filestore'],
+    QUEUE_DISK: [
+        'unzip_dump', 'unzip_backup', 'unzip_filestore', 'copy_filestore', 'gc_blobstore', 'restore_attachments',
+        'index_backup', 'sync_catalog', 'check_restore',
+    ],
+}
+celery.conf.task_default_queue = QUEUE_CONTROL
+celery.conf.task_routes = {name: {'queue': queue} for queue, names in TASK_QUEUES.items() for name in names}
+# Long tasks are acknowledged once done and a worker only reserves the
+# task it runs, control workers override it with --prefetch-multiplier
+celery.conf.task_acks_late = True
+celery.conf.worker_prefetch_multiplier = 1
+# Unacknowledged tasks are redelivered after that, it must exceed the
+# longest backup or restore
+celery.conf.broker_transport_options = {
+    'visibility_timeout': int(os.environ.get("CELERY_VISIBILITY_TIMEOUT", 12 * 3600)),
 }
+# Run by celery beat, see docker-compose.yml
+if warm.WARM_TEMPLATES:
+    celery.conf.beat_schedule = {
+        'refill-warm-pool': {'task': 'refill_warm_pool', 'schedule': warm.WARM_REFILL_INTERVAL},
+    }
 
 FILESTORE_PATH = '/usr/src/filestore'
 
 _logger = get_task_logger(__name__)
 
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    db.init_pools()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    count = db.close_pools()
+    _logger.info("Closed {} connection pools".format(count))
+
+
+@before_task_publish.connect
+def stamp_task_sent(headers=None, **kwargs):
+    # Read back as request.sent_at to measure the queue wait
+    if headers is not None:
+        headers['sent_at'] = time.time()
+
+
+@task_prerun.connect
+def publish_task_started(task_id=None, task=None, **kwargs):
+    metrics.task_started(task_id, task)
+    broker.publish(task_id, {'event': 'state', 'task_id': task_id, 'name': task.name, 'state': 'STARTED'})
+
+
+@task_postrun.connect
+def publish_task_done(task_id=None, task=None, state=None, retval=None, **kwargs):
+    metrics.task_done(task_id, task, state, retval)
+    broker.publish(task_id, {'event': 'state', 'task_id': task_id, 'name': task.name, 'state': state})
+
+
+def _run_with_slots(task, slots, func, *args):
+    """
+    Run func once a slot is free on each resource, the task is retried later
+    otherwise.
+    """
+    token = broker.acquire_slots(slots)
+    if token is None:
+        _logger.info("No slot available on {}, retry later".format([name for name, limit in slots]))
+        countdown = random.uniform(0.5, 1.5) * broker.SLOT_RETRY_DELAY
+        raise task.retry(countdown=countdown, max_retries=None)
+
+    try:
+        return func(*args)
+    finally:
+        broker.release_slots(token)
+
+
+def _get_dump_slots():
+    return [broker.postgres_slot(), broker.disk_slot(tools.OUTPUT_DIR)]
+
+
+def _find_previous_backup(since):
+    """
+    Previous backup given its task id or its filename.
+    """
+    result = celery.AsyncResult(since).result
+    if isinstance(result, dict) and result.get('download'):
+        return result['download']
+    return tools.find_backup(since)
+
+
 @celery.task(name="error_handler")
 def error_handler(request, exc, traceback):
     _logger.error("We've got serious problem here.")
@@ -59,7 +161,9 @@ def create_odoo_manifest(data):
     workdir = data.get('workdir')
     db_name = data.get('db_name')
 
-    filepath, manifest = tools.create_odoo_manifest(workdir, db_name)
+    dump_format = data.get('dump_format', tools.DUMP_FORMAT_SQL)
+
+    filepath, manifest = tools.create_odoo_manifest(workdir, db_name, dump_format=dump_format)
     files = data.setdefault('files', [])
     files.append(filepath)
 
@@ -84,9 +188,17 @@ def create_env(data):
     })
     return data
 
-@celery.task(name="dump_db")
-def dump_db(data):
-    success, results = tools.create_db_dump(data.get('db_name'), data.get('workdir'))
+@celery.task(name="dump_db", bind=True)
+def dump_db(self, data):
+    return _run_with_slots(self, _get_dump_slots(), _dump_db, data)
+
+def _dump_db(data):
+    success, results = tools.create_db_dump(
+        data.get('db_name'),
+        data.get('workdir'),
+        format=data.get('dump_format', tools.DUMP_FORMAT_SQL),
+        jobs=data.get('jobs', 1),
+    )
 
     data['dump'] = results
     files = data.setdefault('files', [])
@@ -104,16 +216,89 @@ def add_filestore(self, data):
     path = os.path.join(FILESTORE_PATH, data.get('db_name'))
     tools._check_path(path)
 
+    if data.get('dedup'):
+        zipfile = data['zip']['path']
+        success, results = blobstore.backup_folder(path, zipfile)
+        tools.write_to_zip(zipfile, tools.DEFAULT_FILESTORE_INDEX, json.dumps(results.pop('index')))
+        data['blobstore'] = results
+        catalog.add_backup(zipfile)
+        return data
+
+    files = None
+    if data.get('since'):
+        index = tools.diff_filestore(path, _find_previous_backup(data['since']))
+        tools.write_to_zip(data['zip']['path'], tools.DEFAULT_FILESTORE_INDEX, json.dumps(index))
+        files = index['added']
+        data['incremental'] = {'base': index['base'], 'added': len(files), 'deleted': len(index['deleted'])}
+
     new_path = os.path.join(data['workdir'], 'filestore')
     os.symlink(path, new_path)
 
-    success, results = tools.add_folder_to_zip(new_path, data['zip']['path'], task=self)
+    success, results = tools.add_folder_to_zip(new_path, data['zip']['path'], files=files, task=self)
+    catalog.add_backup(results['path'])
 
     files = data.setdefault('files', [])
     files.append(new_path)
 
     return data
 
+@celery.task(name="backup", bind=True)
+def backup(self, data):
+    return _run_with_slots(self, _get_dump_slots(), _backup, self, data)
+
+def _backup(task, data):
+    db_name = data.get('db_name')
+    dump_format = data.get('dump_format', tools.DUMP_FORMAT_SQL)
+
+    filestore = None
+    if data.get('with_filestore', True):
+        filestore = os.path.join(FILESTORE_PATH, db_name)
+        tools._check_path(filestore)
+
+    archive_format = data.get('archive_format', archive.ARCHIVE_FORMAT_ZIP)
+    zipfile = archive.get_archive_path(data.get('zipfile'), archive_format)
+    members, files = {}, None
+    if filestore and data.get('dedup'):
+        success, results = blobstore.backup_folder(filestore, zipfile)
+        members[tools.DEFAULT_FILESTORE_INDEX] = json.dumps(results.pop('index'))
+        data['blobstore'] = results
+        filestore = None
+    elif filestore and data.get('since'):
+        index = tools.diff_filestore(filestore, _find_previous_backup(data['since']))
+        members[tools.DEFAULT_FILESTORE_INDEX] = json.dumps(index)
+        files = index['added']
+        data['incremental'] = {'base': index['base'], 'added': len(files), 'deleted': len(index['deleted'])}
+
+    manifest = tools.get_odoo_manifest(db_name, dump_format=dump_format)
+    success, results = tools.create_backup(
+        db_name, zipfile, manifest, filestore=filestore, format=dump_format, members=members, files=files,
+        archive_format=archive_format, task=task)
+
+    data['zip'] = results
+    data['download'] = results['path']
+    catalog.add_backup(results['path'])
+
+    return data
+
+@celery.task(name="bulk_dump")
+def bulk_dump(names, options):
+    """
+    Back up several databases (without names, the Odoo ones of the cluster
+    but the warm pool) as a group, their concurrency is limited by the
+    slots of the backup task.
+    """
+    names = list(dict.fromkeys(names or tools.list_databases([warm.WARM_PREFIX])))
+    result = group([
+        chain(create_env.s(dict(options, db_name=name)), backup.s()).on_error(error_handler.s())
+        for name in names
+    ]).apply_async()
+    result.save()
+
+    return {
+        'group_id': result.id,
+        'tasks': {name: child.id for name, child in zip(names, result.results)},
+    }
+
 @celery.task(name="clean_workdir")
 def clean_workdir(data):
     success = tools.clean_workdir(data.get('workdir'), data.get('files'))
@@ -128,54 +313,254 @@ def init_restore(data):
         raise FileExistsError(filestore)
     # os.mkdir(filestore)
 
-    zipfile = os.path.join(tools.INPUT_DIR, data.get('filename'))
+    # Only backups of the input folder are restored
+    zipfile = os.path.join(tools.INPUT_DIR, os.path.basename(data.get('filename')))
     if not os.path.isfile(zipfile):
         raise FileNotFoundError(zipfile)
 
     data.update({
         'filestore': filestore,
         'zipfile': zipfile,
+        'archive_format': archive.guess_format(zipfile),
     })
+    # Only answered from the catalog, backups not indexed yet are checked
+    # by check_restore on a disk worker
+    data['checked'] = _precheck_restore(data)
+
+    return data
+
+def _precheck_restore(data, index=False):
+    check = catalog.precheck(data['zipfile'], data['filestore'], version=data.get('version'), index=index)
+    if check['errors'] and check.get('indexed', True):
+        raise ValueError("Can't restore '{}': {}".format(data.get('filename'), ", ".join(check['errors'])))
+    return check.get('indexed', True)
+
+@celery.task(name="check_restore")
+def check_restore(data):
+    """
+    Index the backup of a restore if init_restore found it missing from the
+    catalog, then run the restore checks on it.
+    """
+    if not data.get('checked'):
+        data['checked'] = _precheck_restore(data, index=True)
 
     return data
 
 @celery.task(name="unzip_dump")
 def unzip_dump(data):
-    unzip_files = tools.unzip_files(data.get('zipfile'), ['dump.sql'], prefix=data.get('db_name'))
+    manifest = tools.read_manifest(data.get('zipfile'))
+    filename = tools.get_dump_filename(manifest)
+    # Restored by a db worker, extracted on the output volume both mount
+    unzip_files = tools.unzip_files(
+        data.get('zipfile'), [filename], prefix=data.get('db_name'), dir=tools.OUTPUT_DIR)
 
     if not unzip_files:
         raise ValueError("No dump file found")
 
     data['dump'] = unzip_files[0]
+    # Extracted in a workdir of its own, removed once restored
+    data['dump']['tmp_dir'] = os.path.dirname(unzip_files[0]['path'])
 
     return data
 
 
+def _start_post_data(data, db_name):
+    task = restore_post_data.delay(db_name, data['dump'])
+    data['post_data'] = task.id
+
 @celery.task(name="restore_dump")
-def restore_dump(data, name=False):
+def restore_dump(data, name=False, post_data=True):
+    """
+    Restore an extracted dump. With deferred indexes, they are built by a
+    restore_post_data task started here unless post_data is False: the
+    caller starts it once the restore is complete.
+    """
     file = data['dump']['path']
+    tmp_dir = data['dump'].get('tmp_dir', False)
 
     db_name = name if name else data.get('db_name')
 
-    success, results = tools.restore_db_dump(db_name, file)
+    try:
+        success, results = tools.restore_db_dump(
+            db_name,
+            file,
+            jobs=data.get('jobs', 1),
+            defer_post_data=data.get('defer_indexes', False),
+        )
+    except Exception:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
     data['dump'] = results
 
+    if results['deferred']:
+        # Still needed to build the indexes
+        results['tmp_dir'] = tmp_dir
+        if post_data:
+            _start_post_data(data, db_name)
+    elif tmp_dir:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
     return data
 
-@celery.task(name="unzip_backup")
-def unzip_backup(data):
-    success, results = tools.unzip_backup(data.get('zipfile'), data.get('filestore'))
+@celery.task(name="restore_post_data")
+def restore_post_data(db_name, dump):
+    try:
+        success, results = tools.restore_db_post_data(
+            db_name, dump['path'], dump['deferred'], jobs=dump.get('jobs', 1))
+    finally:
+        if dump.get('tmp_dir'):
+            shutil.rmtree(dump['tmp_dir'], ignore_errors=True)
+
+    return results
+
+@celery.task(name="restore_stream", bind=True)
+def restore_stream(self, data, name=False, task_id=None, post_data=True):
+    db_name = name if name else data.get('db_name')
+
+    manifest = tools.read_manifest(data.get('zipfile'))
+    dump_format = manifest.get('dump_format', tools.DUMP_FORMAT_SQL)
+    parallel = data.get('jobs', 1) > 1 or data.get('defer_indexes', False)
+
+    if dump_format == tools.DUMP_FORMAT_DIRECTORY or (dump_format == tools.DUMP_FORMAT_CUSTOM and parallel):
+        # pg_restore needs a file for parallel jobs and TOC lists
+        return restore_dump(unzip_dump(data), name, post_data=post_data)
+
+    success, results = tools.restore_db_stream(db_name, data.get('zipfile'), task=self, task_id=task_id)
+    data['dump'] = results
+
+    return data
+
+@celery.task(name="unzip_backup", bind=True)
+def unzip_backup(self, data):
+    success, results = tools.unzip_backup(data.get('zipfile'), data.get('filestore'), task=self)
     data['zip'] = results
 
     return data
 
-@celery.task(name="unzip_filestore")
-def unzip_filestore(data):
-    success, results = tools.unzip_filestore(data.get('zipfile'), data.get('db_name'), FILESTORE_PATH)
+@celery.task(name="unzip_filestore", bind=True)
+def unzip_filestore(self, data, task_id=None):
+    index = tools.read_filestore_index(data.get('zipfile'))
+    if index.get('mode') == blobstore.INDEX_MODE:
+        path = os.path.join(FILESTORE_PATH, data.get('db_name'))
+        success, results = blobstore.restore_folder(index['files'], path)
+    elif index.get('mode') == tools.FILESTORE_INDEX_INCREMENTAL:
+        zipfiles = tools.get_backup_chain(data.get('zipfile'))
+        success, results = tools.unzip_filestore_chain(
+            zipfiles, data.get('db_name'), FILESTORE_PATH, task=self, task_id=task_id)
+    else:
+        success, results = tools.unzip_filestore(
+            data.get('zipfile'), data.get('db_name'), FILESTORE_PATH, task=self, task_id=task_id)
     data['zip'] = results
 
     return data
 
+def _restore_database(data, state, task_id):
+    create_database(data)
+    state['database'] = True
+
+    # Deferred indexes are only built once the filestore is restored too
+    if data.get('stream'):
+        return restore_stream(data, task_id=task_id, post_data=False)
+    return restore_dump(unzip_dump(data), post_data=False)
+
+def _restore_filestore(data, state, task_id):
+    # Progress is reported on the restore task
+    data = unzip_filestore(data, task_id=task_id)
+    state['filestore'] = True
+
+    return data
+
+def _rollback_restore(data, state):
+    if state.get('database'):
+        res = tools.drop_database(data.get('db_name'))
+        _logger.warning("Drop database '{}': {}".format(data.get('db_name'), res))
+    if state.get('filestore'):
+        res = tools.clean_workdir(data.get('filestore'))
+        _logger.warning("Clean filestore '{}': {}".format(data.get('filestore'), res))
+
+@celery.task(name="restore", bind=True)
+def restore(self, data):
+    """
+    Restore database and filestore concurrently, if either fails what the
+    other created is removed once both are done.
+    """
+    state = {}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        database = executor.submit(_restore_database, dict(data), state, self.request.id)
+        filestore = executor.submit(_restore_filestore, dict(data), state, self.request.id)
+
+    errors = [f.exception() for f in (database, filestore) if f.exception()]
+    if errors:
+        if not database.exception():
+            # Extracted dump kept for the deferred indexes
+            tmp_dir = database.result()['dump'].get('tmp_dir')
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        _rollback_restore(data, state)
+        raise errors[0]
+
+    data.update(database.result())
+    data['zip'] = filestore.result()['zip']
+    if data['dump'].get('deferred'):
+        _start_post_data(data, data.get('db_name'))
+
+    return data
+
+@celery.task(name="restore_attachments")
+def restore_attachments(data):
+    """
+    Restore some files of a live filestore from a backup, given their path,
+    their sha1 or the ids of their ir_attachment records in the dump.
+    """
+    zipfile = _find_previous_backup(data['backup'])
+    target = os.path.join(FILESTORE_PATH, data.get('db_name'))
+    relpaths = set(data.get('paths') or [])
+    relpaths.update(tools.get_attachment_path(checksum) for checksum in data.get('sha1s') or [])
+
+    unresolved = []
+    if data.get('ids'):
+        attachments = tools.find_attachments(zipfile, data['ids'])
+        relpaths.update(fname for fname in attachments.values() if fname)
+        # Unknown ids, or attachments stored in the database
+        resolved = set(key for key, fname in attachments.items() if fname)
+        unresolved = sorted(set(int(value) for value in data['ids']) - resolved)
+
+    index = tools.read_filestore_index(zipfile)
+    if index.get('mode') == blobstore.INDEX_MODE:
+        files = {relpath: index['files'][relpath] for relpath in relpaths if relpath in index['files']}
+        success, results = blobstore.restore_files(files, target, overwrite=data.get('overwrite', False))
+        results['missing'] += sorted(relpaths - set(files))
+    else:
+        # Backups of the chain holding none of the files are not opened
+        members = set(tools.FILESTORE_PREFIX + relpath for relpath in relpaths)
+        zipfiles = [path for path in tools.get_backup_chain(zipfile) if catalog.find_members(path, members)]
+        success, results = tools.restore_filestore_files(
+            zipfiles, relpaths, target, overwrite=data.get('overwrite', False))
+
+    data['attachments'] = dict(results, unresolved=unresolved)
+
+    return data
+
+@celery.task(name="gc_blobstore")
+def gc_blobstore(prune=False):
+    success, results = blobstore.gc(prune=prune)
+
+    return results
+
+@celery.task(name="index_backup")
+def index_backup(path):
+    backup = catalog.add_backup(path)
+
+    return backup and {key: backup[key] for key in ('id', 'path', 'members')}
+
+@celery.task(name="sync_catalog")
+def sync_catalog():
+    success, results = catalog.sync()
+
+    return results
+
 @celery.task(name="create_database")
 def create_database(data, name=False):
     db_name = name if name else data.get('db_name')
@@ -183,12 +568,72 @@ def create_database(data, name=False):
 
     return data
 
-@celery.task(name="copy_filestore")
-def copy_filestore(data):
+@celery.task(name="clone_database", bind=True)
+def clone_database(self, data):
+    try:
+        success, results = tools.clone_database(
+            data.get('db_name'), data.get('new_db'), terminate=data.get('terminate', False))
+    except tools.CLONE_ERRORS as error:
+        _logger.warning("Template clone of '{}' failed, fallback to dump/restore: {}".format(
+            data.get('db_name'), error))
+        raise self.replace(chain(
+            dump_db.s(data),
+            create_database.s(data['new_db']),
+            restore_dump.s(data['new_db']),
+        ))
+
+    data['clone'] = results
+
+    return data
+
+@celery.task(name="copy_filestore", bind=True)
+def copy_filestore(self, data):
     src = os.path.join(FILESTORE_PATH, data.get('db_name'))
     dest = os.path.join(FILESTORE_PATH, data.get('new_db'))
-    success, results = tools.copy_filestore(src, dest)
+    mode = data.get('filestore_mode', tools.DEFAULT_FILESTORE_COPY_MODE)
+    success, results = tools.copy_filestore(src, dest, mode=mode, task=self)
 
     data['new'] = results
 
-    return data
\ No newline at end of file
+    return data
+
+@celery.task(name="refill_warm_pool")
+def refill_warm_pool(templates=None):
+    """
+    Restore the databases missing for each template to keep its ready ones
+    at WARM_POOL_SIZE, failed restores are retried once their pending
+    entry expired.
+    """
+    results = {}
+    for name in templates or list(warm.WARM_TEMPLATES):
+        names = warm.plan_refill(name)
+        for db_name in names:
+            data = {'db_name': db_name, 'filename': warm.get_template(name), 'stream': True}
+            chain(init_restore.s(data), check_restore.s(), restore.s(), warm_ready.s(name)).on_error(error_handler.s()).apply_async()
+        results[name] = names
+
+    return results
+
+@celery.task(name="warm_ready")
+def warm_ready(data, template):
+    warm.set_ready(template, data['db_name'])
+
+    return data
+
+@celery.task(name="claim_database")
+def claim_database(data):
+    """
+    Hand a ready database to a tenant, it goes back to the pool if the
+    claim failed before the database was renamed.
+    """
+    try:
+        success, results = warm.claim_database(data['db_name'], data['new_db'], FILESTORE_PATH)
+    except warm.CLAIM_ERRORS:
+        warm.push_back(data['template'], data['db_name'])
+        raise
+    finally:
+        refill_warm_pool.delay([data['template']])
+
+    data['claim'] = results
+
+    return data
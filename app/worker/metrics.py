@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from datetime import datetime
+import json
+import time
+from celery.utils.log import get_task_logger
+from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
+import redis
+
+from . import broker
+from .env import get_bool_env
+
+_logger = get_task_logger(__name__)
+
+INF = float("inf")
+
+# Workers run in many processes and hosts: their observations are added up
+# in Redis, one hash per metric, and exposed by the API on /metrics.
+METRICS_ENABLED = get_bool_env("METRICS_ENABLED", True)
+METRICS_PREFIX = 'saas:metrics:'
+
+# Tenants are bucketed by the size of their backup, or of the data a step
+# read or wrote, so that small and large ones don't blur the histograms
+SIZE_BUCKETS = [
+    ('<100MB', 100 * 1024 ** 2),
+    ('<1GB', 1024 ** 3),
+    ('<10GB', 10 * 1024 ** 3),
+    ('<100GB', 100 * 1024 ** 3),
+    ('>=100GB', INF),
+]
+SIZE_UNKNOWN = 'unknown'
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, INF)
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600, INF)
+RATIO_BUCKETS = (1, 1.5, 2, 3, 5, 10, 20, INF)
+
+# name: (type, documentation, labels, buckets)
+METRICS = {
+    'saas_task_duration_seconds': (
+        'histogram', "Run time of worker tasks.", ('task', 'state', 'size'), DURATION_BUCKETS),
+    'saas_task_queue_wait_seconds': (
+        'histogram', "Time tasks waited in their queue before running.", ('task', 'queue'), WAIT_BUCKETS),
+    'saas_step_duration_seconds': (
+        'histogram', "Run time of dump, archive, restore, extract and copy steps.", ('step', 'size'),
+        DURATION_BUCKETS),
+    'saas_step_compression_ratio': (
+        'histogram', "Uncompressed to compressed size of the data archived by a step.", ('step', 'size'),
+        RATIO_BUCKETS),
+    'saas_step_bytes': (
+        'counter', "Bytes read (in) and written (out) by steps.", ('step', 'direction'), None),
+    'saas_step_files': (
+        'counter', "Files processed by steps.", ('step',), None),
+}
+
+_started = {}
+
+
+def get_size_bucket(size):
+    if not size:
+        return SIZE_UNKNOWN
+    return next(label for label, limit in SIZE_BUCKETS if size < limit)
+
+
+def get_tenant_size(data):
+    """
+    Size of the backup or dump a task wrote or restored, from its results.
+    """
+    if not isinstance(data, dict):
+        return None
+    sizes = [data[key].get('size') for key in ('zip', 'dump') if isinstance(data.get(key), dict)]
+    return max([size for size in sizes if size], default=None)
+
+
+def _add(pipe, name, labels, value):
+    kind, doc, names, buckets = METRICS[name]
+    key = METRICS_PREFIX + name
+    labels = [str(label) for label in labels]
+
+    if kind == 'counter':
+        pipe.hincrbyfloat(key, json.dumps(labels), value)
+        return
+
+    # Buckets are stored as is and made cumulative when collected
+    le = next(bound for bound in buckets if value <= bound)
+    pipe.hincrby(key, json.dumps(labels + [le]), 1)
+    pipe.hincrbyfloat(key, json.dumps(labels + ['sum']), value)
+
+
+def record(observations):
+    """
+    Add (name, labels, value) observations in a single round trip, lost
+    observations are only logged: metrics must never fail a task.
+    """
+    if not METRICS_ENABLED or not observations:
+        return
+    try:
+        pipe = broker.get_client().pipeline(transaction=False)
+        for name, labels, value in observations:
+            _add(pipe, name, labels, value)
+        pipe.execute()
+    except redis.RedisError as error:
+        _logger.warning("Can't record metrics: {}".format(error))
+
+
+def task_started(task_id, task):
+    _started[task_id] = time.monotonic()
+
+    # Stamped on publish, see before_task_publish in main.py
+    request = task.request
+    sent_at = getattr(request, 'sent_at', None)
+    if not sent_at:
+        return
+    if request.eta:
+        # Delayed (retried) tasks only wait from their eta
+        try:
+            sent_at = max(sent_at, datetime.fromisoformat(request.eta).timestamp())
+        except (TypeError, ValueError):
+            pass
+
+    queue = (request.delivery_info or {}).get('routing_key') or 'unknown'
+    record([('saas_task_queue_wait_seconds', (task.name, queue), max(time.time() - sent_at, 0))])
+
+
+def task_done(task_id, task, state, retval):
+    started = _started.pop(task_id, None)
+    if started is None:
+        return
+
+    size = get_size_bucket(get_tenant_size(retval))
+    record([('saas_task_duration_seconds', (task.name, state, size), time.monotonic() - started)])
+
+
+class Step:
+    """
+    Measure a step of a task, recorded when it succeeds: duration, bytes
+    read and written, files and compression ratio. The tenant size bucket
+    is the largest amount of data the step went through unless given.
+    """
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self.size = size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.files = 0
+        self.ratio = None
+        self.started = None
+
+    def add(self, bytes_in=0, bytes_out=0, files=0):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.files += files
+
+    def compression(self, raw, compressed):
+        if raw and compressed:
+            self.ratio = raw / compressed
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.record(time.monotonic() - self.started)
+
+    def record(self, duration):
+        size = get_size_bucket(self.size or max(self.bytes_in, self.bytes_out))
+        observations = [
+            ('saas_step_duration_seconds', (self.name, size), duration),
+            ('saas_step_bytes', (self.name, 'in'), self.bytes_in),
+            ('saas_step_bytes', (self.name, 'out'), self.bytes_out),
+            ('saas_step_files', (self.name,), self.files),
+        ]
+        if self.ratio is not None:
+            observations.append(('saas_step_compression_ratio', (self.name, size), self.ratio))
+        record(observations)
+
+
+class RedisCollector:
+    """
+    Prometheus collector of the metrics aggregated in Redis by the workers.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+
+    def collect(self):
+        client = self.client or broker.get_client()
+        pipe = client.pipeline(transaction=False)
+        for name in METRICS:
+            pipe.hgetall(METRICS_PREFIX + name)
+
+        for (name, (kind, doc, labels, buckets)), values in zip(METRICS.items(), pipe.execute()):
+            if kind == 'counter':
+                family = CounterMetricFamily(name, doc, labels=labels)
+                for field, value in sorted(values.items()):
+                    family.add_metric(json.loads(field), float(value))
+                yield family
+                continue
+
+            series = {}
+            for field, value in values.items():
+                *key, suffix = json.loads(field)
+                series.setdefault(tuple(key), {})[suffix] = float(value)
+
+            family = HistogramMetricFamily(name, doc, labels=labels)
+            for key, fields in sorted(series.items()):
+                count, cumulative = 0, []
+                for bound in buckets:
+                    count += fields.get(bound, 0)
+                    cumulative.append((floatToGoString(bound), count))
+                family.add_metric(list(key), cumulative, fields.get('sum', 0))
+            yield family
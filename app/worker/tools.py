@@ -1,32 +1,70 @@
 # -*- coding: utf-8 -*-
 # Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import errno
+import glob
+import fcntl
 import gzip
+import hashlib
+import itertools
 import os
+import re
+import time
+import zlib
 # from os.path import basename
-from tempfile import TemporaryDirectory, mkdtemp
-from zipfile import ZipFile, ZIP_DEFLATED
+from tempfile import mkdtemp
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 # import psycopg2
 
 # from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import psycopg
 import json
 import shutil
-from sh import pg_dump, psql
+import uuid
+from sh import pg_dump, pg_restore, psql
 from celery.utils.log import get_task_logger
 
+from . import archive, broker, db, metrics
+from .db import POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DEFAULT_DATABASE
+
 _logger = get_task_logger(__name__)
 
 DEFAULT_DUMP_FILENAME = "dump.sql"
 DEFAULT_DUMP_CMD = ["--no-owner"]
+DEFAULT_DUMP_JOBS = int(os.environ.get("DUMP_JOBS", os.cpu_count() or 1))
+
+# Dump formats supported by pg_dump:
+#  - sql: plain SQL, gzipped, single process (Odoo compatible)
+#  - custom: pg_dump archive (-Fc), compressed by pg_dump itself
+#  - directory: one file per table (-Fd), the only format dumped with -j N
+DUMP_FORMAT_SQL = 'sql'
+DUMP_FORMAT_CUSTOM = 'custom'
+DUMP_FORMAT_DIRECTORY = 'directory'
+DUMP_FORMATS = {
+    DUMP_FORMAT_SQL: {'filename': DEFAULT_DUMP_FILENAME, 'args': ["--format=p"]},
+    DUMP_FORMAT_CUSTOM: {'filename': "dump.dump", 'args': ["--format=c"]},
+    DUMP_FORMAT_DIRECTORY: {'filename': "dump", 'args': ["--format=d"]},
+}
+
+DEFAULT_RESTORE_CMD = ["--no-owner", "--exit-on-error"]
+# post-data TOC entries built after the database is handed back when
+# restoring with deferred indexes, primary keys and unique constraints
+# are restored right away
+DEFERRED_TOC_TYPES = ('INDEX', 'INDEX ATTACH', 'FK CONSTRAINT')
+
 DEFAULT_MANIFEST_FILENAME = 'manifest.json'
+DEFAULT_FILESTORE_INDEX = 'filestore.json'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 
-POSTGRES_USER = os.environ.get("POSTGRES_USER")
-POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
-POSTGRES_HOST = os.environ.get("POSTGRES_HOST", "db")
-POSTGRES_PORT = str(os.environ.get("POSTGRES_PORT", 5432))
-POSTGRES_DEFAULT_DATABASE = 'template1'
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+FILESTORE_PREFIX = 'filestore/'
+FILESTORE_INDEX_INCREMENTAL = 'incremental'
+# Data of ir_attachment in plain SQL dumps (and pg_restore output)
+COPY_ATTACHMENT_RE = re.compile(r'^COPY (?:"?\w+"?\.)?"?ir_attachment"? \((.*)\) FROM stdin;$')
+
+IGNORED_EXTENSIONS = ['.pyc', '.pyo', '.swp', '.DS_Store']
 
 # 'C' collate is only safe with template0, but provides more useful indexes
 # collate = sql.SQL("LC_COLLATE 'C'" if chosen_template == 'template0' else "")
@@ -38,8 +76,35 @@ SQL_TEMPLATE = 'template0'
 SQL_COLLATE = "LC_COLLATE 'C'" if SQL_TEMPLATE == 'template0' else ""
 SQL_CREATE_ODOO_DATABASE = "CREATE DATABASE {} ENCODING 'unicode' {} TEMPLATE {}"
 SQL_CREATE_DATABASE = 'CREATE DATABASE "{}";'
+SQL_DROP_DATABASE = 'DROP DATABASE IF EXISTS "{}";'
+SQL_CLONE_DATABASE = 'CREATE DATABASE "{}" TEMPLATE "{}";'
+SQL_TERMINATE_BACKENDS = "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid()"
+# Databases a restore is still writing to are left out
+SQL_LIST_DATABASES = """
+SELECT datname FROM pg_database d
+WHERE NOT datistemplate AND datallowconn AND datname <> 'postgres'
+AND NOT EXISTS (
+    SELECT 1 FROM pg_stat_activity a WHERE a.datname = d.datname AND a.application_name IN ('pg_restore', 'psql')
+)
+ORDER BY datname
+"""
+SQL_IS_ODOO_DATABASE = "SELECT to_regclass('ir_module_module') IS NOT NULL"
 SQL_SELECT_MODULES = "SELECT name, latest_version FROM ir_module_module WHERE state = 'installed'"
 
+DEFAULT_CLONE_TIMEOUT = int(os.environ.get("CLONE_TIMEOUT", 60))
+# Template clone failures worth a dump/restore fallback
+CLONE_ERRORS = (psycopg.errors.ObjectInUse, psycopg.errors.InsufficientPrivilege)
+
+# Filestore blobs are never modified in place, they can be shared between
+# databases through hardlinks or reflinks (copy on write)
+FILESTORE_COPY_MODES = ('copy', 'reflink', 'hardlink')
+DEFAULT_FILESTORE_COPY_MODE = os.environ.get("FILESTORE_COPY_MODE", "reflink")
+DEFAULT_COPY_WORKERS = int(os.environ.get("COPY_WORKERS", 8))
+FICLONE = 0x40049409
+
+# Minimum delay in seconds between two progress updates of a task
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 1))
+
 OUTPUT_DIR = "/usr/src/output"
 INPUT_DIR = "/usr/src/input"
 
@@ -55,7 +120,9 @@ def clean_workdir(path, files=[]):
             shutil.rmtree(path)
         else:
             for file in files:
-                if os.path.exists(file):
+                if os.path.isdir(file) and not os.path.islink(file):
+                    shutil.rmtree(file)
+                elif os.path.lexists(file):
                     os.remove(file)
     except:
         return False
@@ -66,6 +133,7 @@ def get_postgres_connection(dbname=POSTGRES_DEFAULT_DATABASE, **kwargs):
     # Connect to your postgres DB
     params = {
         'host': POSTGRES_HOST,
+        'port': POSTGRES_PORT,
         'user': POSTGRES_USER,
         'password': POSTGRES_PASSWORD,
         'dbname': dbname,
@@ -85,13 +153,72 @@ def get_postgres_connection(dbname=POSTGRES_DEFAULT_DATABASE, **kwargs):
 def create_database(db_name):
     # db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 
-    with get_postgres_connection(autocommit=True) as conn:
+    with db.connection() as conn:
         cr = conn.cursor()
         # cr.execute(SQL_CREATE_ODOO_DATABASE.format(db_name, SQL_COLLATE, SQL_TEMPLATE))
         cr.execute(SQL_CREATE_DATABASE.format(db_name))
 
     return True
 
+def is_odoo_database(db_name):
+    # Not through a pool: most databases are only looked at once
+    try:
+        with get_postgres_connection(db_name) as conn:
+            return conn.execute(SQL_IS_ODOO_DATABASE).fetchone()[0]
+    except psycopg.OperationalError as error:
+        _logger.warning("Can't connect to database '{}': {}".format(db_name, error))
+        return False
+
+def list_databases(exclude_prefixes=()):
+    """
+    Odoo databases of the cluster, without those whose name starts with
+    one of exclude_prefixes.
+    """
+    with db.connection() as conn:
+        cr = conn.cursor()
+        cr.execute(SQL_LIST_DATABASES)
+        names = [name for name, in cr.fetchall() if not name.startswith(tuple(exclude_prefixes))]
+
+    return [name for name in names if is_odoo_database(name)]
+
+def drop_database(db_name):
+    db.release(db_name)
+
+    with db.connection() as conn:
+        cr = conn.cursor()
+        cr.execute(SQL_TERMINATE_BACKENDS, (db_name,))
+        cr.execute(SQL_DROP_DATABASE.format(db_name))
+
+    return True
+
+def clone_database(src, dest, terminate=False, timeout=DEFAULT_CLONE_TIMEOUT):
+    """
+    Server side copy of a database, the source must have no other
+    connections: they are either terminated or waited for until timeout.
+    """
+    deadline = time.monotonic() + timeout
+    attempts = 0
+
+    with metrics.Step('clone'), db.connection() as conn:
+        cr = conn.cursor()
+        while True:
+            attempts += 1
+            # Idle pooled connections of the workers would make the
+            # template busy, they may come back between attempts
+            db.release(src)
+            if terminate:
+                cr.execute(SQL_TERMINATE_BACKENDS, (src,))
+            try:
+                cr.execute(SQL_CLONE_DATABASE.format(dest, src))
+                break
+            except psycopg.errors.ObjectInUse:
+                if time.monotonic() >= deadline:
+                    raise
+                _logger.info("Database '{}' is being accessed by other users, retry...".format(src))
+                time.sleep(1)
+
+    return (True, {'db_name': dest, 'template': src, 'attempts': attempts})
+
 def guess_odoo_version(modules):
     try:
         return str(float(next(iter(modules.values())).split('.')[0]))
@@ -126,33 +253,200 @@ def _get_postgres_env():
         'PGPASSWORD': POSTGRES_PASSWORD,
     }
 
-def create_db_dump(db_name, path, filename=DEFAULT_DUMP_FILENAME, cmd=[]):
+def _get_size(path):
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    return sum(
+        os.path.getsize(os.path.join(dirpath, f))
+        for dirpath, dirnames, filenames in os.walk(path) for f in filenames
+    )
+
+
+def create_db_dump(db_name, path, filename=None, cmd=[], format=DUMP_FORMAT_SQL, jobs=1):
+    if format not in DUMP_FORMATS:
+        raise ValueError("Unknown dump format '{}'".format(format))
+
+    options = DUMP_FORMATS[format]
+    filepath = os.path.join(path, filename or options['filename'])
+
+    args = DEFAULT_DUMP_CMD + options['args'] + list(cmd)
+    # Parallel dumps are only supported by the directory format
+    if format == DUMP_FORMAT_DIRECTORY and jobs > 1:
+        args.append("--jobs={}".format(jobs))
+    else:
+        jobs = 1
+
+    with metrics.Step('dump') as step:
+        if format == DUMP_FORMAT_SQL:
+            # sh writes to the file descriptor of file objects, bypassing
+            # gzip, the writer goes through GzipFile.write instead
+            progress = Progress(step='dump')
+            with gzip.open(filepath, "wb") as f:
+                pg_dump(*args, db_name, _out=_ProgressWriter(f, progress), _out_bufsize=DEFAULT_CHUNK_SIZE,
+                        _env=_get_postgres_env())
+            step.add(bytes_in=progress.bytes)
+        else:
+            pg_dump(*args, "--file={}".format(filepath), db_name, _env=_get_postgres_env())
+        step.add(bytes_out=_get_size(filepath))
+
+    return (True, {
+        'path': filepath,
+        'size': step.bytes_out,
+        'format': format,
+        'jobs': jobs,
+    })
+
+
+def guess_dump_format(filepath):
+    if os.path.isdir(filepath):
+        if not os.path.isfile(os.path.join(filepath, 'toc.dat')):
+            raise ValueError("No toc.dat found in '{}'".format(filepath))
+        return DUMP_FORMAT_DIRECTORY
+
+    with open(filepath, 'rb') as f:
+        magic = f.read(5)
+    return DUMP_FORMAT_CUSTOM if magic == b'PGDMP' else DUMP_FORMAT_SQL
+
+
+def _is_gzip(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def _split_toc(filepath):
+    """
+    Split pg_restore TOC in two list files: entries restored immediately
+    and entries deferred to restore_db_post_data.
+    """
+    prefix = os.path.normpath(filepath)
+    immediate, deferred = "{}.toc".format(prefix), "{}.deferred.toc".format(prefix)
+
+    toc = pg_restore("--list", filepath, _env=_get_postgres_env())
+    with open(immediate, 'w') as fi, open(deferred, 'w') as fd:
+        for line in toc.splitlines():
+            # 3456; 1259 16789 INDEX public res_partner_name_idx odoo
+            entry = line.split(';', 1)[-1].split()
+            is_deferred = not line.startswith(';') and any(
+                ' '.join(entry[2:2 + len(t.split())]) == t for t in DEFERRED_TOC_TYPES
+            )
+            (fd if is_deferred else fi).write(line + "\n")
+
+    return immediate, deferred
+
+
+def restore_db_dump(db_name, filepath, cmd=[], jobs=1, defer_post_data=False):
+    _check_path(filepath)
+
+    format = guess_dump_format(filepath)
+    results = {
+        'path': filepath,
+        'size': _get_size(filepath),
+        'format': format,
+        'jobs': 1,
+        'deferred': False,
+    }
 
-    args = DEFAULT_DUMP_CMD
-    len(cmd) and args.append(*cmd)
-    args.append(db_name)
-    filepath = os.path.join(path, filename)
+    if format == DUMP_FORMAT_SQL:
+        args = ["-U", POSTGRES_USER, "-d", db_name] + list(cmd)
+        with metrics.Step('restore') as step:
+            step.add(bytes_in=results['size'])
+            if _is_gzip(filepath):
+                # sh reads the file descriptor of file objects, the
+                # compressed bytes, chunks are decompressed here instead
+                with open(filepath, 'rb') as f:
+                    chunks = iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b'')
+                    psql(*args, _in=_gunzip(chunks), _env=_get_postgres_env())
+            else:
+                psql(*args, "-f", filepath, _env=_get_postgres_env())
+        return (True, results)
 
-    with gzip.open(filepath, "wb") as f:
-        pg_dump(*args, _out=f, _env=_get_postgres_env())
+    args = DEFAULT_RESTORE_CMD + ["--dbname={}".format(db_name)] + list(cmd)
+    if jobs > 1:
+        args.append("--jobs={}".format(jobs))
+        results['jobs'] = jobs
 
-    stats = os.stat(filepath)
+    if defer_post_data:
+        immediate, deferred = _split_toc(filepath)
+        args.append("--use-list={}".format(immediate))
+        results.update(deferred=deferred)
 
-    return (True, {'path': filepath, 'size': stats.st_size})
+    with metrics.Step('restore') as step:
+        step.add(bytes_in=results['size'])
+        pg_restore(*args, filepath, _env=_get_postgres_env())
 
+    return (True, results)
 
-def restore_db_dump(db_name, filepath, cmd=[]):
 
-    if not os.path.isfile(filepath):
-        raise FileNotFoundError(filepath)
+def _gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
 
-    args = ["-U", POSTGRES_USER, "-d", db_name, "-f", filepath]
 
-    psql(*args, _env=_get_postgres_env())
+def restore_db_stream(db_name, zipfile, cmd=[], task=None, task_id=None):
+    """
+    Feed the dump member of a backup straight into psql or pg_restore,
+    decompressed on the fly, nothing is extracted to disk. pg_restore can't
+    run parallel jobs nor use a TOC list when reading from stdin.
+    """
+    manifest = read_manifest(zipfile)
+    format = manifest.get('dump_format', DUMP_FORMAT_SQL)
+    if format == DUMP_FORMAT_DIRECTORY:
+        raise ValueError("Directory format dumps can't be streamed")
+
+    filename = get_dump_filename(manifest)
+    try:
+        chunks = archive.iter_member(zipfile, filename)
+        first = next(chunks, b'')
+    except KeyError:
+        raise ValueError("No dump file found")
+
+    chunks = itertools.chain([first], chunks)
+    if first[:2] == b'\x1f\x8b':
+        chunks = _gunzip(chunks)
+
+    progress = Progress(task, task_id, step='restore')
+
+    def counter(chunks):
+        for chunk in chunks:
+            progress.update(size=len(chunk))
+            yield chunk
+
+    with metrics.Step('restore_stream') as step:
+        if format == DUMP_FORMAT_SQL:
+            args = ["-U", POSTGRES_USER, "-d", db_name] + list(cmd)
+            psql(*args, _in=counter(chunks), _env=_get_postgres_env())
+        else:
+            args = DEFAULT_RESTORE_CMD + ["--dbname={}".format(db_name)] + list(cmd)
+            pg_restore(*args, _in=counter(chunks), _env=_get_postgres_env())
+        step.add(bytes_in=progress.bytes)
 
-    stats = os.stat(filepath)
+    return (True, {
+        'path': zipfile,
+        'member': filename,
+        'size': progress.bytes,
+        'format': format,
+        'jobs': 1,
+        'deferred': False,
+    })
 
-    return (True, {'path': filepath, 'size': stats.st_size})
+
+def restore_db_post_data(db_name, filepath, deferred, cmd=[], jobs=1):
+    """
+    Build the indexes and foreign keys left aside by restore_db_dump.
+    """
+    _check_path(deferred)
+
+    args = DEFAULT_RESTORE_CMD + ["--dbname={}".format(db_name), "--use-list={}".format(deferred)]
+    args += list(cmd)
+    if jobs > 1:
+        args.append("--jobs={}".format(jobs))
+
+    with metrics.Step('restore_post_data'):
+        pg_restore(*args, filepath, _env=_get_postgres_env())
+
+    return (True, {'path': filepath, 'deferred': deferred, 'jobs': jobs})
 
 
 def _check_path(path, raise_if_not_found=True):
@@ -168,52 +462,446 @@ def unzip_files(zipfile, files, **options):
     tmp_dir = mkdtemp(**options)
     unzip_files = []
 
-    with ZipFile(zipfile, 'r') as myzip:
-        for f in files:
-            try:
-                myzip.extract(f, path=tmp_dir)
-                new_file = os.path.join(tmp_dir, f)
-                stats = os.stat(new_file)
-                unzip_files.append({'path': new_file, 'size': stats.st_size})
-            except KeyError:
-                print("No file found: {}".format(f))
-                continue
+    members = {f: os.path.normpath(os.path.join(tmp_dir, f)) for f in files}
+    found = archive.extract(zipfile, members)
+
+    for f in files:
+        if f not in found and not (f.endswith('/') and os.path.isdir(members[f])):
+            print("No file found: {}".format(f))
+            continue
+        unzip_files.append({'path': members[f], 'size': _get_size(members[f])})
 
     return unzip_files
 
 
-def unzip_filestore(zipfile, db_name, path):
+def _read_json_member(zipfile, filename):
     _check_path(zipfile)
 
-    with TemporaryDirectory() as tmp_dir:
-        with ZipFile(zipfile, 'r') as myzip:
-            files = [f for f in myzip.namelist() if f.startswith('filestore/')]
-            for f in files:
-                myzip.extract(f, path=tmp_dir)
-        shutil.move(os.path.join(tmp_dir, "filestore"), os.path.join(tmp_dir, db_name))
-        shutil.move(os.path.join(tmp_dir, db_name), path)
+    content = archive.read_member(zipfile, filename)
+    return json.loads(content) if content else {}
 
-    stats = os.stat(zipfile)
-    return (True, {'path': path, 'size': stats.st_size})
 
-def unzip_backup(zipfile, path):
+def read_manifest(zipfile, filename=DEFAULT_MANIFEST_FILENAME):
+    return _read_json_member(zipfile, filename)
+
+
+def read_filestore_index(zipfile, filename=DEFAULT_FILESTORE_INDEX):
+    """
+    Filestore index of backups not holding the filestore files themselves.
+    """
+    return _read_json_member(zipfile, filename)
+
+
+def get_dump_filename(manifest):
+    """
+    Name of the dump member inside a backup, folders end with a slash.
+    """
+    format = manifest.get('dump_format', DUMP_FORMAT_SQL)
+    filename = DUMP_FORMATS[format]['filename']
+    return filename + '/' if format == DUMP_FORMAT_DIRECTORY else filename
+
+
+def find_backup(filename):
+    """
+    Look for a backup by name in the input folder, then in workdirs.
+    """
+    for path in [INPUT_DIR] + sorted(glob.glob(os.path.join(OUTPUT_DIR, '*'))):
+        names = [filename] + [archive.get_archive_path(filename, format) for format in archive.ARCHIVE_FORMATS]
+        for name in names:
+            filepath = os.path.join(path, name)
+            if os.path.isfile(filepath):
+                return filepath
+    raise FileNotFoundError(filename)
+
+
+def get_file_key(filepath):
+    """
+    Odoo names filestore blobs after the sha1 of their content, other files
+    (e.g. the checklist folder) are hashed.
+    """
+    fname = os.path.basename(filepath)
+    if SHA1_RE.match(fname):
+        return fname
+
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def index_folder(path):
+    """
+    Map each file of a filestore, relative to it, to its blob key.
+    """
+    index = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            bname, ext = os.path.splitext(fname)
+            if (ext or bname) in IGNORED_EXTENSIONS:
+                continue
+            filepath = os.path.join(dirpath, fname)
+            index[os.path.relpath(filepath, path)] = get_file_key(filepath)
+    return index
+
+
+def get_filestore_index(zipfile):
+    """
+    Full filestore index of a backup, whatever the way it was stored.
+    """
+    index = read_filestore_index(zipfile)
+    if index:
+        return index['files']
+
+    return {
+        name[len(FILESTORE_PREFIX):]: os.path.basename(name)
+        for name in archive.namelist(zipfile)
+        if name.startswith(FILESTORE_PREFIX) and not name.endswith('/')
+    }
+
+
+def diff_filestore(path, zipfile):
+    """
+    Changes of a filestore since the backup zipfile, files not named after
+    their checksum are always considered as changed.
+    """
+    mode = read_filestore_index(zipfile).get('mode', FILESTORE_INDEX_INCREMENTAL)
+    if mode != FILESTORE_INDEX_INCREMENTAL:
+        raise ValueError("Can't make an incremental backup on top of a '{}' backup".format(mode))
+
+    previous = get_filestore_index(zipfile)
+    index = index_folder(path)
+
+    added = [relpath for relpath, key in index.items() if previous.get(relpath) != key]
+    deleted = [relpath for relpath in previous if relpath not in index]
+
+    return {
+        'mode': FILESTORE_INDEX_INCREMENTAL,
+        'base': os.path.basename(zipfile),
+        # Backups of different workdirs can have the same filename
+        'base_path': os.path.abspath(zipfile),
+        'files': index,
+        'added': added,
+        'deleted': deleted,
+    }
+
+
+def get_backup_chain(zipfile):
+    """
+    Backups needed to restore the filestore of zipfile, oldest first. Bases
+    are found by their path, by their filename next to the backup or in
+    the backup folders if they were moved (or for older indexes).
+    """
+    chain = [zipfile]
+    index = read_filestore_index(zipfile)
+    while index.get('mode') == FILESTORE_INDEX_INCREMENTAL:
+        base = index.get('base_path')
+        if not base or not os.path.isfile(base):
+            base = os.path.join(os.path.dirname(chain[0]), index['base'])
+        if not os.path.isfile(base):
+            base = find_backup(index['base'])
+        if base in chain:
+            raise ValueError("Circular backup chain on {}".format(base))
+        chain.insert(0, base)
+        index = read_filestore_index(base)
+    return chain
+
+
+def _get_safe_path(path, relpath):
+    """
+    Join relpath to path without leaving path.
+    """
+    filepath = os.path.normpath(os.path.join(path, relpath))
+    if not filepath.startswith(os.path.normpath(path) + os.sep):
+        raise ValueError("Illegal member path {}".format(relpath))
+    return filepath
+
+
+def unzip_filestore_chain(zipfiles, db_name, path, task=None, task_id=None):
+    """
+    Restore a filestore from a full backup followed by incremental ones:
+    each file of the latest index is taken from the newest backup holding it.
+    """
+    for zipfile in zipfiles:
+        _check_path(zipfile)
+
+    target = os.path.join(path, db_name)
+    if os.path.exists(target):
+        raise FileExistsError(target)
+
+    remaining = dict(get_filestore_index(zipfiles[-1]))
+    total = len(remaining)
+    progress = Progress(task, task_id, step='extract', total=total)
+    staging = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+    os.makedirs(staging)
+
+    try:
+        with metrics.Step('extract') as step:
+            for zipfile in reversed(zipfiles):
+                members = {FILESTORE_PREFIX + relpath: _get_safe_path(staging, relpath) for relpath in remaining}
+                done = total - len(remaining)
+                extracted = archive.extract_parallel(
+                    zipfile, members, callback=lambda count, _: progress.update(count=done + count))
+                step.add(bytes_in=os.path.getsize(zipfile), files=len(extracted))
+                for member in extracted:
+                    del remaining[member[len(FILESTORE_PREFIX):]]
+                if not remaining:
+                    break
+
+        if remaining:
+            raise FileNotFoundError("{} filestore files missing from backups, e.g. {}".format(
+                len(remaining), next(iter(remaining))))
+
+        os.rename(staging, target)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+    return (True, {'path': target, 'backups': zipfiles})
+
+
+class Progress:
+    """
+    Throttled progress of a task step: stored in the task state and
+    published on the task events channel at most once per PROGRESS_INTERVAL.
+    Without a task id progress is only counted.
+    """
+
+    def __init__(self, task=None, task_id=None, step=None, total=None, interval=PROGRESS_INTERVAL):
+        self.task = task
+        self.task_id = task_id or (task and task.request.id)
+        self.step = step
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.bytes = 0
+        self.last = 0
+
+    def update(self, count=None, total=None, size=0):
+        if count is not None:
+            self.count = count
+        if total is not None:
+            self.total = total
+        self.bytes += size
+
+        now = time.monotonic()
+        if now - self.last >= self.interval or self.count == self.total:
+            self.last = now
+            self.report()
+
+    def report(self):
+        if not self.task_id:
+            return
+        meta = {'step': self.step, 'count': self.count, 'total': self.total, 'bytes': self.bytes}
+        if self.total:
+            meta['progress'] = int((self.count * 100) / self.total)
+        if self.task:
+            self.task.update_state(task_id=self.task_id, state="PROGRESS", meta=meta)
+        broker.publish(self.task_id, dict(meta, event='progress', task_id=self.task_id))
+
+    def __call__(self, count, total):
+        self.update(count=count, total=total)
+
+
+class _ProgressWriter:
+    """
+    File object counting the bytes written through it.
+    """
+
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def write(self, data):
+        self.progress.update(size=len(data))
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def _extract_to(zipfile, members, target, task=None, task_id=None):
+    """
+    Extract members in a staging folder next to target, renamed to target
+    once complete. Members is a dict of member name (or folder) to path
+    relative to target.
+    """
+    if os.path.exists(target):
+        raise FileExistsError(target)
+
+    staging = "{}.{}.tmp".format(os.path.normpath(target), uuid.uuid4().hex)
+    os.makedirs(staging)
+
+    try:
+        members = {name: os.path.join(staging, relpath) for name, relpath in members.items()}
+        with metrics.Step('extract') as step:
+            extracted = archive.extract_parallel(zipfile, members, callback=Progress(task, task_id, step='extract'))
+            step.add(bytes_in=os.path.getsize(zipfile), files=len(extracted))
+        os.rename(staging, target)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+
+def unzip_filestore(zipfile, db_name, path, task=None, task_id=None):
     _check_path(zipfile)
 
-    if not os.path.isdir(path):
-        os.mkdir(path)
+    target = os.path.join(path, db_name)
+    _extract_to(zipfile, {FILESTORE_PREFIX: ''}, target, task=task, task_id=task_id)
+
+    stats = os.stat(zipfile)
+    return (True, {'path': target, 'size': stats.st_size})
+
+def unzip_backup(zipfile, path, task=None, task_id=None):
+    _check_path(zipfile)
 
-    with ZipFile(zipfile, 'r') as myzip:
-        # Extract all the contents of zip file in different directory
-        myzip.extractall(path)
+    # An empty target is replaced, not merged into
+    if os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+    _extract_to(zipfile, {'': ''}, path, task=task, task_id=task_id)
 
     stats = os.stat(zipfile)
     return (True, {'path': path, 'size': stats.st_size})
 
 
+def get_attachment_path(checksum):
+    """
+    Filestore path of an attachment given the sha1 of its content.
+    """
+    return "{}/{}".format(checksum[:2], checksum)
+
+
+def _iter_lines(chunks):
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if pending:
+        yield pending.decode('utf-8', 'replace')
+
+
+def _iter_dump_lines(zipfile, manifest):
+    """
+    Lines of the SQL of a dump, custom format dumps are converted by
+    pg_restore reading from stdin: no database is needed.
+    """
+    format = manifest.get('dump_format', DUMP_FORMAT_SQL)
+    if format == DUMP_FORMAT_DIRECTORY:
+        raise ValueError("Attachments can't be looked up in directory format dumps")
+
+    chunks = archive.iter_member(zipfile, get_dump_filename(manifest))
+    first = next(chunks, b'')
+    chunks = itertools.chain([first], chunks)
+    if first[:2] == b'\x1f\x8b':
+        chunks = _gunzip(chunks)
+
+    if format != DUMP_FORMAT_CUSTOM:
+        yield from _iter_lines(chunks)
+        return
+
+    args = ["--data-only", "--table=ir_attachment", "--file=-"]
+    proc = pg_restore(*args, _in=chunks, _iter=True, _env=_get_postgres_env())
+    try:
+        for line in proc:
+            yield line.rstrip('\n')
+    finally:
+        # Closed early, pg_restore would otherwise run until its pipe breaks
+        if proc.process.is_alive()[0]:
+            try:
+                proc.process.terminate()
+            except ProcessLookupError:
+                pass
+
+
+def find_attachments(zipfile, ids):
+    """
+    Filestore path of ir_attachment records given their ids, read from the
+    dump of a backup. Only the dump is read, up to the end of the
+    ir_attachment data. Records stored in the database have no path.
+    """
+    ids = set(str(int(value)) for value in ids)
+    found = {}
+    columns = None
+
+    lines = _iter_dump_lines(zipfile, read_manifest(zipfile))
+    try:
+        for line in lines:
+            if columns is None:
+                match = COPY_ATTACHMENT_RE.match(line)
+                if match:
+                    columns = [name.strip().strip('"') for name in match.group(1).split(',')]
+                    id_index, fname_index = columns.index('id'), columns.index('store_fname')
+                continue
+            if line == '\\.':
+                break
+            values = line.split('\t')
+            if values[id_index] in ids:
+                fname = values[fname_index]
+                found[int(values[id_index])] = None if fname == '\\N' else fname
+                if len(found) == len(ids):
+                    break
+    finally:
+        # Stop decompressing (or pg_restore) as soon as done
+        lines.close()
+
+    return found
+
+
+def restore_filestore_files(zipfiles, relpaths, target, overwrite=False):
+    """
+    Restore some files of a filestore from a backup chain, oldest first,
+    each taken from the newest backup holding it. Zip backups are read by
+    random access from their central directory, tar archives are scanned.
+    Files already present are kept unless overwrite, each file is written
+    next to its target and renamed in place.
+    """
+    targets = {relpath: _get_safe_path(target, relpath) for relpath in relpaths}
+    skipped = [] if overwrite else [relpath for relpath, filepath in targets.items() if os.path.exists(filepath)]
+    remaining = set(targets) - set(skipped)
+    restored = []
+
+    os.makedirs(target, exist_ok=True)
+    staging = "{}.{}.tmp".format(os.path.normpath(target), uuid.uuid4().hex)
+    os.makedirs(staging)
+
+    try:
+        with metrics.Step('restore_files') as step:
+            for zipfile in reversed(zipfiles):
+                if not remaining:
+                    break
+                members = {FILESTORE_PREFIX + relpath: _get_safe_path(staging, relpath) for relpath in remaining}
+                for member in archive.extract(zipfile, members):
+                    relpath = member[len(FILESTORE_PREFIX):]
+                    os.makedirs(os.path.dirname(targets[relpath]), exist_ok=True)
+                    step.add(bytes_out=os.path.getsize(members[member]), files=1)
+                    os.replace(members[member], targets[relpath])
+                    remaining.discard(relpath)
+                    restored.append(relpath)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return (True, {
+        'path': target,
+        'restored': sorted(restored),
+        'skipped': sorted(skipped),
+        'missing': sorted(remaining),
+        'backups': zipfiles,
+    })
+
+
+def write_to_zip(zipfile, filename, content):
+    with ZipFile(zipfile, 'a', compression=ZIP_DEFLATED, allowZip64=True) as myzip:
+        myzip.writestr(filename, content)
+
+    stats = os.stat(zipfile)
+
+    return (True, {'path': zipfile, 'size':stats.st_size})
+
+
 def add_to_zip(files, zipfile, **kwargs):
-    extension = '.zip'
-    if not zipfile.endswith(extension):
-        zipfile += extension
+    zipfile = archive.get_archive_path(zipfile)
 
     options = {
         'compression': ZIP_DEFLATED,
@@ -221,72 +909,236 @@ def add_to_zip(files, zipfile, **kwargs):
     }
     options.update(kwargs)
 
-    with ZipFile(zipfile, 'w', **options) as myzip:
-        for filepath in files:
-            filepath = os.path.normpath(filepath)
-            filename = filepath[len(os.path.dirname(filepath))+1:]
-
-            if os.path.isfile(filepath):
-                myzip.write(filepath, filename)
-
-    stats = os.stat(zipfile)
+    items = []
+    for filepath in files:
+        filepath = os.path.normpath(filepath)
+        len_prefix = len(os.path.dirname(filepath)) + 1
+        filename = filepath[len_prefix:]
+
+        if os.path.isfile(filepath):
+            items.append((filepath, filename))
+        elif os.path.isdir(filepath):
+            # Directory format dumps
+            for dirpath, dirnames, filenames in os.walk(filepath):
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    items.append((path, path[len_prefix:]))
+
+    with metrics.Step('archive') as step:
+        with ZipFile(zipfile, 'w', **options) as myzip:
+            archive.write_files(myzip, items)
+
+        stats = os.stat(zipfile)
+        raw = sum(os.path.getsize(filepath) for filepath, arcname in items)
+        step.add(bytes_in=raw, bytes_out=stats.st_size, files=len(items))
+        step.compression(raw, stats.st_size)
 
     return (True, {'path': zipfile, 'size':stats.st_size})
 
 
-def create_odoo_manifest(path, db_name, filename=DEFAULT_MANIFEST_FILENAME):
-    manifest = {}
-    filepath = os.path.join(path, filename)
-    with open(filepath, 'w') as fh:
-        db = get_postgres_connection(db_name)
-        with db.cursor() as cr:
+def get_odoo_manifest(db_name, **kwargs):
+    with db.connection(db_name) as conn:
+        with conn.cursor() as cr:
             manifest = dump_db_manifest(cr)
-            json.dump(manifest, fh, indent=4)
+    manifest.update(kwargs)
 
-    return (filepath, manifest)
+    return manifest
 
 
-def add_folder_to_zip(path, zipfile, task=None):
-    myzip = ZipFile(zipfile, 'a', compression=ZIP_DEFLATED, allowZip64=True)
+def create_odoo_manifest(path, db_name, filename=DEFAULT_MANIFEST_FILENAME, **kwargs):
+    filepath = os.path.join(path, filename)
+    manifest = get_odoo_manifest(db_name, **kwargs)
+    with open(filepath, 'w') as fh:
+        json.dump(manifest, fh, indent=4)
 
-    include_dir = True
-    path = os.path.normpath(path)
-    len_prefix = len(os.path.dirname(path)) if include_dir else len(path)
-    if len_prefix:
-        len_prefix += 1
+    return (filepath, manifest)
 
-    total = sum([len(files) for base, dirs, files in os.walk(path)])
-    count = 0
 
+def _iter_folder(path, arcname, files=None):
     for dirpath, dirnames, filenames in os.walk(path):
         # filenames = sorted(filenames, key=fnct_sort)
         for fname in filenames:
             bname, ext = os.path.splitext(fname)
             ext = ext or bname
-            if ext not in ['.pyc', '.pyo', '.swp', '.DS_Store']:
-                path = os.path.normpath(os.path.join(dirpath, fname))
-                count += 1
-                if os.path.isfile(path):
-                    myzip.write(path, path[len_prefix:])
-            else:
-                count -= 1
-            progress = int((count * 100) / total)
+            if ext in IGNORED_EXTENSIONS:
+                continue
+            filepath = os.path.normpath(os.path.join(dirpath, fname))
+            relpath = os.path.relpath(filepath, path)
+            if files is not None and relpath not in files:
+                continue
+            if os.path.isfile(filepath):
+                yield filepath, os.path.join(arcname, relpath)
 
-            if task and progress in [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]:
-                task.update_state(state="PROGRESS", meta={'progress': progress})
 
+def _write_folder(myzip, path, arcname=None, files=None, task=None, step=None):
+    path = os.path.normpath(path)
+    arcname = os.path.basename(path) if arcname is None else arcname
+
+    if files is not None:
+        files = set(files)
+        total = len(files)
+    else:
+        total = sum([len(files) for base, dirs, files in os.walk(path)])
+    progress = Progress(task, step='filestore', total=total)
+
+    def callback(filepath, arcname):
+        size = os.path.getsize(filepath)
+        progress.update(count=progress.count + 1, size=size)
+        if step:
+            step.add(bytes_in=size, files=1)
+
+    return archive.write_files(myzip, _iter_folder(path, arcname, files), callback=callback)
 
-    myzip.close()
-    stats = os.stat(zipfile)
+
+def add_folder_to_zip(path, zipfile, files=None, task=None):
+    with metrics.Step('archive_filestore') as step:
+        size = os.path.getsize(zipfile)
+        with ZipFile(zipfile, 'a', compression=ZIP_DEFLATED, allowZip64=True) as myzip:
+            _write_folder(myzip, path, files=files, task=task, step=step)
+
+        stats = os.stat(zipfile)
+        step.add(bytes_out=stats.st_size - size)
+        step.compression(step.bytes_in, step.bytes_out)
 
     return (True, {'path': zipfile, 'size':stats.st_size})
 
 
-def copy_filestore(src_path, dest_path):
+def create_backup(db_name, zipfile, manifest, filestore=None, format=DUMP_FORMAT_SQL, cmd=[], members={}, files=None,
+                  archive_format=archive.ARCHIVE_FORMAT_ZIP, task=None):
+    """
+    Write a complete backup in a single pass: manifest, pg_dump output
+    streamed straight into its archive entry, then the filestore. Nothing is
+    written to disk except the archive itself.
+    """
+    if format == DUMP_FORMAT_DIRECTORY:
+        raise ValueError("Directory format dumps can't be streamed")
+
+    zipfile = archive.get_archive_path(zipfile, archive_format)
+
+    options = DUMP_FORMATS[format]
+    args = DEFAULT_DUMP_CMD + options['args'] + list(cmd)
+    progress = Progress(task, step='dump')
+
+    with metrics.Step('backup') as step:
+        if archive_format == archive.ARCHIVE_FORMAT_TAR_ZST:
+            with archive.TarZstWriter(zipfile) as tar:
+                tar.writestr(DEFAULT_MANIFEST_FILENAME, json.dumps(manifest, indent=4))
+                for filename, content in members.items():
+                    tar.writestr(filename, content)
+
+                with tar.open(options['filename']) as dest:
+                    pg_dump(*args, db_name, _out=_ProgressWriter(dest, progress), _out_bufsize=DEFAULT_CHUNK_SIZE,
+                            _env=_get_postgres_env())
+                dump = {'format': format, 'size': dest.size, 'parts': dest.parts}
+
+                if filestore:
+                    _write_folder(tar, filestore, arcname='filestore', files=files, task=task, step=step)
+        else:
+            with ZipFile(zipfile, 'w', compression=ZIP_DEFLATED, compresslevel=archive.ZIP_COMPRESSION_LEVEL, allowZip64=True) as myzip:
+                myzip.writestr(DEFAULT_MANIFEST_FILENAME, json.dumps(manifest, indent=4))
+                for filename, content in members.items():
+                    myzip.writestr(filename, content)
+
+                zinfo = ZipInfo(options['filename'], date_time=datetime.now().timetuple()[:6])
+                # Custom format dumps are already compressed by pg_dump
+                zinfo.compress_type = ZIP_DEFLATED if format == DUMP_FORMAT_SQL else ZIP_STORED
+                archive.set_compress_level(zinfo, archive.ZIP_COMPRESSION_LEVEL)
+                with myzip.open(zinfo, 'w', force_zip64=True) as dest:
+                    pg_dump(*args, db_name, _out=_ProgressWriter(dest, progress), _out_bufsize=DEFAULT_CHUNK_SIZE,
+                            _env=_get_postgres_env())
+                info = myzip.getinfo(options['filename'])
+                dump = {'format': format, 'size': info.file_size, 'compress_size': info.compress_size}
+
+                if filestore:
+                    _write_folder(myzip, filestore, arcname='filestore', files=files, task=task, step=step)
+
+        stats = os.stat(zipfile)
+        step.add(bytes_in=dump['size'], bytes_out=stats.st_size)
+        step.compression(step.bytes_in, stats.st_size)
+
+    return (True, {
+        'path': zipfile,
+        'size': stats.st_size,
+        'format': archive_format,
+        'dump': dump,
+    })
+
+
+def _reflink_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            # No reflink support, let the kernel copy the data (server side
+            # on network filesystems), across devices on recent kernels only
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            except (OSError, AttributeError):
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, DEFAULT_CHUNK_SIZE)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _hardlink_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        # Across devices
+        shutil.copy2(src, dst)
+    return dst
+
+
+COPY_FUNCTIONS = {
+    'copy': shutil.copy2,
+    'reflink': _reflink_file,
+    'hardlink': _hardlink_file,
+}
+
+
+def _copy_tree(src, dst, copy_function=shutil.copy2, workers=DEFAULT_COPY_WORKERS, progress=None):
+    """
+    copytree with a thread per top-level folder, Odoo filestores are split
+    in 256 folders named after the first two characters of the checksum.
+    """
+    os.makedirs(dst)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for entry in os.scandir(src):
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir():
+                futures.append(executor.submit(shutil.copytree, entry.path, target, copy_function=copy_function))
+            else:
+                futures.append(executor.submit(copy_function, entry.path, target))
+        for count, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress:
+                progress.update(count=count, total=len(futures))
+
+    shutil.copystat(src, dst)
+
+
+def copy_filestore(src_path, dest_path, mode=DEFAULT_FILESTORE_COPY_MODE, workers=DEFAULT_COPY_WORKERS, task=None):
     _check_path(src_path)
 
-    shutil.copytree(src_path, dest_path)
+    if mode not in COPY_FUNCTIONS:
+        raise ValueError("Unknown filestore copy mode '{}'".format(mode))
+
+    progress = Progress(task, step='copy')
+    # Hardlinks and reflinks are much cheaper than copies, timed apart
+    with metrics.Step('copy_{}'.format(mode)):
+        _copy_tree(src_path, dest_path, copy_function=COPY_FUNCTIONS[mode], workers=workers, progress=progress)
 
     stats = os.stat(dest_path)
 
-    return (True, {'path': dest_path, 'size':stats.st_size})
\ No newline at end of file
+    return (True, {'path': dest_path, 'size':stats.st_size, 'mode': mode})
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Part of SaaS Backend. See LICENSE file for full copyright and licensing details.
+
+from datetime import datetime
+import os
+import re
+import time
+import uuid
+from celery.utils.log import get_task_logger
+import psycopg
+
+from . import broker, db, tools
+
+_logger = get_task_logger(__name__)
+
+# Databases restored ahead of time from template backups, handed to new
+# tenants by a rename. Templates are given as name:backup filename pairs in
+# the input folder, e.g. "default:template_15.zip,shop:shop_15.zip".
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", 2))
+WARM_REFILL_INTERVAL = float(os.environ.get("WARM_REFILL_INTERVAL", 60))
+# A restore not done after that is considered lost and started again
+WARM_PENDING_TTL = int(os.environ.get("WARM_PENDING_TTL", 3600))
+WARM_PREFIX = 'warm_'
+# Tenant names end up in SQL and filestore paths, same rule as Odoo
+DB_NAME_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_.-]{0,62}$')
+DEFAULT_TEMPLATE = 'default'
+
+# Ready databases of a template are a list popped by claims, the restores
+# running a sorted set scored by their expiry
+READY_KEY = 'saas:warm:{}:ready'
+PENDING_KEY = 'saas:warm:{}:pending'
+LOCK_KEY = 'saas:warm:{}:lock'
+
+SQL_RENAME_DATABASE = 'ALTER DATABASE "{}" RENAME TO "{}";'
+# Copies of a template must not share the uuid Odoo identifies them with,
+# nor the secret it signs sessions and tokens with
+SQL_RESET_PARAMETER = "UPDATE ir_config_parameter SET value = %s WHERE key = %s"
+# Claim failures leaving the ready database untouched: anything raised up
+# to the database rename, a filestore that can't be renamed gives the
+# database its name back
+CLAIM_ERRORS = (ValueError, OSError, psycopg.Error)
+
+
+def _parse_templates(value):
+    templates = {}
+    for template in filter(None, (template.strip() for template in value.split(','))):
+        try:
+            name, filename = template.split(':')
+            if not name or not filename:
+                raise ValueError(template)
+        except ValueError:
+            # Not worth failing every worker and the API on import
+            _logger.warning("Ignored warm template '{}', expected name:backup".format(template))
+            continue
+        templates[name] = filename
+    return templates
+
+
+WARM_TEMPLATES = _parse_templates(os.environ.get("WARM_TEMPLATES", ""))
+
+
+def check_db_name(name):
+    """
+    Raise a ValueError unless name can be given to a tenant database.
+    """
+    if not isinstance(name, str) or not DB_NAME_RE.match(name):
+        raise ValueError("Invalid database name '{}'".format(name))
+    if name.startswith(WARM_PREFIX):
+        raise ValueError("Database names starting with '{}' are reserved".format(WARM_PREFIX))
+
+
+def get_template(name):
+    if name not in WARM_TEMPLATES:
+        raise KeyError("Unknown template '{}'".format(name))
+    return WARM_TEMPLATES[name]
+
+
+def get_status():
+    client = broker.get_client()
+    pipe = client.pipeline(transaction=False)
+    for name in WARM_TEMPLATES:
+        pipe.zremrangebyscore(PENDING_KEY.format(name), '-inf', time.time())
+        pipe.lrange(READY_KEY.format(name), 0, -1)
+        pipe.zcard(PENDING_KEY.format(name))
+    results = pipe.execute()
+
+    return {
+        name: {
+            'backup': filename,
+            'size': WARM_POOL_SIZE,
+            'ready': [value.decode() for value in results[i * 3 + 1]],
+            'pending': results[i * 3 + 2],
+        } for i, (name, filename) in enumerate(WARM_TEMPLATES.items())
+    }
+
+
+def plan_refill(name, size=WARM_POOL_SIZE):
+    """
+    Names of the databases to restore for a template to have size ready
+    ones, registered as pending. Concurrent refills of a template are
+    skipped.
+    """
+    client = broker.get_client()
+    if not client.set(LOCK_KEY.format(name), 1, nx=True, ex=60):
+        return []
+
+    try:
+        pending = PENDING_KEY.format(name)
+        client.zremrangebyscore(pending, '-inf', time.time())
+        missing = size - client.llen(READY_KEY.format(name)) - client.zcard(pending)
+        names = ["{}{}_{}".format(WARM_PREFIX, name, uuid.uuid4().hex[:12]) for i in range(max(missing, 0))]
+        if names:
+            client.zadd(pending, {db_name: time.time() + WARM_PENDING_TTL for db_name in names})
+            _logger.info("Warm pool '{}': restore {} databases".format(name, len(names)))
+    finally:
+        client.delete(LOCK_KEY.format(name))
+
+    return names
+
+
+def set_ready(name, db_name):
+    pipe = broker.get_client().pipeline()
+    pipe.zrem(PENDING_KEY.format(name), db_name)
+    pipe.rpush(READY_KEY.format(name), db_name)
+    pipe.execute()
+
+
+def pop_ready(name):
+    """
+    Take a ready database of a template, None if there is none left. A
+    database is only ever given to one caller.
+    """
+    value = broker.get_client().lpop(READY_KEY.format(name))
+    return value and value.decode()
+
+
+def push_back(name, db_name):
+    broker.get_client().lpush(READY_KEY.format(name), db_name)
+
+
+def get_database_parameters():
+    """
+    New identity of a copied database, as Odoo sets it on its own copies.
+    """
+    return {
+        'database.secret': str(uuid.uuid4()),
+        'database.uuid': str(uuid.uuid1()),
+        'database.create_date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def claim_database(db_name, new_db, filestore_path):
+    """
+    Rename a ready database and its filestore to a tenant, both renames are
+    instant whatever their size.
+    """
+    check_db_name(new_db)
+    filestore, new_filestore = os.path.join(filestore_path, db_name), os.path.join(filestore_path, new_db)
+    if os.path.exists(new_filestore):
+        raise FileExistsError(new_filestore)
+
+    # Before the rename: on failure the database is still the pool's
+    with db.connection(db_name) as conn:
+        for key, value in get_database_parameters().items():
+            conn.execute(SQL_RESET_PARAMETER, (value, key))
+
+    db.release(db_name)
+    with db.connection() as conn:
+        cr = conn.cursor()
+        cr.execute(tools.SQL_TERMINATE_BACKENDS, (db_name,))
+        cr.execute(SQL_RENAME_DATABASE.format(db_name, new_db))
+        try:
+            if os.path.isdir(filestore):
+                os.rename(filestore, new_filestore)
+        except OSError:
+            try:
+                cr.execute(SQL_RENAME_DATABASE.format(new_db, db_name))
+            except psycopg.Error as error:
+                # Not a claim error, the database is no longer the pool's
+                raise RuntimeError("Database '{}' left as '{}' without its filestore".format(
+                    db_name, new_db)) from error
+            raise
+
+    return (True, {'db_name': new_db, 'from': db_name, 'filestore': new_filestore})